@@ -0,0 +1,90 @@
+"""
+Бенчмарк стисненого архіву діалогів (dialog_archive.py).
+
+Порівнює для синтетичних діалогів:
+  - обсяг: рядки client_messages (оцінка з накладними витратами Postgres на рядок та індекси)
+    проти одного запису dialog_archives зі стисненим blob;
+  - читання: кількість рядків, які треба отримати з БД, і час розпакування архіву в Python.
+
+Запуск: python bench_dialog_archive.py [кількість_діалогів]
+"""
+import sys
+import time
+import random
+from datetime import datetime, timedelta
+
+from dialog_archive import encode_dialog, decode_dialog, zstandard
+
+# Накладні витрати Postgres на один рядок client_messages: заголовок кортежу (24), вказівник (4),
+# message_id + client_id + timestamp (24), заголовки змінних полів (2), записи двох індексів (~2 * 32)
+ROW_OVERHEAD_BYTES = 24 + 4 + 24 + 2 + 64
+# Один рядок dialog_archives: заголовок, вказівник, фіксовані колонки, codec, запис індексу
+ARCHIVE_ROW_OVERHEAD_BYTES = 24 + 4 + 8 * 4 + 4 + 8 + 32
+
+CLIENT_PHRASES = [
+    "Добрий день! Потрібні гальмівні диски на Golf 7 2015 року",
+    "VIN WVWZZZAUZFW123456",
+    "А є оригінал, не аналог?",
+    "Скільки їхати до Києва?",
+    "Дякую, беру",
+    "Можна оплату при отриманні?",
+    "Ще потрібні колодки на задню вісь",
+]
+MANAGER_PHRASES = [
+    "Вітаю! Зараз підберу по VIN",
+    "Оригінал є, ціна 4 200 грн за пару, доставка з ЄС 3–5 робочих днів",
+    "Так, можна накладеним платежем Новою Поштою",
+    "Оформлюю замовлення, номер надішлю окремим повідомленням",
+    "Колодки Textar або ATE, обидва варіанти в наявності",
+]
+
+def make_dialog(rnd: random.Random) -> list[dict]:
+    start = datetime(2025, 7, 1) + timedelta(minutes=rnd.randint(0, 60 * 24 * 60))
+    messages = []
+    for i in range(rnd.randint(4, 40)):
+        sender = "client" if i % 2 == 0 else "manager"
+        text = rnd.choice(CLIENT_PHRASES if sender == "client" else MANAGER_PHRASES)
+        messages.append({
+            "sender_type": sender,
+            "message_text": text,
+            "timestamp": start + timedelta(seconds=30 * i + rnd.randint(0, 20)),
+        })
+    return messages
+
+def row_bytes(message: dict) -> int:
+    return ROW_OVERHEAD_BYTES + len(message["sender_type"]) + len(message["message_text"].encode("utf-8"))
+
+def bench(codec: str, dialogs: list[list[dict]]):
+    rows = sum(len(d) for d in dialogs)
+    raw_size = sum(row_bytes(m) for d in dialogs for m in d)
+
+    start = time.perf_counter()
+    blobs = [encode_dialog(d, codec) for d in dialogs]
+    encode_time = time.perf_counter() - start
+    archive_size = sum(len(b) + ARCHIVE_ROW_OVERHEAD_BYTES for b in blobs)
+
+    start = time.perf_counter()
+    for blob in blobs:
+        decode_dialog(blob, codec)
+    decode_time = time.perf_counter() - start
+
+    print(f"[{codec}] діалогів: {len(dialogs)}, повідомлень: {rows}")
+    print(f"  client_messages (оцінка): {raw_size / 1024:10.1f} КБ, {rows} рядків")
+    print(f"  dialog_archives:          {archive_size / 1024:10.1f} КБ, {len(dialogs)} рядків"
+          f" (x{raw_size / archive_size:.1f} менше)")
+    print(f"  стиснення: {encode_time / len(dialogs) * 1e6:8.1f} мкс/діалог")
+    print(f"  читання архіву: {decode_time / len(dialogs) * 1e6:8.1f} мкс/діалог"
+          f" замість отримання в середньому {rows / len(dialogs):.1f} рядків з БД")
+
+def main():
+    n = int(sys.argv[1]) if len(sys.argv) > 1 else 2000
+    rnd = random.Random(42)
+    dialogs = [make_dialog(rnd) for _ in range(n)]
+    bench("zlib", dialogs)
+    if zstandard is not None:
+        bench("zstd", dialogs)
+    else:
+        print("[zstd] пакет zstandard не встановлено, пропускаємо.")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,123 @@
+"""
+Мікробенчмарк вибору обробника текстового повідомлення.
+
+Порівнює попередню схему (ланцюжок MessageHandler з regex-фільтрами + if/elif у handle_message)
+з MessageRouter (пошук у словниках). Вимірюється лише вибір обробника, без мережі та БД.
+
+Запуск: python bench_dispatch.py [кількість_повідомлень]
+"""
+import re
+import sys
+import time
+import random
+
+from router import MessageRouter
+
+MANAGER_REGEX_BUTTONS = [
+    "📊 Запити клієнтів", "📝 Змінити баланс", "📤 Експорт замовлень", "🔍 Інфо по клієнту",
+    "💬 Активний діалог", "📨 Нові запити", "✅ Оформлені замовлення",
+    "📦 Оформити замовлення", "📂 Архів повідомлень", "📜 Замовлення клієнта", "❌ Завершити діалог",
+    "✏️ Змінити статус замовлення", "(🔄 Комплектування|🚚 З ЄС|📮 По Україні|✅ Виконано)", "🔙 Назад",
+]
+MANAGER_FLAGS = [
+    "manager_awaiting_order_id_for_status_change", "manager_awaiting_balance_client_id",
+    "manager_awaiting_balance_amount", "manager_awaiting_client_info_id",
+    "manager_awaiting_order_price", "manager_awaiting_order_description",
+]
+MANAGER_MENU_BUTTONS = [
+    "📊 Запити клієнтів", "📝 Змінити баланс", "📤 Експорт замовлень", "🔍 Інфо по клієнту",
+    "💬 Активний діалог", "📨 Нові запити", "✅ Оформлені замовлення",
+    "📦 Оформити замовлення", "📂 Архів повідомлень", "📜 Замовлення клієнта", "❌ Завершити діалог",
+    "✏️ Змінити статус замовлення", "🔙 Назад",
+]
+CLIENT_BUTTONS = [
+    "📦 Зробити запит/замовлення", "❌ Завершити діалог", "ℹ️ Інформація", "🎁 Мої бонуси",
+    "💰 Перевірити баланс", "⬆️ Ввести бонус-код", "📦 Доставка", "📞 Контакти", "👥 Про нас",
+    "🔍 Перевірити замовлення", "🎯 Акція", "🔙 Назад",
+]
+MANAGER_IDS = {1001, 1002, 1003}
+
+async def _noop(*args):
+    pass
+
+def old_dispatch(uid, text, user_data, regexes):
+    """Відтворює порядок перевірок попередньої версії: regex-обробники, потім гілки if/elif."""
+    is_manager = uid in MANAGER_IDS
+    for regex in regexes:
+        # PTB перевіряє regex і фільтр менеджера для кожного зареєстрованого обробника
+        if regex.search(text) and is_manager:
+            break
+    if is_manager:
+        for flag in MANAGER_FLAGS:
+            if user_data.get(flag):
+                return flag
+        state = user_data.get("manager_menu_state")
+        for button in MANAGER_MENU_BUTTONS:
+            if text == button and state is not None:
+                return button
+        return "unknown"
+    for button in CLIENT_BUTTONS:
+        if text == button:
+            return button
+        if button == "⬆️ Ввести бонус-код" and user_data.get("awaiting_bonus_code"):
+            return "bonus_code"
+    return "free_text"
+
+def build_router() -> MessageRouter:
+    router = MessageRouter()
+    for button in MANAGER_MENU_BUTTONS:
+        router.on_text("manager", button, _noop, states=["main", "requests_menu", "active_dialog"])
+    for flag in MANAGER_FLAGS:
+        router.on_state("manager", flag, _noop)
+    router.on_state("manager", "active_dialog", _noop)
+    router.set_default("manager", _noop)
+    for button in CLIENT_BUTTONS:
+        router.on_text("client", button, _noop)
+    router.on_state("client", "awaiting_bonus_code_input", _noop)
+    router.set_default("client", _noop)
+    return router
+
+def new_dispatch(router, uid, text, user_data):
+    if uid in MANAGER_IDS:
+        state = None
+        for flag in MANAGER_FLAGS:
+            if user_data.get(flag):
+                state = flag
+                break
+        return router.resolve("manager", state or user_data.get("manager_menu_state") or "main", text)
+    return router.resolve("client", user_data.get("client_menu_state") or "main", text)
+
+def make_workload(n: int):
+    rnd = random.Random(42)
+    texts = MANAGER_MENU_BUTTONS + CLIENT_BUTTONS + ["Добрий день, потрібні гальмівні диски на Golf 7", "12345"]
+    workload = []
+    for _ in range(n):
+        uid = rnd.choice([1001, 1002, 5001, 5002, 5003, 5004])
+        user_data = {"manager_menu_state": rnd.choice(["main", "requests_menu", "active_dialog"]),
+                     "client_menu_state": rnd.choice(["main", "info", "active_dialog"])}
+        workload.append((uid, rnd.choice(texts), user_data))
+    return workload
+
+def main():
+    n = int(sys.argv[1]) if len(sys.argv) > 1 else 200_000
+    workload = make_workload(n)
+    regexes = [re.compile(f"^{pattern}$") for pattern in MANAGER_REGEX_BUTTONS]
+    router = build_router()
+
+    start = time.perf_counter()
+    for uid, text, user_data in workload:
+        old_dispatch(uid, text, user_data, regexes)
+    old_time = time.perf_counter() - start
+
+    start = time.perf_counter()
+    for uid, text, user_data in workload:
+        new_dispatch(router, uid, text, user_data)
+    new_time = time.perf_counter() - start
+
+    print(f"Повідомлень: {n}")
+    print(f"regex + if/elif: {old_time / n * 1e9:8.0f} нс/повідомлення")
+    print(f"MessageRouter:   {new_time / n * 1e9:8.0f} нс/повідомлення")
+    print(f"Прискорення: x{old_time / new_time:.1f}")
+
+if __name__ == "__main__":
+    main()
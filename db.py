@@ -1,10 +1,21 @@
 import asyncpg
+import asyncio
+from collections import OrderedDict, deque
+import functools
+import socket
+import json
 import pandas as pd
+from dialog_archive import DIALOG_ARCHIVE_CODEC, encode_dialog, decode_dialog
+from db_resilience import (
+    CONNECTION, DB_BREAKER_FAILURES, DB_BREAKER_RESET_SECONDS, CircuitBreaker, ResilientPool, classify_error,
+    connection_failed, reset_connection_failed
+)
+from order_status import COMPLETED, UNKNOWN, ASSEMBLING, status_code, status_label, migration_case_sql
 import os
 from dotenv import load_dotenv
 import logging
-from typing import Dict, Any, Optional
-from datetime import datetime # Імпортуємо datetime для created_at
+from typing import Dict, Any, Optional, Callable
+from datetime import datetime, timezone # Імпортуємо datetime для created_at
 
 # 🛠️ Налаштування логування для db.py
 logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(name)s - %(levelname)s - %(message)s')
@@ -12,18 +23,54 @@ logger = logging.getLogger(__name__)
 
 load_dotenv()
 
-DB_HOST = "aws-0-eu-north-1.pooler.supabase.com"
-DB_NAME = "postgres"
-DB_USER = "postgres.frxhghhoqlfuatrfldvb"
+DB_HOST = os.getenv("DB_HOST", "aws-0-eu-north-1.pooler.supabase.com")
+DB_NAME = os.getenv("DB_NAME", "postgres")
+DB_USER = os.getenv("DB_USER", "postgres.frxhghhoqlfuatrfldvb")
 DB_PASSWORD = os.getenv("DB_PASSWORD")
-DB_PORT = 6543
+DB_PORT = int(os.getenv("DB_PORT", 6543))
+# Порт пулера в session mode: LISTEN не працює через transaction mode (6543)
+DB_SESSION_PORT = int(os.getenv("DB_SESSION_PORT", 5432))
 
-# Глобальна змінна для пулу з'єднань
+# Таймаути встановлення з'єднання та очікування вільного з'єднання в пулі: без них недоступна БД
+# тримає кожен запит до системного таймауту TCP
+DB_CONNECT_TIMEOUT = float(os.getenv("DB_CONNECT_TIMEOUT", 10))
+DB_ACQUIRE_TIMEOUT = float(os.getenv("DB_ACQUIRE_TIMEOUT", 10))
+
+# Глобальна змінна для пулу з'єднань (ResilientPool: повтори тимчасових помилок, облік запобіжником)
 _pool = None
+# Запобіжник БД: поки він відкритий, get_db_pool() повертає None і функції одразу йдуть резервним шляхом
+_breaker = CircuitBreaker(DB_BREAKER_FAILURES, DB_BREAKER_RESET_SECONDS)
+
+# --- ЛОКАЛЬНІ КЕШІ ТА МІЖПРОЦЕСНА ІНВАЛІДАЦІЯ (LISTEN/NOTIFY) ---
+# Кеші client_states і manager_active_dialogs увімкнені лише поки працює слухач каналу,
+# інакше інші воркери могли б змінити дані без нашого відома.
+INVALIDATION_CHANNEL = "cache_invalidation"
+NODE_ID = f"{socket.gethostname()}:{os.getpid()}"
+CACHE_MAX_ENTRIES = int(os.getenv("CACHE_MAX_ENTRIES", 50000))
+LISTENER_KEEPALIVE_SECONDS = 5
+
+_client_state_cache: Dict[int, Optional[Dict[str, Any]]] = {}
+_manager_dialog_cache: Dict[int, Optional[int]] = {}
+_cache_enabled = False
+_invalidation_seq = 0 # зростає при кожній інвалідації; захищає від запису застарілих даних у кеш
+_listener_conn = None
+_listener_task = None
+_invalidation_callbacks: list[Callable[[str, str], None]] = []
+
+# Стрічка змін статусів замовлень: тригер на order_status_events надсилає NOTIFY з подією після коміту.
+# Доставка "не більше одного разу" - пропущені під час розриву з'єднання події можна дочитати
+# через get_order_status_events_since за останнім отриманим event_id.
+ORDER_EVENTS_CHANNEL = "order_status_events"
+_order_event_callbacks: list[Callable[[Dict[str, Any]], None]] = []
 
 async def get_db_pool():
-    """Повертає існуючий пул з'єднань або ініціалізує його."""
+    """
+    Повертає існуючий пул з'єднань або ініціалізує його.
+    Поки запобіжник БД відкритий (БД недоступна), повертає None без спроби підключення.
+    """
     global _pool
+    if not _breaker.allow_request():
+        return None
     if _pool is None:
         await init_db_pool()
     return _pool
@@ -33,7 +80,7 @@ async def init_db_pool():
     global _pool
     if _pool is None:
         try:
-            _pool = await asyncpg.create_pool(
+            raw_pool = await asyncpg.create_pool(
                 host=DB_HOST,
                 database=DB_NAME,
                 user=DB_USER,
@@ -41,13 +88,571 @@ async def init_db_pool():
                 port=DB_PORT,
                 min_size=1,  # Мінімальна кількість з'єднань у пулі
                 max_size=10, # Максимальна кількість з'єднань у пулі
+                timeout=DB_CONNECT_TIMEOUT,
             )
+            _pool = ResilientPool(raw_pool, _breaker, DB_ACQUIRE_TIMEOUT)
+            _breaker.record_success()
             logger.info("Пул з'єднань БД успішно ініціалізовано.")
             await init_tables() # Викликаємо функцію для створення/оновлення таблиць після ініціалізації пулу
         except Exception as e:
             logger.error(f"Помилка ініціалізації пулу з'єднань БД: {e}")
+            _breaker.record_failure()
             _pool = None # Забезпечити, що пул не буде встановлений, якщо сталася помилка
 
+# --- РЕЖИМ ДЕГРАДАЦІЇ (БД НЕДОСТУПНА) ---
+# Поки запобіжник відкритий:
+#   - читання станів клієнтів, активних діалогів менеджерів і замовлень клієнта повертають останні відомі
+#     значення (_last_known), а не "порожньо", яке бот сприйняв би як "немає даних";
+#   - записи, позначені _deferrable, ставляться в чергу й виконуються по порядку, щойно БД знову доступна.
+#     Поки черга не порожня, нові записи теж стають у чергу, щоб старі не перезаписали новіші.
+# Черга лише в пам'яті процесу: якщо процес зупиниться до відновлення БД, її записи втрачаються.
+DEGRADED_READ_CACHE_SIZE = int(os.getenv("DEGRADED_READ_CACHE_SIZE", 20000))
+DEFERRED_WRITES_MAX = int(os.getenv("DEFERRED_WRITES_MAX", 5000))
+# Пауза перед повтором відкладеного запису, який не вдався через помилку з'єднання (запобіжник ще закритий)
+DEFERRED_REPLAY_RETRY_DELAY = 1.0
+
+_last_known: "OrderedDict[tuple[str, Any], Any]" = OrderedDict()
+_deferred_writes: deque = deque() # (функція, args, kwargs)
+_deferred_dropped = 0
+_degraded_reads = 0
+_replay_task: Optional[asyncio.Task] = None
+
+def _remember(kind: str, key, value):
+    """Запам'ятовує останнє прочитане з БД значення для режиму деградації."""
+    _last_known[(kind, key)] = value
+    _last_known.move_to_end((kind, key))
+    if len(_last_known) > DEGRADED_READ_CACHE_SIZE:
+        _last_known.popitem(last=False)
+
+def _recall(kind: str, key) -> tuple[bool, Any]:
+    """Повертає (знайдено, значення) з останніх відомих значень."""
+    global _degraded_reads
+    if (kind, key) not in _last_known:
+        return False, None
+    _degraded_reads += 1
+    return True, _last_known[(kind, key)]
+
+def is_db_degraded() -> bool:
+    """Чи працює бот зараз без БД (запобіжник відкритий або є невиконані відкладені записи)."""
+    return _breaker.is_open or bool(_deferred_writes)
+
+def get_db_health() -> Dict[str, Any]:
+    """Стан запобіжника БД і режиму деградації (для метрик)."""
+    return {
+        "state": _breaker.state,
+        "failures": _breaker.failures,
+        "times_opened": _breaker.times_opened,
+        "deferred_writes": len(_deferred_writes),
+        "dropped_writes": _deferred_dropped,
+        "degraded_reads": _degraded_reads,
+    }
+
+def _deferrable(patch: Optional[Callable[..., None]] = None):
+    """
+    Записи, які під час недоступності БД ставляться в чергу замість втрати.
+    Виклик ставиться в чергу, якщо запобіжник відкритий, черга не порожня або сам запис не вдався через
+    помилку з'єднання (зокрема перші помилки, поки запобіжник ще закритий).
+    Позначена функція повертає True, якщо запис виконано або прийнято в чергу (буде виконано, щойно БД
+    доступна), і False, якщо запис втрачено: БД його відхилила або черга заповнена (помилку вже залоговано).
+    patch(*args, **kwargs) оновлює останні відомі значення, щоб читання в режиму деградації бачили запис.
+    """
+    def decorator(fn):
+        @functools.wraps(fn)
+        async def wrapper(*args, **kwargs):
+            global _deferred_dropped
+            if not _breaker.is_open and not _deferred_writes:
+                reset_connection_failed()
+                try:
+                    written = await fn(*args, **kwargs)
+                except Exception as e:
+                    # Помилка отримання з'єднання виникає поза try самої функції
+                    if classify_error(e) != CONNECTION:
+                        raise
+                    logger.error(f"Помилка з'єднання з БД при {fn.__name__}{args}: {e}")
+                    written = False
+                if written or not (connection_failed() or _breaker.is_open):
+                    return written
+            if len(_deferred_writes) >= DEFERRED_WRITES_MAX:
+                _deferred_dropped += 1
+                logger.error(f"Черга відкладених записів заповнена ({DEFERRED_WRITES_MAX}), {fn.__name__}{args} втрачено.")
+                return False
+            _deferred_writes.append((fn, args, kwargs))
+            if patch is not None:
+                patch(*args, **kwargs)
+            logger.warning(f"БД недоступна: {fn.__name__}{args} відкладено ({len(_deferred_writes)} у черзі).")
+            if not _breaker.is_open:
+                _start_deferred_replay()
+            return True
+        return wrapper
+    return decorator
+
+def _start_deferred_replay():
+    global _replay_task
+    if _deferred_writes and (_replay_task is None or _replay_task.done()):
+        _replay_task = asyncio.get_running_loop().create_task(_replay_deferred_writes())
+
+async def _replay_deferred_writes():
+    """
+    Виконує відкладені записи по порядку. Запис прибирається з черги лише після підтвердженого успіху
+    або помилки самого запиту (дані, які БД відхиляє, повтор не виправить). Якщо БД знову недоступна,
+    запис залишається першим у черзі: до закриття запобіжника або до наступної спроби через паузу.
+    """
+    global _deferred_dropped
+    replayed = 0
+    while _deferred_writes and not _breaker.is_open:
+        fn, args, kwargs = _deferred_writes[0]
+        reset_connection_failed()
+        try:
+            written = await fn(*args, **kwargs)
+        except Exception as e:
+            logger.error(f"Помилка при виконанні відкладеного запису {fn.__name__}{args}: {e}")
+            written = False
+        if not written and (connection_failed() or _breaker.is_open):
+            # Запис не вдався через помилку з'єднання: не втрачаємо його
+            if _breaker.is_open:
+                break
+            await asyncio.sleep(DEFERRED_REPLAY_RETRY_DELAY)
+            continue
+        _deferred_writes.popleft()
+        if written:
+            replayed += 1
+        else:
+            _deferred_dropped += 1
+            logger.error(f"Відкладений запис {fn.__name__}{args} відхилено БД і втрачено.")
+    logger.info(f"Виконано {replayed} відкладених записів, у черзі залишилось {len(_deferred_writes)}.")
+
+_breaker.on_close(_start_deferred_replay)
+
+def _patch_client_state(client_id: int, **fields):
+    """Застосовує відкладений запис до останнього відомого стану клієнта."""
+    _evict_local("client_states", str(client_id))
+    state = _last_known.get(("client_state", client_id))
+    if state is not None:
+        _remember("client_state", client_id, {**state, **fields})
+
+def _defer_add_client_state(client_id: int, is_active: bool = False, is_notified: bool = False,
+                            current_manager_id: Optional[int] = None):
+    _evict_local("client_states", str(client_id))
+    _remember("client_state", client_id, {
+        "is_active": is_active, "is_notified": is_notified,
+        "current_manager_id": current_manager_id, "last_activity": datetime.now(timezone.utc),
+    })
+
+def _defer_client_active(client_id: int, is_active: bool):
+    _patch_client_state(client_id, is_active=is_active, last_activity=datetime.now(timezone.utc))
+
+def _defer_client_notified(client_id: int, is_notified: bool):
+    _patch_client_state(client_id, is_notified=is_notified)
+
+def _defer_client_manager(client_id: int, manager_id: Optional[int]):
+    _patch_client_state(client_id, current_manager_id=manager_id)
+
+def _defer_manager_dialog(manager_id: int, client_id: Optional[int]):
+    _evict_local("manager_active_dialogs", str(manager_id))
+    _remember("manager_dialog", manager_id, client_id)
+
+def _cache_put(cache: Dict, key, value, seq: int):
+    """Кладе значення в кеш, якщо за час запиту до БД не було жодної інвалідації."""
+    if not _cache_enabled or seq != _invalidation_seq:
+        return
+    if len(cache) >= CACHE_MAX_ENTRIES:
+        cache.clear()
+    cache[key] = value
+
+def _evict_local(table: str, key: str):
+    """Видаляє запис з локальних кешів цього процесу."""
+    global _invalidation_seq
+    _invalidation_seq += 1
+    if table == "client_states":
+        _client_state_cache.pop(int(key), None)
+    elif table == "manager_active_dialogs":
+        _manager_dialog_cache.pop(int(key), None)
+
+def _run_invalidation_callbacks(table: str, key: str):
+    for callback in _invalidation_callbacks:
+        try:
+            callback(table, key)
+        except Exception as e:
+            logger.error(f"Помилка в колбеку інвалідації для {table}:{key}: {e}")
+
+def _clear_caches():
+    global _invalidation_seq
+    _invalidation_seq += 1
+    _client_state_cache.clear()
+    _manager_dialog_cache.clear()
+    _run_invalidation_callbacks("*", "*")
+
+async def _notify_invalidation(conn, table: str, *keys):
+    """Інвалідовує записи локально та надсилає NOTIFY іншим процесам (доставляється після коміту)."""
+    for key in keys:
+        _evict_local(table, str(key))
+    await conn.execute(
+        "SELECT pg_notify($1, $2 || '|' || $3 || '|' || k) FROM unnest($4::text[]) AS k",
+        INVALIDATION_CHANNEL, NODE_ID, table, [str(k) for k in keys]
+    )
+
+def add_invalidation_callback(callback: Callable[[str, str], None]):
+    """
+    Реєструє колбек callback(table, key), який викликається, коли інший процес змінив запис.
+    table == "*" означає, що сповіщення могли бути втрачені і треба скинути всі кеші.
+    """
+    _invalidation_callbacks.append(callback)
+
+def _on_invalidation_notify(connection, pid, channel, payload):
+    try:
+        sender, table, key = payload.split("|", 2)
+    except ValueError:
+        logger.warning(f"Некоректне повідомлення інвалідації: '{payload}'")
+        return
+    if sender == NODE_ID:
+        return
+    _evict_local(table, key)
+    _run_invalidation_callbacks(table, key)
+
+def add_order_status_callback(callback: Callable[[Dict[str, Any]], None]):
+    """
+    Реєструє колбек callback(event) для кожної зміни статусу замовлення (у будь-якому процесі).
+    event має ключі event_id, order_id, status, previous_status (тексти), status_code, changed_by, changed_at.
+    """
+    _order_event_callbacks.append(callback)
+
+def _order_event_row(record) -> Dict[str, Any]:
+    """Подія order_status_events як dict з текстовими статусами."""
+    event = dict(record)
+    event["status_code"] = event["status"]
+    event["status"] = status_label(event["status"])
+    if event.get("previous_status") is not None:
+        event["previous_status"] = status_label(event["previous_status"])
+    return event
+
+def _on_order_event_notify(connection, pid, channel, payload):
+    try:
+        event = json.loads(payload)
+        event["changed_at"] = datetime.fromisoformat(event["changed_at"])
+        event = _order_event_row(event)
+    except (ValueError, KeyError) as e:
+        logger.warning(f"Некоректна подія зміни статусу '{payload}': {e}")
+        return
+    for callback in _order_event_callbacks:
+        try:
+            callback(event)
+        except Exception as e:
+            logger.error(f"Помилка в колбеку зміни статусу замовлення {event['order_id']}: {e}")
+
+async def _listener_loop():
+    """Тримає окреме з'єднання з LISTEN і перепідключається при його втраті."""
+    global _listener_conn, _cache_enabled
+    backoff = 1
+    while True:
+        try:
+            _listener_conn = await asyncpg.connect(
+                host=DB_HOST,
+                database=DB_NAME,
+                user=DB_USER,
+                password=DB_PASSWORD,
+                port=DB_SESSION_PORT,
+            )
+            await _listener_conn.add_listener(INVALIDATION_CHANNEL, _on_invalidation_notify)
+            await _listener_conn.add_listener(ORDER_EVENTS_CHANNEL, _on_order_event_notify)
+            # Поки слухача не було, ми могли пропустити зміни — починаємо з чистих кешів
+            _clear_caches()
+            _cache_enabled = True
+            backoff = 1
+            logger.info(f"Слухач інвалідації кешу підключено (вузол {NODE_ID}).")
+            while True:
+                await asyncio.sleep(LISTENER_KEEPALIVE_SECONDS)
+                await _listener_conn.fetchval("SELECT 1")
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            logger.error(f"Слухач інвалідації кешу втратив з'єднання: {e}. Повтор через {backoff} с.")
+        finally:
+            _cache_enabled = False
+            _clear_caches()
+            if _listener_conn is not None and not _listener_conn.is_closed():
+                try:
+                    await _listener_conn.close()
+                except Exception:
+                    pass
+            _listener_conn = None
+        await asyncio.sleep(backoff)
+        backoff = min(backoff * 2, 30)
+
+async def start_cache_listener():
+    """Запускає фоновий слухач каналу інвалідації кешів."""
+    global _listener_task
+    if _listener_task is None:
+        _listener_task = asyncio.create_task(_listener_loop())
+
+async def stop_cache_listener():
+    """Зупиняє слухач інвалідації та вимикає локальні кеші."""
+    global _listener_task
+    if _listener_task is not None:
+        _listener_task.cancel()
+        try:
+            await _listener_task
+        except asyncio.CancelledError:
+            pass
+        _listener_task = None
+        logger.info("Слухач інвалідації кешу зупинено.")
+
+# --- ЛІДЕРСТВО (ADVISORY LOCK) ---
+# Сесійний advisory lock тримається на окремому з'єднанні: якщо процес-лідер помирає,
+# Postgres закриває його сесію і блокування автоматично звільняється.
+LEADER_LOCK_KEY = int(os.getenv("LEADER_LOCK_KEY", 6910690))
+
+_leader_conn = None
+
+async def hold_leader_lock() -> bool:
+    """
+    Повертає True, якщо цей процес утримує блокування лідера.
+    Якщо блокування ще не взяте, пробує взяти його (без очікування).
+    """
+    global _leader_conn
+    try:
+        if _leader_conn is not None and not _leader_conn.is_closed():
+            # Блокування вже наше — перевіряємо, що сесія жива
+            await _leader_conn.fetchval("SELECT 1")
+            return True
+        _leader_conn = await asyncpg.connect(
+            host=DB_HOST,
+            database=DB_NAME,
+            user=DB_USER,
+            password=DB_PASSWORD,
+            port=DB_SESSION_PORT,
+        )
+        acquired = await _leader_conn.fetchval("SELECT pg_try_advisory_lock($1)", LEADER_LOCK_KEY)
+        if not acquired:
+            await _leader_conn.close()
+            _leader_conn = None
+        return bool(acquired)
+    except Exception as e:
+        logger.error(f"Помилка при перевірці блокування лідера: {e}")
+        if _leader_conn is not None and not _leader_conn.is_closed():
+            try:
+                await _leader_conn.close()
+            except Exception:
+                pass
+        _leader_conn = None
+        return False
+
+async def release_leader_lock():
+    """Звільняє блокування лідера (при зупинці процесу)."""
+    global _leader_conn
+    if _leader_conn is None:
+        return
+    try:
+        if not _leader_conn.is_closed():
+            await _leader_conn.execute("SELECT pg_advisory_unlock($1)", LEADER_LOCK_KEY)
+            await _leader_conn.close()
+        logger.info("Блокування лідера звільнено.")
+    except Exception as e:
+        logger.error(f"Помилка при звільненні блокування лідера: {e}")
+    finally:
+        _leader_conn = None
+
+# --- СЕКЦІОНУВАННЯ client_messages ---
+# client_messages секціонована по місяцях за колонкою timestamp (client_messages_YYYY_MM).
+# Завдання maintain_client_messages_partitions наперед створює секції на найближчі місяці
+# і прибирає секції, старші за термін зберігання. Секція DEFAULT приймає рядки поза створеними діапазонами.
+CLIENT_MESSAGES_PARTITIONS_AHEAD = 2
+
+def _month_start(value: datetime, shift: int = 0) -> datetime:
+    month_index = value.year * 12 + value.month - 1 + shift
+    return datetime(month_index // 12, month_index % 12 + 1, 1)
+
+def _partition_name(month: datetime) -> str:
+    return f"client_messages_{month.year:04d}_{month.month:02d}"
+
+async def _create_client_messages_partition(conn, month: datetime):
+    await conn.execute(f"""
+        CREATE TABLE IF NOT EXISTS {_partition_name(month)} PARTITION OF client_messages
+        FOR VALUES FROM ('{month:%Y-%m-%d}') TO ('{_month_start(month, 1):%Y-%m-%d}');
+    """)
+
+async def _init_client_messages(conn):
+    """
+    Створює секціоновану таблицю client_messages. Якщо існує стара несекціонована таблиця,
+    переносить її дані в нову (разово, в межах транзакції init_tables).
+    """
+    legacy_exists = await conn.fetchval("""
+        SELECT EXISTS (
+            SELECT 1 FROM pg_class c JOIN pg_namespace n ON n.oid = c.relnamespace
+            WHERE n.nspname = current_schema() AND c.relname = 'client_messages' AND c.relkind = 'r'
+        )
+    """)
+    if legacy_exists:
+        await conn.execute("ALTER TABLE client_messages RENAME TO client_messages_legacy;")
+
+    await conn.execute("""
+        CREATE TABLE IF NOT EXISTS client_messages (
+            message_id BIGSERIAL,
+            client_id BIGINT NOT NULL,
+            sender_type TEXT NOT NULL,
+            message_text TEXT NOT NULL, -- для медіа - підпис (або порожній рядок)
+            timestamp TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP,
+            media_type TEXT NULL, -- photo / document / voice
+            file_id TEXT NULL, -- file_id Telegram: медіа пересилається і зберігається без завантаження файлу
+            PRIMARY KEY (message_id, timestamp),
+            FOREIGN KEY (client_id) REFERENCES client_states(client_id) ON DELETE CASCADE
+        ) PARTITION BY RANGE (timestamp);
+    """)
+    await conn.execute("""
+        ALTER TABLE client_messages
+            ADD COLUMN IF NOT EXISTS media_type TEXT NULL,
+            ADD COLUMN IF NOT EXISTS file_id TEXT NULL;
+    """)
+    await conn.execute("CREATE TABLE IF NOT EXISTS client_messages_default PARTITION OF client_messages DEFAULT;")
+    await conn.execute("""
+        CREATE INDEX IF NOT EXISTS idx_client_messages_client_ts ON client_messages (client_id, timestamp);
+    """)
+    # Стиснені архіви завершених діалогів (див. dialog_archive.py та archive_closed_dialogs)
+    await conn.execute("""
+        CREATE TABLE IF NOT EXISTS dialog_archives (
+            archive_id BIGSERIAL PRIMARY KEY,
+            client_id BIGINT NOT NULL REFERENCES client_states(client_id) ON DELETE CASCADE,
+            first_ts TIMESTAMP NOT NULL,
+            last_ts TIMESTAMP NOT NULL,
+            message_count INTEGER NOT NULL,
+            codec TEXT NOT NULL,
+            payload BYTEA NOT NULL,
+            created_at TIMESTAMP WITH TIME ZONE DEFAULT NOW()
+        );
+    """)
+    await conn.execute("""
+        CREATE INDEX IF NOT EXISTS idx_dialog_archives_client ON dialog_archives (client_id, first_ts);
+    """)
+
+    now = datetime.now()
+    first_month = _month_start(now)
+    if legacy_exists:
+        oldest = await conn.fetchval("SELECT MIN(timestamp) FROM client_messages_legacy")
+        if oldest is not None:
+            first_month = min(first_month, _month_start(oldest))
+    month = first_month
+    while month <= _month_start(now, CLIENT_MESSAGES_PARTITIONS_AHEAD):
+        await _create_client_messages_partition(conn, month)
+        month = _month_start(month, 1)
+
+    if legacy_exists:
+        moved = await conn.execute("""
+            INSERT INTO client_messages (message_id, client_id, sender_type, message_text, timestamp)
+            SELECT message_id, client_id, sender_type, message_text, COALESCE(timestamp, CURRENT_TIMESTAMP)
+            FROM client_messages_legacy;
+        """)
+        await conn.execute("""
+            SELECT setval(pg_get_serial_sequence('client_messages', 'message_id'),
+                          COALESCE((SELECT MAX(message_id) FROM client_messages), 0) + 1, false);
+        """)
+        await conn.execute("DROP TABLE client_messages_legacy;")
+        logger.info(f"client_messages перенесено в секціоновану таблицю ({moved.split()[-1]} рядків).")
+
+async def maintain_client_messages_partitions(retention_months: int, drop: bool = True) -> list[str]:
+    """
+    Створює секції client_messages на найближчі місяці та прибирає секції, повністю старші
+    за retention_months місяців. drop=True видаляє їх, drop=False лише від'єднує
+    (таблиця client_messages_YYYY_MM лишається як архів поза основною таблицею).
+    Повертає назви прибраних секцій.
+    """
+    pool = await get_db_pool()
+    if pool is None:
+        logger.warning("Пул з'єднань БД не ініціалізовано. Неможливо обслужити секції client_messages.")
+        return []
+    removed = []
+    async with pool.acquire() as conn:
+        try:
+            now = datetime.now()
+            for shift in range(CLIENT_MESSAGES_PARTITIONS_AHEAD + 1):
+                await _create_client_messages_partition(conn, _month_start(now, shift))
+
+            cutoff = _month_start(now, -retention_months)
+            partitions = await conn.fetch("""
+                SELECT c.relname FROM pg_inherits i
+                JOIN pg_class c ON c.oid = i.inhrelid
+                JOIN pg_class p ON p.oid = i.inhparent
+                WHERE p.relname = 'client_messages' AND c.relname ~ '^client_messages_[0-9]{4}_[0-9]{2}$'
+            """)
+            for record in partitions:
+                name = record["relname"]
+                year, month = int(name[-7:-3]), int(name[-2:])
+                if _month_start(datetime(year, month, 1), 1) > cutoff:
+                    continue
+                async with conn.transaction():
+                    await conn.execute(f"ALTER TABLE client_messages DETACH PARTITION {name};")
+                    if drop:
+                        await conn.execute(f"DROP TABLE {name};")
+                removed.append(name)
+            # Архіви діалогів підпадають під той самий термін зберігання
+            await conn.execute("DELETE FROM dialog_archives WHERE last_ts < $1", cutoff)
+            if removed:
+                action = "видалено" if drop else "від'єднано"
+                logger.info(f"Секції client_messages {action}: {', '.join(removed)}.")
+        except Exception as e:
+            logger.error(f"Помилка при обслуговуванні секцій client_messages: {e}")
+    return removed
+
+async def _migrate_order_status(conn, table: str):
+    """Перетворює колонку status таблиці table з тексту (емодзі-підписи) на SMALLINT-коди, якщо це ще не зроблено."""
+    data_type = await conn.fetchval("""
+        SELECT data_type FROM information_schema.columns
+        WHERE table_schema = current_schema() AND table_name = $1 AND column_name = 'status'
+    """, table)
+    if data_type != "text":
+        return
+    unknown = await conn.fetchval(f"SELECT COUNT(*) FROM {table} WHERE {migration_case_sql('status')} = {UNKNOWN}")
+    if unknown:
+        logger.warning(f"{table}: {unknown} замовлень мають невідомий текстовий статус, їм присвоєно код {UNKNOWN}.")
+    # Частковий індекс зі старою текстовою умовою не переживе зміну типу колонки
+    await conn.execute(f"DROP INDEX IF EXISTS idx_{table}_active;")
+    await conn.execute(f"""
+        ALTER TABLE {table}
+            ALTER COLUMN status TYPE SMALLINT USING {migration_case_sql('status')},
+            ALTER COLUMN status SET DEFAULT {ASSEMBLING},
+            ALTER COLUMN status SET NOT NULL;
+    """)
+    logger.info(f"{table}: статуси замовлень перенесено в коди.")
+
+async def _init_orders_updated_at(conn):
+    """
+    Колонка orders.updated_at для інкрементального експорту: тригер оновлює її при будь-якій зміні рядка.
+    Для існуючих замовлень разово заповнюється значенням created_at.
+    """
+    exists = await conn.fetchval("""
+        SELECT EXISTS (
+            SELECT 1 FROM information_schema.columns
+            WHERE table_schema = current_schema() AND table_name = 'orders' AND column_name = 'updated_at'
+        )
+    """)
+    if not exists:
+        await conn.execute("""
+            ALTER TABLE orders ADD COLUMN updated_at TIMESTAMP WITH TIME ZONE NULL;
+            UPDATE orders SET updated_at = COALESCE(created_at, NOW());
+            ALTER TABLE orders
+                ALTER COLUMN updated_at SET DEFAULT NOW(),
+                ALTER COLUMN updated_at SET NOT NULL;
+        """)
+        logger.info("orders: додано колонку updated_at.")
+    await conn.execute("""
+        CREATE OR REPLACE FUNCTION orders_touch_updated_at() RETURNS trigger AS $$
+        BEGIN
+            NEW.updated_at := NOW();
+            RETURN NEW;
+        END;
+        $$ LANGUAGE plpgsql;
+        DROP TRIGGER IF EXISTS orders_touch_updated_at ON orders;
+        CREATE TRIGGER orders_touch_updated_at BEFORE UPDATE ON orders
+            FOR EACH ROW WHEN (OLD.* IS DISTINCT FROM NEW.*) EXECUTE FUNCTION orders_touch_updated_at();
+        CREATE INDEX IF NOT EXISTS idx_orders_updated_at ON orders (updated_at);
+    """)
+
+def _order_row(record) -> Dict[str, Any]:
+    """Рядок замовлення як dict: status - текст для відображення, status_code - код з БД."""
+    row = dict(record)
+    if "status" in row:
+        row["status_code"] = row["status"]
+        row["status"] = status_label(row["status"])
+    return row
+
 async def init_tables():
     """Створює/оновлює таблиці, якщо вони не існують, використовуючи asyncpg."""
     if _pool is None:
@@ -63,10 +668,11 @@ async def init_tables():
                     CREATE TABLE IF NOT EXISTS orders (
                         order_id TEXT PRIMARY KEY,
                         client_id BIGINT,
-                        status TEXT,
+                        status SMALLINT NOT NULL DEFAULT 1, -- код з order_status.py
                         price NUMERIC(10, 2) NULL,
                         description TEXT NULL,
-                        created_at TIMESTAMP WITH TIME ZONE DEFAULT NOW()
+                        created_at TIMESTAMP WITH TIME ZONE DEFAULT NOW(),
+                        updated_at TIMESTAMP WITH TIME ZONE NOT NULL DEFAULT NOW() -- див. _init_orders_updated_at
                     );
                 """)
                 
@@ -79,6 +685,15 @@ async def init_tables():
                     END $$;
                 """)
 
+                # Останні експортовані зміни замовлень для кожного менеджера (див. export_order_changes_to_excel)
+                await conn.execute("""
+                    CREATE TABLE IF NOT EXISTS export_watermarks (
+                        manager_id BIGINT PRIMARY KEY,
+                        exported_until TIMESTAMP WITH TIME ZONE NOT NULL,
+                        updated_at TIMESTAMP WITH TIME ZONE DEFAULT NOW()
+                    );
+                """)
+
                 # Таблиця client_states
                 await conn.execute("""
                     CREATE TABLE IF NOT EXISTS client_states (
@@ -89,17 +704,8 @@ async def init_tables():
                         last_activity TIMESTAMP WITH TIME ZONE DEFAULT NOW()
                     );
                 """)
-                # Таблиця client_messages
-                await conn.execute("""
-                    CREATE TABLE IF NOT EXISTS client_messages (
-                        message_id SERIAL PRIMARY KEY,
-                        client_id BIGINT NOT NULL,
-                        sender_type TEXT NOT NULL,
-                        message_text TEXT NOT NULL,
-                        timestamp TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-                        FOREIGN KEY (client_id) REFERENCES client_states(client_id) ON DELETE CASCADE
-                    );
-                """)
+                # Таблиця client_messages, секціонована по місяцях (див. _init_client_messages)
+                await _init_client_messages(conn)
                 # Таблиця manager_active_dialogs
                 await conn.execute("""
                     CREATE TABLE IF NOT EXISTS manager_active_dialogs (
@@ -127,33 +733,185 @@ async def init_tables():
                         ALTER TABLE bonus_codes ADD COLUMN IF NOT EXISTS activated_by_tg_user_id BIGINT;
                     END $$;
                 """)
+
+                # Таблиця bot_user_data (збережений context.user_data для persistence.py)
+                await conn.execute("""
+                    CREATE TABLE IF NOT EXISTS bot_user_data (
+                        user_id BIGINT PRIMARY KEY,
+                        data JSONB NOT NULL,
+                        updated_at TIMESTAMP WITH TIME ZONE DEFAULT NOW()
+                    );
+                """)
+
+                # Таблиця managers (реєстр менеджерів: онлайн-статус та ліміт одночасних діалогів)
+                await conn.execute("""
+                    CREATE TABLE IF NOT EXISTS managers (
+                        manager_id BIGINT PRIMARY KEY,
+                        is_online BOOLEAN DEFAULT TRUE NOT NULL,
+                        max_dialogs INTEGER DEFAULT 1 NOT NULL,
+                        updated_at TIMESTAMP WITH TIME ZONE DEFAULT NOW()
+                    );
+                """)
+                # Індекс для підрахунку навантаження менеджерів
+                await conn.execute("""
+                    CREATE INDEX IF NOT EXISTS idx_client_states_active_manager
+                    ON client_states (current_manager_id) WHERE is_active;
+                """)
+
+                # Таблиця forwarded_messages: яке повідомлення в чаті менеджера відповідає якому клієнту
+                await conn.execute("""
+                    CREATE TABLE IF NOT EXISTS forwarded_messages (
+                        manager_id BIGINT NOT NULL,
+                        message_id BIGINT NOT NULL,
+                        client_id BIGINT NOT NULL,
+                        created_at TIMESTAMP WITH TIME ZONE DEFAULT NOW(),
+                        PRIMARY KEY (manager_id, message_id)
+                    );
+                """)
+                await conn.execute("""
+                    CREATE INDEX IF NOT EXISTS idx_forwarded_messages_created_at
+                    ON forwarded_messages (created_at);
+                """)
+
+                # Таблиця processed_updates: update_id, які вже оброблено (захист від повторної доставки вебхука)
+                await conn.execute("""
+                    CREATE TABLE IF NOT EXISTS processed_updates (
+                        update_id BIGINT PRIMARY KEY,
+                        processed_at TIMESTAMP WITH TIME ZONE DEFAULT NOW()
+                    );
+                """)
+                await conn.execute("""
+                    CREATE INDEX IF NOT EXISTS idx_processed_updates_processed_at
+                    ON processed_updates (processed_at);
+                """)
+                # Наступний offset getUpdates для режиму polling (див. polling.py)
+                await conn.execute("""
+                    CREATE TABLE IF NOT EXISTS polling_offsets (
+                        bot_id BIGINT PRIMARY KEY,
+                        next_offset BIGINT NOT NULL,
+                        updated_at TIMESTAMP WITH TIME ZONE DEFAULT NOW()
+                    );
+                """)
+
+                # Архів давно виконаних замовлень (переносяться фоновим завданням archive_completed_orders)
+                await conn.execute("""
+                    CREATE TABLE IF NOT EXISTS orders_archive (
+                        order_id TEXT PRIMARY KEY,
+                        client_id BIGINT,
+                        status SMALLINT NOT NULL DEFAULT 1,
+                        price NUMERIC(10, 2) NULL,
+                        description TEXT NULL,
+                        created_at TIMESTAMP WITH TIME ZONE,
+                        archived_at TIMESTAMP WITH TIME ZONE DEFAULT NOW()
+                    );
+                """)
+                await conn.execute("""
+                    CREATE INDEX IF NOT EXISTS idx_orders_archive_client_id
+                    ON orders_archive (client_id, created_at DESC);
+                """)
+                # Одноразова міграція текстових статусів у коди
+                await _migrate_order_status(conn, "orders")
+                await _migrate_order_status(conn, "orders_archive")
+                await _init_orders_updated_at(conn)
+
+                # Історія статусів замовлень (лише додавання). Пишеться в тій самій транзакції, що й зміна
+                # статусу в orders, тому історія завжди узгоджена з поточним статусом.
+                await conn.execute("""
+                    CREATE TABLE IF NOT EXISTS order_status_events (
+                        event_id BIGSERIAL PRIMARY KEY,
+                        order_id TEXT NOT NULL,
+                        status SMALLINT NOT NULL,
+                        previous_status SMALLINT NULL,
+                        changed_by BIGINT NULL,
+                        changed_at TIMESTAMP WITH TIME ZONE NOT NULL DEFAULT NOW()
+                    );
+                    CREATE INDEX IF NOT EXISTS idx_order_status_events_order
+                        ON order_status_events (order_id, changed_at, event_id);
+                    CREATE INDEX IF NOT EXISTS idx_order_status_events_changed_at
+                        ON order_status_events (changed_at);
+                """)
+                await conn.execute(f"""
+                    CREATE OR REPLACE FUNCTION notify_order_status_event() RETURNS trigger AS $$
+                    BEGIN
+                        PERFORM pg_notify('{ORDER_EVENTS_CHANNEL}', json_build_object(
+                            'event_id', NEW.event_id,
+                            'order_id', NEW.order_id,
+                            'status', NEW.status,
+                            'previous_status', NEW.previous_status,
+                            'changed_by', NEW.changed_by,
+                            'changed_at', NEW.changed_at
+                        )::text);
+                        RETURN NULL;
+                    END;
+                    $$ LANGUAGE plpgsql;
+                    DROP TRIGGER IF EXISTS order_status_events_notify ON order_status_events;
+                    CREATE TRIGGER order_status_events_notify AFTER INSERT ON order_status_events
+                        FOR EACH ROW EXECUTE FUNCTION notify_order_status_event();
+                """)
+                # Замовлення, створені до появи історії, отримують початкову подію з поточним статусом
+                backfilled = await conn.execute("""
+                    INSERT INTO order_status_events (order_id, status, changed_at)
+                    SELECT o.order_id, o.status, o.created_at FROM orders o
+                    WHERE NOT EXISTS (SELECT 1 FROM order_status_events e WHERE e.order_id = o.order_id)
+                """)
+                if backfilled != "INSERT 0 0":
+                    logger.info(f"order_status_events: додано початкові події для існуючих замовлень ({backfilled}).")
+                # Індекси для вибірок замовлень за клієнтом, статусом та активних замовлень.
+                # idx_orders_active містить лише невиконані замовлення у потрібному порядку, тому список активних
+                # не переглядає виконані замовлення. description (довільний текст менеджера) в індекс не входить:
+                # довгий опис перевищив би межу розміру рядка btree, і INSERT замовлення завершився б помилкою.
+                # Попередня версія індексу з description перебудовується.
+                old_active_index = await conn.fetchval(
+                    "SELECT indexdef FROM pg_indexes WHERE schemaname = current_schema() AND indexname = 'idx_orders_active'"
+                )
+                if old_active_index and "description" in old_active_index:
+                    await conn.execute("DROP INDEX idx_orders_active")
+                    logger.info("idx_orders_active: видалено стару версію індексу з description.")
+                await conn.execute(f"""
+                    CREATE INDEX IF NOT EXISTS idx_orders_client_id ON orders (client_id, created_at DESC);
+                    CREATE INDEX IF NOT EXISTS idx_orders_status ON orders (status, created_at);
+                    CREATE INDEX IF NOT EXISTS idx_orders_active ON orders (created_at DESC)
+                        INCLUDE (order_id, client_id, status, price)
+                        WHERE status <> {COMPLETED};
+                """)
+                await _init_order_daily_stats(conn)
+                await _init_support_dialogs(conn)
+                await _init_search_indexes(conn)
                 logger.info("Таблиці успішно ініціалізовані/перевірені.")
         except Exception as e:
             logger.error(f"Помилка при створенні/перевірці таблиць БД: {e}")
 
-async def add_order(order_id: str, client_id: int, status: str, price: Optional[float] = None, description: Optional[str] = None):
-    """Додає нове замовлення до таблиці 'orders' за допомогою asyncpg."""
+@_deferrable()
+async def add_order(order_id: str, client_id: int, status: str, price: Optional[float] = None, description: Optional[str] = None,
+                    changed_by: Optional[int] = None):
+    """Додає нове замовлення до таблиці 'orders' за допомогою asyncpg (разом з початковою подією історії статусів)."""
     pool = await get_db_pool()
     if pool is None:
         logger.warning("Пул з'єднань БД не ініціалізовано. Неможливо додати замовлення.")
-        return
+        return False
     async with pool.acquire() as conn:
         try:
             await conn.execute("""
-                INSERT INTO orders (order_id, client_id, status, price, description, created_at)
-                VALUES ($1, $2, $3, $4, $5, NOW())
-                ON CONFLICT (order_id) DO NOTHING
-            """, order_id, client_id, status, price, description)
+                WITH inserted AS (
+                    INSERT INTO orders (order_id, client_id, status, price, description, created_at)
+                    VALUES ($1, $2, $3, $4, $5, NOW())
+                    ON CONFLICT (order_id) DO NOTHING
+                    RETURNING order_id, status, created_at
+                )
+                INSERT INTO order_status_events (order_id, status, changed_by, changed_at)
+                SELECT order_id, status, $6, created_at FROM inserted
+            """, order_id, client_id, status_code(status), price, description, changed_by)
             logger.info(f"Замовлення {order_id} додано зі статусом '{status}'.")
             # Перевірка, чи замовлення дійсно додалося
             check_record = await conn.fetchrow("SELECT order_id, status FROM orders WHERE order_id = $1", order_id)
             if check_record:
-                logger.info(f"Перевірка: Замовлення {check_record['order_id']} знайдено в БД зі статусом '{check_record['status']}'.")
+                logger.info(f"Перевірка: Замовлення {check_record['order_id']} знайдено в БД зі статусом '{status_label(check_record['status'])}'.")
             else:
                 logger.warning(f"Перевірка: Замовлення {order_id} НЕ знайдено в БД після спроби додавання.")
-
+            return True
         except Exception as e:
             logger.error(f"Помилка при додаванні замовлення {order_id}: {e}")
+            return False
 
 async def get_order_details(order_id: str) -> Optional[Dict[str, Any]]:
     """Повертає деталі замовлення (статус, ціну, опис) за його order_id, або None, якщо не знайдено."""
@@ -164,23 +922,149 @@ async def get_order_details(order_id: str) -> Optional[Dict[str, Any]]:
     async with pool.acquire() as conn:
         try:
             record = await conn.fetchrow("SELECT order_id, status, price, description, created_at FROM orders WHERE order_id = $1", order_id)
-            return dict(record) if record else None
+            return _order_row(record) if record else None
         except Exception as e:
             logger.error(f"Помилка при отриманні деталей замовлення {order_id}: {e}")
             return None
 
-async def update_order_status(order_id: str, new_status: str):
-    """Оновлює статус замовлення за його order_id."""
+# Оновлення статусу і запис події історії виконуються одним запитом (одна транзакція).
+# previous_status читається з блокуванням рядка, тому паралельні зміни не перемішують історію.
+_UPDATE_STATUS_WITH_EVENT_SQL = """
+    WITH old AS (
+        SELECT order_id, status FROM orders WHERE order_id = ANY($2::text[]) FOR UPDATE
+    ), updated AS (
+        UPDATE orders o SET status = $1 FROM old
+        WHERE o.order_id = old.order_id
+        RETURNING o.order_id, o.client_id, old.status AS previous_status
+    ), events AS (
+        INSERT INTO order_status_events (order_id, status, previous_status, changed_by)
+        SELECT order_id, $1, previous_status, $3 FROM updated WHERE previous_status <> $1
+    )
+    SELECT order_id, client_id, previous_status <> $1 AS changed FROM updated
+"""
+
+@_deferrable()
+async def update_order_status(order_id: str, new_status: str, changed_by: Optional[int] = None):
+    """Оновлює статус замовлення за його order_id і записує подію в order_status_events."""
     pool = await get_db_pool()
     if pool is None:
         logger.warning("Пул з'єднань БД не ініціалізовано. Неможливо оновити статус замовлення.")
-        return
+        return False
     async with pool.acquire() as conn:
         try:
-            await conn.execute("UPDATE orders SET status = $1 WHERE order_id = $2", new_status, order_id)
+            await conn.execute(_UPDATE_STATUS_WITH_EVENT_SQL, status_code(new_status), [order_id], changed_by)
             logger.info(f"Статус замовлення {order_id} оновлено на {new_status}.")
+            return True
         except Exception as e:
             logger.error(f"Помилка при оновленні статусу замовлення {order_id}: {e}")
+            return False
+
+async def bulk_update_order_status(order_ids: list[str], new_status: str, changed_by: Optional[int] = None) -> list[Dict[str, Any]]:
+    """
+    Оновлює статус кількох замовлень одним запитом.
+    Повертає список {order_id, client_id, changed} знайдених замовлень (неіснуючі номери пропускаються);
+    changed - False для замовлень, які вже мали цей статус.
+    """
+    pool = await get_db_pool()
+    if pool is None:
+        logger.warning("Пул з'єднань БД не ініціалізовано. Неможливо оновити статуси замовлень.")
+        return []
+    async with pool.acquire() as conn:
+        try:
+            records = await conn.fetch(_UPDATE_STATUS_WITH_EVENT_SQL, status_code(new_status), order_ids, changed_by)
+            logger.info(f"Статус {len(records)} замовлень оновлено на {new_status}.")
+            return [dict(r) for r in records]
+        except Exception as e:
+            logger.error(f"Помилка при масовому оновленні статусу замовлень: {e}")
+            return []
+
+async def get_order_timeline(order_id: str) -> list[Dict[str, Any]]:
+    """
+    Повертає історію статусів замовлення від найстарішої події.
+    Кожна подія містить dwell_seconds - скільки замовлення пробуло в цьому статусі
+    (для поточного статусу - до цього моменту).
+    """
+    pool = await get_db_pool()
+    if pool is None:
+        logger.warning("Пул з'єднань БД не ініціалізовано. Неможливо отримати історію статусів.")
+        return []
+    async with pool.acquire() as conn:
+        try:
+            records = await conn.fetch("""
+                SELECT event_id, order_id, status, previous_status, changed_by, changed_at,
+                       EXTRACT(EPOCH FROM COALESCE(
+                           LEAD(changed_at) OVER (ORDER BY changed_at, event_id), NOW()
+                       ) - changed_at)::float8 AS dwell_seconds
+                FROM order_status_events
+                WHERE order_id = $1
+                ORDER BY changed_at, event_id
+            """, order_id)
+            return [_order_event_row(r) for r in records]
+        except Exception as e:
+            logger.error(f"Помилка при отриманні історії статусів замовлення {order_id}: {e}")
+            return []
+
+async def get_status_dwell_stats(days: int) -> list[Dict[str, Any]]:
+    """
+    Час перебування замовлень у кожному статусі для етапів, що почалися за останні days днів.
+    Повертає для кожного статусу: completed (етапів завершено), in_progress (замовлень зараз у статусі),
+    avg_seconds, p50_seconds, p90_seconds (по завершених етапах). Фінальний статус не враховується.
+    """
+    pool = await get_db_pool()
+    if pool is None:
+        logger.warning("Пул з'єднань БД не ініціалізовано. Неможливо отримати статистику статусів.")
+        return []
+    async with pool.acquire() as conn:
+        try:
+            # Кінець етапу - наступна подія того ж замовлення; обчислюється лише для замовлень з подіями у вікні
+            records = await conn.fetch(f"""
+                WITH stages AS (
+                    SELECT status, changed_at,
+                           LEAD(changed_at) OVER (PARTITION BY order_id ORDER BY changed_at, event_id) AS left_at
+                    FROM order_status_events
+                    WHERE order_id IN (
+                        SELECT order_id FROM order_status_events
+                        WHERE changed_at >= NOW() - make_interval(days => $1)
+                    )
+                )
+                SELECT status,
+                       COUNT(left_at) AS completed,
+                       COUNT(*) - COUNT(left_at) AS in_progress,
+                       EXTRACT(EPOCH FROM AVG(left_at - changed_at))::float8 AS avg_seconds,
+                       EXTRACT(EPOCH FROM percentile_cont(0.5) WITHIN GROUP (ORDER BY left_at - changed_at))::float8 AS p50_seconds,
+                       EXTRACT(EPOCH FROM percentile_cont(0.9) WITHIN GROUP (ORDER BY left_at - changed_at))::float8 AS p90_seconds
+                FROM stages
+                WHERE changed_at >= NOW() - make_interval(days => $1) AND status <> {COMPLETED}
+                GROUP BY status
+                ORDER BY status
+            """, days)
+            return [_order_row(r) for r in records]
+        except Exception as e:
+            logger.error(f"Помилка при отриманні статистики часу в статусах: {e}")
+            return []
+
+async def get_order_status_events_since(after_event_id: int, limit: int = 500) -> list[Dict[str, Any]]:
+    """
+    Повертає до limit подій зміни статусу з event_id > after_event_id (за зростанням).
+    Споживачі стрічки змін використовують її, щоб дочитати події, пропущені під час розриву LISTEN.
+    """
+    pool = await get_db_pool()
+    if pool is None:
+        logger.warning("Пул з'єднань БД не ініціалізовано. Неможливо отримати події статусів.")
+        return []
+    async with pool.acquire() as conn:
+        try:
+            records = await conn.fetch("""
+                SELECT event_id, order_id, status, previous_status, changed_by, changed_at
+                FROM order_status_events
+                WHERE event_id > $1
+                ORDER BY event_id
+                LIMIT $2
+            """, after_event_id, limit)
+            return [_order_event_row(r) for r in records]
+        except Exception as e:
+            logger.error(f"Помилка при отриманні подій статусів після {after_event_id}: {e}")
+            return []
 
 async def get_client_id_by_order_id(order_id: str) -> Optional[int]: # ЗМІНА НАЗВИ ФУНКЦІЇ
     """
@@ -211,7 +1095,7 @@ async def get_all_orders():
     async with pool.acquire() as conn:
         try:
             records = await conn.fetch("SELECT order_id, client_id, status, price, description, created_at FROM orders")
-            return [dict(r) for r in records]
+            return [_order_row(r) for r in records]
         except Exception as e:
             logger.error(f"Помилка при отриманні всіх замовлень: {e}")
             return []
@@ -224,8 +1108,8 @@ async def get_orders_by_status(status: str):
         return []
     async with pool.acquire() as conn:
         try:
-            records = await conn.fetch("SELECT order_id, client_id, status, price, description, created_at FROM orders WHERE status = $1", status)
-            return [dict(r) for r in records]
+            records = await conn.fetch("SELECT order_id, client_id, status, price, description, created_at FROM orders WHERE status = $1", status_code(status))
+            return [_order_row(r) for r in records]
         except Exception as e:
             logger.error(f"Помилка при отриманні замовлень за статусом '{status}': {e}")
             return []
@@ -243,12 +1127,13 @@ async def delete_order(order_id: str): # ЗМІНА ПАРАМЕТРА
         except Exception as e:
             logger.error(f"Помилка при видаленні замовлення {order_id}: {e}")
 
+@_deferrable(_defer_add_client_state)
 async def add_client_state(client_id: int, is_active: bool = False, is_notified: bool = False, current_manager_id: Optional[int] = None):
     """Додає новий стан клієнта або оновлює існуючий."""
     pool = await get_db_pool()
     if pool is None:
         logger.warning("Пул з'єднань БД не ініціалізовано. Неможливо додати/оновити стан клієнта.")
-        return
+        return False
     async with pool.acquire() as conn:
         try:
             await conn.execute("""
@@ -260,62 +1145,157 @@ async def add_client_state(client_id: int, is_active: bool = False, is_notified:
                     current_manager_id = EXCLUDED.current_manager_id,
                     last_activity = NOW()
             """, client_id, is_active, is_notified, current_manager_id)
+            await _notify_invalidation(conn, "client_states", client_id)
             logger.info(f"Стан клієнта {client_id} додано/оновлено.")
+            return True
         except Exception as e:
             logger.error(f"Помилка при додаванні/оновленні стану клієнта {client_id}: {e}")
+            return False
 
 async def get_client_state(client_id: int):
     """Повертає стан клієнта за його client_id, або None, якщо не знайдено."""
+    if _cache_enabled and client_id in _client_state_cache:
+        cached = _client_state_cache[client_id]
+        return dict(cached) if cached else None
+    seq = _invalidation_seq
     pool = await get_db_pool()
     if pool is None:
+        found, state = _recall("client_state", client_id)
+        if found:
+            return dict(state) if state else None
         logger.warning("Пул з'єднань БД не ініціалізовано. Неможливо отримати стан клієнта.")
         return None
     async with pool.acquire() as conn:
         try:
             record = await conn.fetchrow("SELECT is_active, is_notified, current_manager_id, last_activity FROM client_states WHERE client_id = $1", client_id)
-            return dict(record) if record else None
+            state = dict(record) if record else None
+            _cache_put(_client_state_cache, client_id, state, seq)
+            _remember("client_state", client_id, state)
+            return dict(state) if state else None
         except Exception as e:
             logger.error(f"Помилка при отриманні стану клієнта {client_id}: {e}")
             return None
 
+@_deferrable(_defer_client_active)
 async def update_client_active_status(client_id: int, is_active: bool):
     """Оновлює статус активності клієнта."""
     pool = await get_db_pool()
     if pool is None:
         logger.warning("Пул з'єднань БД не ініціалізовано. Неможливо оновити статус активності клієнта.")
-        return
+        return False
     async with pool.acquire() as conn:
         try:
-            await conn.execute("UPDATE client_states SET is_active = $1, last_activity = NOW() WHERE client_id = $2", is_active, client_id)
+            async with conn.transaction():
+                await conn.execute("UPDATE client_states SET is_active = $1, last_activity = NOW() WHERE client_id = $2", is_active, client_id)
+                # Журнал діалогів для SLA-аналітики: попередній діалог закривається, новий запит відкриває наступний
+                await conn.execute(
+                    "UPDATE support_dialogs SET closed_at = NOW() WHERE client_id = $1 AND closed_at IS NULL", client_id
+                )
+                if is_active:
+                    await conn.execute("INSERT INTO support_dialogs (client_id) VALUES ($1)", client_id)
+                await _notify_invalidation(conn, "client_states", client_id)
             logger.info(f"Статус активності клієнта {client_id} оновлено на {is_active}.")
+            return True
         except Exception as e:
             logger.error(f"Помилка при оновленні статусу активності клієнта {client_id}: {e}")
+            return False
 
+@_deferrable(_defer_client_notified)
 async def update_client_notified_status(client_id: int, is_notified: bool):
     """Оновлює статус сповіщення клієнта."""
     pool = await get_db_pool()
     if pool is None:
         logger.warning("Пул з'єднань БД не ініціалізовано. Неможливо оновити статус сповіщення клієнта.")
-        return
+        return False
     async with pool.acquire() as conn:
         try:
             await conn.execute("UPDATE client_states SET is_notified = $1 WHERE client_id = $2", is_notified, client_id)
+            await _notify_invalidation(conn, "client_states", client_id)
             logger.info(f"Статус сповіщення клієнта {client_id} оновлено на {is_notified}.")
+            return True
         except Exception as e:
             logger.error(f"Помилка при оновленні статусу сповіщення клієнта {client_id}: {e}")
+            return False
 
+@_deferrable(_defer_client_manager)
 async def update_client_manager(client_id: int, manager_id: Optional[int]):
     """Оновлює ID менеджера, який зараз працює з клієнтом."""
     pool = await get_db_pool()
     if pool is None:
         logger.warning("Пул з'єднань БД не ініціалізовано. Неможливо оновити менеджера для клієнта.")
-        return
+        return False
     async with pool.acquire() as conn:
         try:
             await conn.execute("UPDATE client_states SET current_manager_id = $1 WHERE client_id = $2", manager_id, client_id)
+            await _notify_invalidation(conn, "client_states", client_id)
             logger.info(f"Менеджер для клієнта {client_id} оновлено на {manager_id}.")
+            return True
         except Exception as e:
             logger.error(f"Помилка при оновленні менеджера для клієнта {client_id}: {e}")
+            return False
+
+async def close_stale_dialogs(idle_minutes: int, batch_size: int) -> list[Dict[str, Any]]:
+    """
+    Завершує до batch_size активних діалогів, у яких понад idle_minutes хвилин не було ні повідомлень,
+    ні змін стану, одним запитом UPDATE ... RETURNING: знімає активність і менеджера з client_states,
+    закриває журнал support_dialogs і звільняє активний діалог менеджера.
+    Повертає [{client_id, manager_id, was_active_dialog}] для сповіщення сторін.
+    """
+    # Повідомлення з буфера теж є активністю - інакше діалог, у якому щойно писали, може бути закрито
+    await flush_client_messages()
+    pool = await get_db_pool()
+    if pool is None:
+        logger.warning("Пул з'єднань БД не ініціалізовано. Неможливо завершити неактивні діалоги.")
+        return []
+    async with pool.acquire() as conn:
+        try:
+            async with conn.transaction():
+                records = await conn.fetch("""
+                    WITH stale AS (
+                        SELECT s.client_id, s.current_manager_id
+                        FROM client_states s
+                        WHERE s.is_active
+                          AND s.last_activity < NOW() - make_interval(mins => $1)
+                          AND NOT EXISTS (
+                              SELECT 1 FROM client_messages m
+                              WHERE m.client_id = s.client_id
+                                AND m.timestamp >= LOCALTIMESTAMP - make_interval(mins => $1)
+                          )
+                        ORDER BY s.last_activity
+                        LIMIT $2
+                        FOR UPDATE OF s SKIP LOCKED
+                    ), closed AS (
+                        UPDATE client_states s
+                        SET is_active = FALSE, is_notified = FALSE, current_manager_id = NULL, last_activity = NOW()
+                        FROM stale
+                        WHERE s.client_id = stale.client_id
+                        RETURNING s.client_id, stale.current_manager_id AS manager_id
+                    ), dialogs AS (
+                        UPDATE support_dialogs d SET closed_at = NOW()
+                        FROM closed
+                        WHERE d.client_id = closed.client_id AND d.closed_at IS NULL
+                    ), released AS (
+                        UPDATE manager_active_dialogs a SET active_client_id = NULL
+                        FROM closed
+                        WHERE a.active_client_id = closed.client_id
+                        RETURNING a.manager_id, closed.client_id
+                    )
+                    SELECT c.client_id, COALESCE(c.manager_id, r.manager_id) AS manager_id,
+                           (r.manager_id IS NOT NULL) AS was_active_dialog
+                    FROM closed c
+                    LEFT JOIN released r ON r.client_id = c.client_id
+                """, idle_minutes, batch_size)
+                if records:
+                    await _notify_invalidation(conn, "client_states", *(r["client_id"] for r in records))
+                    released = [r["manager_id"] for r in records if r["was_active_dialog"]]
+                    if released:
+                        await _notify_invalidation(conn, "manager_active_dialogs", *released)
+            if records:
+                logger.info(f"Автоматично завершено {len(records)} неактивних діалогів.")
+            return [dict(r) for r in records]
+        except Exception as e:
+            logger.error(f"Помилка при завершенні неактивних діалогів: {e}")
+            return []
 
 async def get_manager_active_dialogs(manager_id: int) -> Optional[int]:
     """
@@ -323,8 +1303,14 @@ async def get_manager_active_dialogs(manager_id: int) -> Optional[int]:
     Якщо немає активного діалогу, повертає None.
     Ця функція тепер використовує нову таблицю `manager_active_dialogs`.
     """
+    if _cache_enabled and manager_id in _manager_dialog_cache:
+        return _manager_dialog_cache[manager_id]
+    seq = _invalidation_seq
     pool = await get_db_pool()
     if pool is None:
+        found, active_client_id = _recall("manager_dialog", manager_id)
+        if found:
+            return active_client_id
         logger.warning("Пул з'єднань БД не ініціалізовано. Неможливо отримати активний діалог менеджера.")
         return None
     async with pool.acquire() as conn:
@@ -333,11 +1319,14 @@ async def get_manager_active_dialogs(manager_id: int) -> Optional[int]:
                 "SELECT active_client_id FROM manager_active_dialogs WHERE manager_id = $1",
                 manager_id
             )
+            _cache_put(_manager_dialog_cache, manager_id, active_client_id, seq)
+            _remember("manager_dialog", manager_id, active_client_id)
             return active_client_id
         except Exception as e:
             logger.error(f"Помилка при отриманні активного діалогу для менеджера {manager_id}: {e}")
             return None
 
+@_deferrable(_defer_manager_dialog)
 async def update_manager_active_dialog(manager_id: int, client_id: Optional[int]):
     """
     Встановлює або очищає активний діалог для менеджера.
@@ -347,7 +1336,7 @@ async def update_manager_active_dialog(manager_id: int, client_id: Optional[int]
     pool = await get_db_pool()
     if pool is None:
         logger.warning("Пул з'єднань БД не ініціалізовано. Неможливо оновити активний діалог менеджера.")
-        return
+        return False
     async with pool.acquire() as conn:
         try:
             await conn.execute("""
@@ -356,22 +1345,170 @@ async def update_manager_active_dialog(manager_id: int, client_id: Optional[int]
                 ON CONFLICT (manager_id) DO UPDATE SET
                     active_client_id = EXCLUDED.active_client_id
             """, manager_id, client_id)
+            await _notify_invalidation(conn, "manager_active_dialogs", manager_id)
             if client_id:
                 logger.info(f"Менеджер {manager_id} тепер веде активний діалог з клієнтом {client_id}.")
             else:
                 logger.info(f"Активний діалог для менеджера {manager_id} очищено.")
+            return True
         except Exception as e:
             logger.error(f"Помилка при оновленні активного діалогу для менеджера {manager_id}: {e}")
+            return False
 
-async def get_active_clients():
-    """Повертає список ID активних клієнтів."""
+async def claim_client(client_id: int, manager_id: int) -> bool:
+    """
+    Атомарно закріплює активного клієнта за менеджером.
+    Повертає False, якщо діалог неактивний або клієнт вже в роботі в іншого менеджера.
+    """
     pool = await get_db_pool()
     if pool is None:
-        logger.warning("Пул з'єднань БД не ініціалізовано. Неможливо отримати активних клієнтів.")
-        return []
+        logger.warning("Пул з'єднань БД не ініціалізовано. Неможливо закріпити клієнта.")
+        return False
     async with pool.acquire() as conn:
         try:
-            records = await conn.fetch("SELECT client_id FROM client_states WHERE is_active = TRUE")
+            async with conn.transaction():
+                claimed = await conn.fetchval("""
+                    UPDATE client_states SET current_manager_id = $2
+                    WHERE client_id = $1 AND is_active = TRUE
+                        AND (current_manager_id IS NULL OR current_manager_id = $2)
+                    RETURNING client_id
+                """, client_id, manager_id)
+                if claimed is not None:
+                    await _mark_support_dialog_claimed(conn, client_id, manager_id)
+                    await _notify_invalidation(conn, "client_states", client_id)
+            if claimed is not None:
+                logger.info(f"Клієнта {client_id} закріплено за менеджером {manager_id}.")
+            return claimed is not None
+        except Exception as e:
+            logger.error(f"Помилка при закріпленні клієнта {client_id} за менеджером {manager_id}: {e}")
+            return False
+
+# 🔥 ФУНКЦІЇ РЕЄСТРУ МЕНЕДЖЕРІВ ТА РОЗПОДІЛУ КЛІЄНТІВ 🔥
+
+# Ключ транзакційного advisory lock: розподіл клієнтів з різних воркерів виконується послідовно,
+# щоб ліміти менеджерів не перевищувались.
+ASSIGNMENT_LOCK_KEY = LEADER_LOCK_KEY + 1
+
+async def register_manager(manager_id: int, max_dialogs: int):
+    """Додає менеджера до реєстру, якщо його там ще немає (налаштування існуючих записів не змінюються)."""
+    pool = await get_db_pool()
+    if pool is None:
+        logger.warning("Пул з'єднань БД не ініціалізовано. Неможливо зареєструвати менеджера.")
+        return
+    async with pool.acquire() as conn:
+        try:
+            await conn.execute("""
+                INSERT INTO managers (manager_id, max_dialogs)
+                VALUES ($1, $2)
+                ON CONFLICT (manager_id) DO NOTHING
+            """, manager_id, max_dialogs)
+            logger.info(f"Менеджер {manager_id} зареєстрований.")
+        except Exception as e:
+            logger.error(f"Помилка при реєстрації менеджера {manager_id}: {e}")
+
+async def set_manager_online(manager_id: int, is_online: bool):
+    """Змінює онлайн-статус менеджера (офлайн-менеджерам нові клієнти не призначаються)."""
+    pool = await get_db_pool()
+    if pool is None:
+        logger.warning("Пул з'єднань БД не ініціалізовано. Неможливо змінити статус менеджера.")
+        return
+    async with pool.acquire() as conn:
+        try:
+            await conn.execute(
+                "UPDATE managers SET is_online = $2, updated_at = NOW() WHERE manager_id = $1",
+                manager_id, is_online
+            )
+            logger.info(f"Менеджер {manager_id} тепер {'онлайн' if is_online else 'офлайн'}.")
+        except Exception as e:
+            logger.error(f"Помилка при зміні статусу менеджера {manager_id}: {e}")
+
+async def set_manager_max_dialogs(manager_id: int, max_dialogs: int):
+    """Встановлює ліміт одночасних діалогів менеджера."""
+    pool = await get_db_pool()
+    if pool is None:
+        logger.warning("Пул з'єднань БД не ініціалізовано. Неможливо змінити ліміт менеджера.")
+        return
+    async with pool.acquire() as conn:
+        try:
+            await conn.execute(
+                "UPDATE managers SET max_dialogs = $2, updated_at = NOW() WHERE manager_id = $1",
+                manager_id, max_dialogs
+            )
+            logger.info(f"Ліміт діалогів менеджера {manager_id} встановлено на {max_dialogs}.")
+        except Exception as e:
+            logger.error(f"Помилка при зміні ліміту менеджера {manager_id}: {e}")
+
+async def get_managers_load() -> list[Dict[str, Any]]:
+    """Повертає менеджерів з кількістю активних діалогів (manager_id, is_online, max_dialogs, active_dialogs)."""
+    pool = await get_db_pool()
+    if pool is None:
+        logger.warning("Пул з'єднань БД не ініціалізовано. Неможливо отримати навантаження менеджерів.")
+        return []
+    async with pool.acquire() as conn:
+        try:
+            records = await conn.fetch("""
+                SELECT m.manager_id, m.is_online, m.max_dialogs, COUNT(cs.client_id) AS active_dialogs
+                FROM managers m
+                LEFT JOIN client_states cs ON cs.current_manager_id = m.manager_id AND cs.is_active
+                GROUP BY m.manager_id, m.is_online, m.max_dialogs
+                ORDER BY m.manager_id;
+            """)
+            return [dict(r) for r in records]
+        except Exception as e:
+            logger.error(f"Помилка при отриманні навантаження менеджерів: {e}")
+            return []
+
+async def assign_client_to_least_loaded_manager(client_id: int) -> Optional[int]:
+    """
+    Призначає очікуючого клієнта онлайн-менеджеру з найменшою кількістю активних діалогів,
+    у якого ще не вичерпано ліміт max_dialogs.
+    Повертає manager_id або None, якщо вільних менеджерів немає чи клієнт вже не очікує.
+    """
+    pool = await get_db_pool()
+    if pool is None:
+        logger.warning("Пул з'єднань БД не ініціалізовано. Неможливо призначити менеджера.")
+        return None
+    async with pool.acquire() as conn:
+        try:
+            async with conn.transaction():
+                await conn.execute("SELECT pg_advisory_xact_lock($1)", ASSIGNMENT_LOCK_KEY)
+                manager_id = await conn.fetchval("""
+                    WITH candidate AS (
+                        SELECT m.manager_id
+                        FROM managers m
+                        LEFT JOIN client_states cs ON cs.current_manager_id = m.manager_id AND cs.is_active
+                        WHERE m.is_online
+                        GROUP BY m.manager_id, m.max_dialogs
+                        HAVING COUNT(cs.client_id) < m.max_dialogs
+                        ORDER BY COUNT(cs.client_id) ASC, m.manager_id ASC
+                        LIMIT 1
+                    )
+                    UPDATE client_states SET current_manager_id = candidate.manager_id
+                    FROM candidate
+                    WHERE client_states.client_id = $1
+                        AND client_states.is_active = TRUE
+                        AND client_states.current_manager_id IS NULL
+                    RETURNING client_states.current_manager_id
+                """, client_id)
+                if manager_id is not None:
+                    await _mark_support_dialog_claimed(conn, client_id, manager_id)
+                    await _notify_invalidation(conn, "client_states", client_id)
+            if manager_id is not None:
+                logger.info(f"Клієнта {client_id} автоматично призначено менеджеру {manager_id}.")
+            return manager_id
+        except Exception as e:
+            logger.error(f"Помилка при автоматичному призначенні менеджера клієнту {client_id}: {e}")
+            return None
+
+async def get_active_clients():
+    """Повертає список ID активних клієнтів."""
+    pool = await get_db_pool()
+    if pool is None:
+        logger.warning("Пул з'єднань БД не ініціалізовано. Неможливо отримати активних клієнтів.")
+        return []
+    async with pool.acquire() as conn:
+        try:
+            records = await conn.fetch("SELECT client_id FROM client_states WHERE is_active = TRUE")
             return [r['client_id'] for r in records]
         except Exception as e:
             logger.error(f"Помилка при отриманні активних клієнтів: {e}")
@@ -413,36 +1550,498 @@ async def get_not_notified_clients():
             logger.error(f"Помилка при отриманні несповіщених клієнтів: {e}")
             return []
 
-async def add_client_message(client_id: int, sender_type: str, message_text: str):
-    """Додає повідомлення від клієнта або менеджера до історії."""
+# --- ЗАПИС ІСТОРІЇ ДІАЛОГІВ ПАЧКАМИ (WRITE-BEHIND) ---
+# Повідомлення діалогів накопичуються в буфері й записуються одним executemany.
+#   CLIENT_MESSAGES_DURABILITY=async (за замовчуванням) - add_client_message повертається одразу,
+#       буфер записується раз на CLIENT_MESSAGES_FLUSH_INTERVAL секунд або при CLIENT_MESSAGES_BATCH_SIZE рядках;
+#   CLIENT_MESSAGES_DURABILITY=sync - add_client_message чекає, поки рядок буде записано в БД;
+#       одночасні повідомлення все одно об'єднуються в одну пачку.
+# Незаписані рядки губляться лише при аварійному завершенні процесу; при зупинці викликається flush_client_messages.
+CLIENT_MESSAGES_DURABILITY = os.getenv("CLIENT_MESSAGES_DURABILITY", "async").lower()
+CLIENT_MESSAGES_FLUSH_INTERVAL = float(os.getenv("CLIENT_MESSAGES_FLUSH_INTERVAL", 0.2))
+CLIENT_MESSAGES_BATCH_SIZE = int(os.getenv("CLIENT_MESSAGES_BATCH_SIZE", 200))
+
+_message_buffer: list[tuple[int, str, str, datetime, Optional[str], Optional[str]]] = []
+_message_flush_lock = asyncio.Lock()
+_message_flush_task: Optional[asyncio.Task] = None
+_message_batch_task: Optional[asyncio.Task] = None # запис повної пачки, не чекаючи інтервалу
+
+async def add_client_message(client_id: int, sender_type: str, message_text: str,
+                             media_type: Optional[str] = None, file_id: Optional[str] = None) -> bool:
+    """
+    Додає повідомлення від клієнта або менеджера до історії (через буфер пачкового запису).
+    Для фото, документів і голосових зберігається лише file_id Telegram (message_text - підпис).
+    Повертає False лише в режимі sync, якщо пачку з повідомленням не вдалося записати повністю (якщо БД
+    недоступна, пачка лишається в буфері і записується пізніше); в режимі async повідомлення лише ставиться в буфер.
+    """
+    global _message_flush_task, _message_batch_task
+    # Час фіксуємо в момент надходження, а не запису пачки
+    _message_buffer.append((client_id, sender_type, message_text, datetime.now(timezone.utc), media_type, file_id))
+    if CLIENT_MESSAGES_DURABILITY == "sync":
+        if await flush_client_messages():
+            return True
+        logger.warning(f"Повідомлення для клієнта {client_id} не записано в БД одразу (режим sync).")
+        _reschedule_client_messages_flush()
+        return False
+    if len(_message_buffer) >= CLIENT_MESSAGES_BATCH_SIZE and (_message_batch_task is None or _message_batch_task.done()):
+        _message_batch_task = asyncio.create_task(flush_client_messages())
+    elif _message_flush_task is None or _message_flush_task.done():
+        _message_flush_task = asyncio.create_task(_flush_client_messages_later())
+    return True
+
+async def _flush_client_messages_later():
+    await asyncio.sleep(CLIENT_MESSAGES_FLUSH_INTERVAL)
+    await flush_client_messages()
+    if _message_buffer:
+        # Пачку не вдалося записати (або вона прийшла під час запису) - повторимо пізніше
+        asyncio.get_running_loop().call_soon(_reschedule_client_messages_flush)
+
+def _reschedule_client_messages_flush():
+    global _message_flush_task
+    if _message_buffer and (_message_flush_task is None or _message_flush_task.done()):
+        _message_flush_task = asyncio.create_task(_flush_client_messages_later())
+
+def pending_client_messages() -> int:
+    """Скільки повідомлень діалогів ще не записано в БД (буфер пачкового запису)."""
+    return len(_message_buffer)
+
+async def flush_client_messages() -> bool:
+    """Записує в БД усі накопичені повідомлення діалогів. Повертає False, якщо частину не вдалося записати."""
+    async with _message_flush_lock:
+        if not _message_buffer:
+            return True
+        rows = _message_buffer[:]
+        _message_buffer.clear()
+        pool = await get_db_pool()
+        if pool is None:
+            logger.warning(f"Пул з'єднань БД не ініціалізовано. {len(rows)} повідомлень залишаються в буфері.")
+            _message_buffer[:0] = rows
+            return False
+        insert_sql = """
+            INSERT INTO client_messages (client_id, sender_type, message_text, timestamp, media_type, file_id)
+            VALUES ($1, $2, $3, $4::timestamptz, $5, $6)
+        """
+        try:
+            async with pool.acquire() as conn:
+                try:
+                    await conn.executemany(insert_sql, rows)
+                    logger.info(f"Додано {len(rows)} повідомлень діалогів однією пачкою.")
+                    return True
+                except asyncpg.PostgresError as e:
+                    if classify_error(e) == CONNECTION:
+                        raise
+                    # Помилка даних (наприклад, немає стану клієнта) - записуємо по одному, щоб не втратити решту пачки
+                    logger.error(f"Помилка при пакетному додаванні повідомлень: {e}. Записуємо по одному.")
+                    written = 0
+                    for row in rows:
+                        try:
+                            await conn.execute(insert_sql, *row)
+                            written += 1
+                        except Exception as row_error:
+                            logger.error(f"Помилка при додаванні повідомлення для клієнта {row[0]}: {row_error}")
+                    return written == len(rows)
+        except Exception as e:
+            # Зокрема, не вдалося отримати з'єднання або воно обірвалось - пачка повертається в буфер
+            logger.error(f"Помилка при пакетному додаванні {len(rows)} повідомлень: {e}")
+            _message_buffer[:0] = rows
+            return False
+
+async def get_client_messages(client_id: int):
+    """Повертає всі повідомлення для певного клієнта (разом із розпакованими архівами завершених діалогів)."""
+    # Повідомлення з буфера мають потрапити в історію до читання
+    await flush_client_messages()
     pool = await get_db_pool()
     if pool is None:
-        logger.warning("Пул з'єднань БД не ініціалізовано. Неможливо додати повідомлення.")
+        logger.warning("Пул з'єднань БД не ініціалізовано. Неможливо отримати повідомлення клієнта.")
+        return []
+    async with pool.acquire() as conn:
+        try:
+            archives = await conn.fetch(
+                "SELECT codec, payload FROM dialog_archives WHERE client_id = $1 ORDER BY first_ts ASC",
+                client_id
+            )
+            records = await conn.fetch("SELECT sender_type, message_text, timestamp, media_type, file_id FROM client_messages WHERE client_id = $1 ORDER BY timestamp ASC, message_id ASC", client_id)
+            messages = []
+            for archive in archives:
+                messages.extend(decode_dialog(archive["payload"], archive["codec"]))
+            messages.extend(dict(r) for r in records)
+            return messages
+        except Exception as e:
+            logger.error(f"Помилка при отриманні повідомлень для клієнта {client_id}: {e}")
+            return []
+
+async def archive_closed_dialogs(grace_hours: int, batch_size: int) -> int:
+    """
+    Стискає повідомлення завершених діалогів: для клієнтів без активного діалогу, які не писали
+    понад grace_hours годин, рядки client_messages замінюються одним записом у dialog_archives.
+    Обробляє до batch_size клієнтів. Повертає кількість заархівованих діалогів.
+    """
+    await flush_client_messages()
+    pool = await get_db_pool()
+    if pool is None:
+        logger.warning("Пул з'єднань БД не ініціалізовано. Неможливо заархівувати діалоги.")
+        return 0
+    archived = 0
+    async with pool.acquire() as conn:
+        try:
+            client_ids = await conn.fetch("""
+                SELECT m.client_id
+                FROM client_messages m
+                JOIN client_states s ON s.client_id = m.client_id
+                WHERE NOT s.is_active
+                GROUP BY m.client_id
+                HAVING MAX(m.timestamp) < LOCALTIMESTAMP - make_interval(hours => $1)
+                LIMIT $2
+            """, grace_hours, batch_size)
+        except Exception as e:
+            logger.error(f"Помилка при пошуку завершених діалогів для архівації: {e}")
+            return 0
+
+        for record in client_ids:
+            client_id = record["client_id"]
+            try:
+                async with conn.transaction():
+                    # Блокуємо стан клієнта, щоб він не почав новий діалог під час архівації
+                    is_active = await conn.fetchval(
+                        "SELECT is_active FROM client_states WHERE client_id = $1 FOR UPDATE", client_id
+                    )
+                    if is_active:
+                        continue
+                    rows = await conn.fetch("""
+                        DELETE FROM client_messages WHERE client_id = $1
+                        RETURNING message_id, sender_type, message_text, timestamp, media_type, file_id
+                    """, client_id)
+                    if not rows:
+                        continue
+                    messages = sorted((dict(r) for r in rows), key=lambda m: (m["timestamp"], m["message_id"]))
+                    await conn.execute("""
+                        INSERT INTO dialog_archives (client_id, first_ts, last_ts, message_count, codec, payload)
+                        VALUES ($1, $2, $3, $4, $5, $6)
+                    """, client_id, messages[0]["timestamp"], messages[-1]["timestamp"], len(messages),
+                        DIALOG_ARCHIVE_CODEC, encode_dialog(messages))
+                archived += 1
+            except Exception as e:
+                logger.error(f"Помилка при архівації діалогу клієнта {client_id}: {e}")
+    if archived:
+        logger.info(f"Заархівовано {archived} завершених діалогів.")
+    return archived
+
+# --- АНАЛІТИКА ПРОДАЖІВ (ДЕННІ АГРЕГАТИ) ---
+# order_daily_stats містить кількість замовлень і суму цін за день створення та статусом.
+# Тригер на orders оновлює агрегати в тій самій транзакції, що й вставку, зміну статусу/ціни чи видалення,
+# тому /stats читає кілька рядків замість сканування orders. Перенесення в orders_archive агрегати не змінює.
+# День рахується в часовому поясі STATS_TIME_ZONE.
+STATS_TIME_ZONE = os.getenv("STATS_TIME_ZONE", "Europe/Kyiv")
+
+async def _init_order_daily_stats(conn):
+    """Створює таблицю денних агрегатів і тригер; порожню таблицю заповнює з orders та orders_archive."""
+    await conn.execute("""
+        CREATE TABLE IF NOT EXISTS order_daily_stats (
+            day DATE NOT NULL,
+            status SMALLINT NOT NULL,
+            orders_count INTEGER NOT NULL DEFAULT 0,
+            priced_count INTEGER NOT NULL DEFAULT 0, -- замовлення з вказаною ціною (для середньої ціни)
+            revenue NUMERIC(14, 2) NOT NULL DEFAULT 0,
+            PRIMARY KEY (day, status)
+        );
+    """)
+    tz = STATS_TIME_ZONE.replace("'", "''")
+    await conn.execute(f"""
+        CREATE OR REPLACE FUNCTION order_daily_stats_apply(p_created_at TIMESTAMPTZ, p_status SMALLINT, p_price NUMERIC, p_sign INTEGER)
+        RETURNS void AS $$
+        BEGIN
+            INSERT INTO order_daily_stats AS s (day, status, orders_count, priced_count, revenue)
+            VALUES ((p_created_at AT TIME ZONE '{tz}')::date, p_status, p_sign,
+                    CASE WHEN p_price IS NULL THEN 0 ELSE p_sign END, COALESCE(p_price, 0) * p_sign)
+            ON CONFLICT (day, status) DO UPDATE SET
+                orders_count = s.orders_count + EXCLUDED.orders_count,
+                priced_count = s.priced_count + EXCLUDED.priced_count,
+                revenue = s.revenue + EXCLUDED.revenue;
+        END;
+        $$ LANGUAGE plpgsql;
+
+        CREATE OR REPLACE FUNCTION order_daily_stats_trigger() RETURNS trigger AS $$
+        BEGIN
+            IF TG_OP = 'DELETE' AND current_setting('store.archiving', true) = 'on' THEN
+                RETURN NULL;
+            END IF;
+            IF TG_OP IN ('UPDATE', 'DELETE') THEN
+                PERFORM order_daily_stats_apply(OLD.created_at, OLD.status, OLD.price, -1);
+            END IF;
+            IF TG_OP IN ('INSERT', 'UPDATE') THEN
+                PERFORM order_daily_stats_apply(NEW.created_at, NEW.status, NEW.price, 1);
+            END IF;
+            RETURN NULL;
+        END;
+        $$ LANGUAGE plpgsql;
+
+        DROP TRIGGER IF EXISTS orders_daily_stats ON orders;
+        CREATE TRIGGER orders_daily_stats AFTER INSERT OR DELETE OR UPDATE OF status, price, created_at ON orders
+            FOR EACH ROW EXECUTE FUNCTION order_daily_stats_trigger();
+    """)
+    if not await conn.fetchval("SELECT EXISTS (SELECT 1 FROM order_daily_stats)"):
+        filled = await conn.execute(f"""
+            INSERT INTO order_daily_stats (day, status, orders_count, priced_count, revenue)
+            SELECT (created_at AT TIME ZONE '{tz}')::date, status, COUNT(*), COUNT(price), COALESCE(SUM(price), 0)
+            FROM (
+                SELECT status, price, created_at FROM orders
+                UNION ALL
+                SELECT status, price, created_at FROM orders_archive
+            ) all_orders
+            WHERE created_at IS NOT NULL
+            GROUP BY 1, 2
+        """)
+        logger.info(f"order_daily_stats заповнено з наявних замовлень ({filled.split()[-1]} рядків).")
+
+async def get_order_stats(days: int) -> list[Dict[str, Any]]:
+    """
+    Денні агрегати замовлень за останні days днів (включно з сьогоднішнім), новіші дні першими.
+    Кожен рядок: day, status, status_code, orders_count, priced_count, revenue, avg_price.
+    """
+    pool = await get_db_pool()
+    if pool is None:
+        logger.warning("Пул з'єднань БД не ініціалізовано. Неможливо отримати статистику замовлень.")
+        return []
+    async with pool.acquire() as conn:
+        try:
+            records = await conn.fetch("""
+                SELECT day, status, orders_count, priced_count, revenue
+                FROM order_daily_stats
+                WHERE day > (NOW() AT TIME ZONE $2)::date - $1::int AND orders_count <> 0
+                ORDER BY day DESC, status
+            """, days, STATS_TIME_ZONE)
+            rows = [_order_row(r) for r in records]
+            for row in rows:
+                row["avg_price"] = row["revenue"] / row["priced_count"] if row["priced_count"] else None
+            return rows
+        except Exception as e:
+            logger.error(f"Помилка при отриманні статистики замовлень: {e}")
+            return []
+
+# --- SLA ПІДТРИМКИ ---
+# support_dialogs - журнал діалогів: відкриття запиту (📦 Зробити запит/замовлення), закріплення за менеджером
+# (take_ або автопризначення) і завершення пишуться в тих самих транзакціях, що й зміни client_states.
+# Час першої відповіді менеджера та кількість повідомлень заповнює фонове завдання compute_support_dialog_metrics
+# одним запитом по client_messages. Після закриття діалогу метрики фіксуються (metrics_final),
+# тому кожен запуск обробляє лише відкриті та щойно закриті діалоги, а не всю історію.
+SLA_GROUPS = {
+    # Колонки групування для get_support_sla_stats; день і година тижня рахуються в STATS_TIME_ZONE
+    "day": ("(opened_at AT TIME ZONE '{tz}')::date AS day",),
+    "hour_of_week": (
+        "EXTRACT(ISODOW FROM opened_at AT TIME ZONE '{tz}')::int AS dow",
+        "EXTRACT(HOUR FROM opened_at AT TIME ZONE '{tz}')::int AS hour",
+    ),
+    "total": (),
+}
+
+async def _init_support_dialogs(conn):
+    await conn.execute("""
+        CREATE TABLE IF NOT EXISTS support_dialogs (
+            dialog_id BIGSERIAL PRIMARY KEY,
+            client_id BIGINT NOT NULL,
+            opened_at TIMESTAMP WITH TIME ZONE NOT NULL DEFAULT NOW(),
+            claimed_at TIMESTAMP WITH TIME ZONE NULL,
+            manager_id BIGINT NULL,
+            first_client_message_at TIMESTAMP WITH TIME ZONE NULL,
+            first_response_at TIMESTAMP WITH TIME ZONE NULL,
+            closed_at TIMESTAMP WITH TIME ZONE NULL,
+            message_count INTEGER NOT NULL DEFAULT 0,
+            metrics_final BOOLEAN NOT NULL DEFAULT FALSE
+        );
+        CREATE INDEX IF NOT EXISTS idx_support_dialogs_open ON support_dialogs (client_id) WHERE closed_at IS NULL;
+        CREATE INDEX IF NOT EXISTS idx_support_dialogs_pending ON support_dialogs (dialog_id) WHERE NOT metrics_final;
+        CREATE INDEX IF NOT EXISTS idx_support_dialogs_opened_at ON support_dialogs (opened_at);
+    """)
+
+async def _mark_support_dialog_claimed(conn, client_id: int, manager_id: int):
+    """Фіксує перше закріплення відкритого діалогу за менеджером (у транзакції закріплення)."""
+    await conn.execute("""
+        UPDATE support_dialogs SET claimed_at = NOW(), manager_id = $2
+        WHERE client_id = $1 AND closed_at IS NULL AND claimed_at IS NULL
+    """, client_id, manager_id)
+
+async def compute_support_dialog_metrics(batch_size: int, after_dialog_id: int = 0) -> tuple[int, int]:
+    """
+    Заповнює first_client_message_at, first_response_at і message_count для до batch_size діалогів
+    з dialog_id > after_dialog_id, метрики яких ще не зафіксовані.
+    Повертає (кількість оброблених діалогів, останній оброблений dialog_id) - курсор для наступної пачки.
+    """
+    await flush_client_messages()
+    pool = await get_db_pool()
+    if pool is None:
+        logger.warning("Пул з'єднань БД не ініціалізовано. Неможливо обчислити метрики діалогів.")
+        return 0, after_dialog_id
+    async with pool.acquire() as conn:
+        try:
+            # client_messages.timestamp зберігається без часового поясу (у поясі сесії), тому межі діалогу
+            # приводяться до timestamp - так запит використовує індекс (client_id, timestamp)
+            records = await conn.fetch("""
+                WITH pending AS (
+                    SELECT dialog_id, client_id, opened_at::timestamp AS opened_ts,
+                           COALESCE(closed_at, NOW())::timestamp AS closed_ts, closed_at IS NOT NULL AS is_closed
+                    FROM support_dialogs
+                    WHERE NOT metrics_final AND dialog_id > $2
+                    ORDER BY dialog_id
+                    LIMIT $1
+                ), computed AS (
+                    SELECT p.dialog_id, p.is_closed, m.first_client, m.first_response, m.message_count
+                    FROM pending p
+                    CROSS JOIN LATERAL (
+                        SELECT MIN(timestamp) FILTER (WHERE sender_type = 'client') AS first_client,
+                               MIN(timestamp) FILTER (WHERE sender_type = 'manager') AS first_response,
+                               COUNT(*) AS message_count
+                        FROM client_messages
+                        WHERE client_id = p.client_id AND timestamp >= p.opened_ts AND timestamp <= p.closed_ts
+                    ) m
+                )
+                UPDATE support_dialogs d SET
+                    first_client_message_at = c.first_client::timestamptz,
+                    first_response_at = c.first_response::timestamptz,
+                    message_count = c.message_count,
+                    metrics_final = c.is_closed
+                FROM computed c
+                WHERE d.dialog_id = c.dialog_id
+                RETURNING d.dialog_id
+            """, batch_size, after_dialog_id)
+            return len(records), max((r["dialog_id"] for r in records), default=after_dialog_id)
+        except Exception as e:
+            logger.error(f"Помилка при обчисленні метрик діалогів підтримки: {e}")
+            return 0, after_dialog_id
+
+async def get_support_sla_stats(days: int, group_by: str = "day") -> list[Dict[str, Any]]:
+    """
+    Перцентилі SLA для діалогів, відкритих за останні days днів, згруповані за group_by
+    ("day", "hour_of_week" - dow 1..7 та hour 0..23, або "total").
+    Для кожної групи: dialogs, unanswered (закриті без відповіді менеджера) і p50/p90 у секундах для
+    claim (очікування закріплення), first_response (очікування першої відповіді) та duration (тривалість діалогу).
+    """
+    tz = STATS_TIME_ZONE.replace("'", "''")
+    keys = [key.format(tz=tz) for key in SLA_GROUPS[group_by]]
+    positions = ", ".join(str(i + 1) for i in range(len(keys)))
+    group_clause = f"GROUP BY {positions} ORDER BY {positions}" if keys else ""
+    pool = await get_db_pool()
+    if pool is None:
+        logger.warning("Пул з'єднань БД не ініціалізовано. Неможливо отримати SLA статистику.")
+        return []
+    percentiles = ", ".join(
+        f"percentile_cont({q}) WITHIN GROUP (ORDER BY EXTRACT(EPOCH FROM {end} - opened_at))::float8 AS {name}_p{int(q * 100)}"
+        for name, end in (("claim", "claimed_at"), ("first_response", "first_response_at"), ("duration", "closed_at"))
+        for q in (0.5, 0.9)
+    )
+    async with pool.acquire() as conn:
+        try:
+            records = await conn.fetch(f"""
+                SELECT {"".join(key + ", " for key in keys)}
+                       COUNT(*) AS dialogs,
+                       COUNT(*) FILTER (WHERE metrics_final AND first_response_at IS NULL) AS unanswered,
+                       {percentiles}
+                FROM support_dialogs
+                WHERE opened_at >= NOW() - make_interval(days => $1)
+                {group_clause}
+            """, days)
+            return [dict(r) for r in records]
+        except Exception as e:
+            logger.error(f"Помилка при отриманні SLA статистики: {e}")
+            return []
+
+# --- ПОШУК ДЛЯ МЕНЕДЖЕРІВ (pg_trgm) ---
+# Нечіткий пошук за описом замовлення та текстом повідомлень через триграмні GIN-індекси.
+# Оператор <% (word_similarity) знаходить запит як частину довшого тексту і терпить одруківки
+# (наприклад, "пасат" знайде "Пассат"); поріг схожості задає SEARCH_SIMILARITY_THRESHOLD.
+# Стиснені архіви завершених діалогів (dialog_archives) у пошук не потрапляють.
+SEARCH_SIMILARITY_THRESHOLD = float(os.getenv("SEARCH_SIMILARITY_THRESHOLD", 0.5))
+SEARCH_TIMEOUT_MS = int(os.getenv("SEARCH_TIMEOUT_MS", 2000))
+
+async def _init_search_indexes(conn):
+    """Вмикає pg_trgm і створює триграмні індекси. Без розширення пошук вимкнено, решта схеми працює."""
+    try:
+        # Точка збереження: помилка прав на CREATE EXTENSION не повинна скасувати транзакцію init_tables
+        async with conn.transaction():
+            await conn.execute("CREATE EXTENSION IF NOT EXISTS pg_trgm;")
+    except Exception as e:
+        logger.warning(f"Розширення pg_trgm недоступне, пошук замовлень і повідомлень вимкнено: {e}")
         return
+    # Індекс на секціонованій client_messages створюється на кожній секції, в т.ч. майбутніх
+    await conn.execute("""
+        CREATE INDEX IF NOT EXISTS idx_orders_description_trgm ON orders USING gin (description gin_trgm_ops);
+        CREATE INDEX IF NOT EXISTS idx_orders_archive_description_trgm ON orders_archive USING gin (description gin_trgm_ops);
+        CREATE INDEX IF NOT EXISTS idx_client_messages_text_trgm ON client_messages USING gin (message_text gin_trgm_ops);
+    """)
+
+async def _prepare_search(conn):
+    """Налаштування пошуку в межах поточної транзакції (SET LOCAL, сумісно з пулером у transaction mode)."""
+    await conn.execute(
+        "SELECT set_config('pg_trgm.word_similarity_threshold', $1, true), set_config('statement_timeout', $2, true)",
+        str(SEARCH_SIMILARITY_THRESHOLD), str(SEARCH_TIMEOUT_MS)
+    )
+
+async def search_orders(query: str, limit: int, offset: int = 0) -> list[Dict[str, Any]]:
+    """
+    Шукає замовлення (включно з архівними) за описом. Результати впорядковані за схожістю (score),
+    потім новіші першими; limit/offset задають сторінку.
+    """
+    pool = await get_db_pool()
+    if pool is None:
+        logger.warning("Пул з'єднань БД не ініціалізовано. Неможливо виконати пошук замовлень.")
+        return []
     async with pool.acquire() as conn:
         try:
-            await conn.execute("""
-                INSERT INTO client_messages (client_id, sender_type, message_text)
-                VALUES ($1, $2, $3)
-            """, client_id, sender_type, message_text)
-            logger.info(f"Повідомлення для клієнта {client_id} додано.")
+            async with conn.transaction():
+                await _prepare_search(conn)
+                records = await conn.fetch("""
+                    SELECT order_id, client_id, status, price, description, created_at, score
+                    FROM (
+                        SELECT order_id, client_id, status, price, description, created_at,
+                               word_similarity($1, description) AS score
+                        FROM orders WHERE $1 <% description
+                        UNION ALL
+                        SELECT order_id, client_id, status, price, description, created_at,
+                               word_similarity($1, description) AS score
+                        FROM orders_archive WHERE $1 <% description
+                    ) found
+                    ORDER BY score DESC, created_at DESC
+                    LIMIT $2 OFFSET $3
+                """, query, limit, offset)
+            return [_order_row(r) for r in records]
         except Exception as e:
-            logger.error(f"Помилка при додаванні повідомлення для клієнта {client_id}: {e}")
+            logger.error(f"Помилка при пошуку замовлень за запитом '{query}': {e}")
+            return []
 
-async def get_client_messages(client_id: int):
-    """Повертає всі повідомлення для певного клієнта."""
+async def search_client_messages(query: str, limit: int, offset: int = 0) -> list[Dict[str, Any]]:
+    """
+    Шукає повідомлення діалогів за текстом. Результати впорядковані за схожістю (score),
+    потім новіші першими; limit/offset задають сторінку.
+    """
+    await flush_client_messages()
     pool = await get_db_pool()
     if pool is None:
-        logger.warning("Пул з'єднань БД не ініціалізовано. Неможливо отримати повідомлення клієнта.")
+        logger.warning("Пул з'єднань БД не ініціалізовано. Неможливо виконати пошук повідомлень.")
         return []
     async with pool.acquire() as conn:
         try:
-            records = await conn.fetch("SELECT sender_type, message_text, timestamp FROM client_messages WHERE client_id = $1 ORDER BY timestamp ASC", client_id)
+            async with conn.transaction():
+                await _prepare_search(conn)
+                records = await conn.fetch("""
+                    SELECT client_id, sender_type, message_text, timestamp,
+                           word_similarity($1, message_text) AS score
+                    FROM client_messages
+                    WHERE $1 <% message_text
+                    ORDER BY score DESC, timestamp DESC
+                    LIMIT $2 OFFSET $3
+                """, query, limit, offset)
             return [dict(r) for r in records]
         except Exception as e:
-            logger.error(f"Помилка при отриманні повідомлень для клієнта {client_id}: {e}")
+            logger.error(f"Помилка при пошуку повідомлень за запитом '{query}': {e}")
             return []
 
+def _orders_dataframe(rows: list[Dict[str, Any]]) -> pd.DataFrame:
+    df = pd.DataFrame(rows)
+    # Excel не підтримує дати з часовою зоною
+    for column in ("created_at", "updated_at"):
+        if column in df:
+            df[column] = pd.to_datetime(df[column], utc=True).dt.tz_localize(None)
+    return df
+
 async def export_orders_to_excel():
     """Експортує всі замовлення в Excel файл."""
     pool = await get_db_pool()
@@ -451,15 +2050,15 @@ async def export_orders_to_excel():
         return None
     async with pool.acquire() as conn:
         try:
-            records = await conn.fetch("SELECT order_id, client_id, status, price, description, created_at FROM orders")
+            records = await conn.fetch("SELECT order_id, client_id, status, price, description, created_at, updated_at FROM orders")
             
-            data = [dict(r) for r in records]
+            data = [_order_row(r) for r in records]
             
             if not data:
                 logger.info("Немає даних для експорту.")
                 return None
 
-            df = pd.DataFrame(data)
+            df = _orders_dataframe(data)
             file_path = "orders_export.xlsx"
             df.to_excel(file_path, index=False)
             logger.info(f"Дані замовлень експортовано до {file_path}.")
@@ -468,6 +2067,69 @@ async def export_orders_to_excel():
             logger.error(f"Помилка при експорті замовлень в Excel: {e}")
             return None
 
+# --- ІНКРЕМЕНТАЛЬНИЙ ЕКСПОРТ ЗАМОВЛЕНЬ ---
+# Кожен менеджер має власну позначку exported_until: експорт змін вибирає лише рядки з
+# exported_until < updated_at <= нова позначка (діапазон по індексу idx_orders_updated_at), тому його час
+# залежить від кількості змін, а не від розміру історії. Нова позначка відстає від NOW() на
+# EXPORT_WATERMARK_LAG_SECONDS, щоб зміни транзакцій, які ще не закомітились, потрапили в наступний експорт.
+# Позначка зсувається (commit_export_watermark) лише після успішної відправки файлу.
+EXPORT_WATERMARK_LAG_SECONDS = 5
+
+async def export_order_changes_to_excel(manager_id: int) -> tuple[Optional[str], Optional[datetime]]:
+    """
+    Експортує в Excel замовлення, створені або змінені після попереднього експорту менеджера manager_id
+    (при першому експорті - всі). Повертає (шлях до файлу або None, якщо змін немає; нова позначка).
+    При помилці повертає (None, None).
+    """
+    pool = await get_db_pool()
+    if pool is None:
+        logger.warning("Пул з'єднань БД не ініціалізовано. Неможливо експортувати зміни замовлень.")
+        return None, None
+    async with pool.acquire() as conn:
+        try:
+            since = await conn.fetchval("SELECT exported_until FROM export_watermarks WHERE manager_id = $1", manager_id)
+            until = await conn.fetchval("SELECT NOW() - make_interval(secs => $1)", EXPORT_WATERMARK_LAG_SECONDS)
+            records = await conn.fetch("""
+                SELECT order_id, client_id, status, price, description, created_at, updated_at,
+                       ($1::timestamptz IS NULL OR created_at > $1) AS is_new
+                FROM orders
+                WHERE ($1::timestamptz IS NULL OR updated_at > $1) AND updated_at <= $2
+                ORDER BY updated_at
+            """, since, until)
+            if not records:
+                logger.info(f"Немає змін замовлень для експорту менеджеру {manager_id}.")
+                return None, until
+            rows = []
+            for r in records:
+                row = _order_row(r)
+                row["is_new"] = "нове" if row["is_new"] else "змінене"
+                rows.append(row)
+            file_path = f"orders_changes_{manager_id}.xlsx"
+            _orders_dataframe(rows).to_excel(file_path, index=False)
+            logger.info(f"Експортовано {len(rows)} змінених замовлень для менеджера {manager_id} до {file_path}.")
+            return file_path, until
+        except Exception as e:
+            logger.error(f"Помилка при експорті змін замовлень для менеджера {manager_id}: {e}")
+            return None, None
+
+async def commit_export_watermark(manager_id: int, exported_until: datetime):
+    """Запам'ятовує, що менеджер manager_id отримав усі зміни замовлень до exported_until."""
+    pool = await get_db_pool()
+    if pool is None:
+        logger.warning("Пул з'єднань БД не ініціалізовано. Неможливо зберегти позначку експорту.")
+        return
+    async with pool.acquire() as conn:
+        try:
+            await conn.execute("""
+                INSERT INTO export_watermarks (manager_id, exported_until, updated_at)
+                VALUES ($1, $2, NOW())
+                ON CONFLICT (manager_id) DO UPDATE SET
+                    exported_until = GREATEST(export_watermarks.exported_until, EXCLUDED.exported_until),
+                    updated_at = NOW()
+            """, manager_id, exported_until)
+        except Exception as e:
+            logger.error(f"Помилка при збереженні позначки експорту менеджера {manager_id}: {e}")
+
 async def close_db_pool():
     """Закриває пул з'єднань asyncpg."""
     global _pool
@@ -540,6 +2202,24 @@ async def update_bonus_balance(telegram_user_id: int, amount: float) -> bool:
             logger.error(f"Помилка при оновленні балансу бонусів для TG ID {telegram_user_id}: {e}")
             return False
 
+async def set_bonus_balance(telegram_user_id: int, new_balance: float) -> bool:
+    """Встановлює абсолютне значення балансу бонусів для клієнта."""
+    pool = await get_db_pool()
+    if pool is None:
+        logger.warning("Пул з'єднань БД не ініціалізовано. Неможливо встановити баланс бонусів.")
+        return False
+    async with pool.acquire() as conn:
+        try:
+            await conn.execute(
+                "UPDATE bonus_accounts SET bonus_balance = $2, last_updated = NOW() WHERE telegram_user_id = $1;",
+                telegram_user_id, new_balance
+            )
+            logger.info(f"Встановлено баланс бонусів для TG ID: {telegram_user_id} на {new_balance}.")
+            return True
+        except Exception as e:
+            logger.error(f"Помилка при встановленні балансу бонусів для TG ID {telegram_user_id}: {e}")
+            return False
+
 async def get_bonus_code_details(code: str) -> Optional[Dict[str, Any]]:
     """Отримує деталі бонусного коду за його значенням."""
     pool = await get_db_pool()
@@ -640,21 +2320,67 @@ async def get_client_orders(client_id: int) -> list[Dict[str, Any]]:
     """
     pool = await get_db_pool()
     if pool is None:
+        found, orders = _recall("client_orders", client_id)
+        if found:
+            return [dict(order) for order in orders]
         logger.warning("Пул з'єднань БД не ініціалізовано. Неможливо отримати замовлення клієнта.")
         return []
     async with pool.acquire() as conn:
         try:
+            # Давно виконані замовлення лежать в orders_archive, але клієнт має бачити всю історію
             records = await conn.fetch("""
                 SELECT order_id, status, created_at, price, description
                 FROM orders
                 WHERE client_id = $1
+                UNION ALL
+                SELECT order_id, status, created_at, price, description
+                FROM orders_archive
+                WHERE client_id = $1
                 ORDER BY created_at DESC;
             """, client_id)
-            return [dict(r) for r in records]
+            orders = [_order_row(r) for r in records]
+            _remember("client_orders", client_id, orders)
+            return [dict(order) for order in orders]
         except Exception as e:
             logger.error(f"Помилка при отриманні замовлень для клієнта {client_id}: {e}")
             return []
 
+async def archive_completed_orders(older_than_days: int, batch_size: int) -> int:
+    """
+    Переносить до batch_size виконаних замовлень, створених понад older_than_days днів тому,
+    з orders в orders_archive. Повертає кількість перенесених замовлень.
+    """
+    pool = await get_db_pool()
+    if pool is None:
+        logger.warning("Пул з'єднань БД не ініціалізовано. Неможливо архівувати замовлення.")
+        return 0
+    async with pool.acquire() as conn:
+        try:
+            async with conn.transaction():
+                # Перенесення в архів не є видаленням замовлення: тригер статистики його пропускає
+                await conn.execute("SELECT set_config('store.archiving', 'on', true)")
+                result = await conn.execute(f"""
+                    WITH moved AS (
+                        DELETE FROM orders
+                        WHERE order_id IN (
+                            SELECT order_id FROM orders
+                            WHERE status = {COMPLETED}
+                              AND created_at < NOW() - make_interval(days => $1)
+                            ORDER BY created_at
+                            LIMIT $2
+                            FOR UPDATE SKIP LOCKED
+                        )
+                        RETURNING order_id, client_id, status, price, description, created_at
+                    )
+                    INSERT INTO orders_archive (order_id, client_id, status, price, description, created_at)
+                    SELECT order_id, client_id, status, price, description, created_at FROM moved
+                    ON CONFLICT (order_id) DO NOTHING
+                """, older_than_days, batch_size)
+            return int(result.split()[-1])
+        except Exception as e:
+            logger.error(f"Помилка при архівуванні виконаних замовлень: {e}")
+            return 0
+
 async def get_all_active_orders() -> list[Dict[str, Any]]:
     """
     Повертає всі замовлення, статус яких НЕ "✅ Замовлення виконано",
@@ -666,19 +2392,272 @@ async def get_all_active_orders() -> list[Dict[str, Any]]:
         return []
     async with pool.acquire() as conn:
         try:
-            records = await conn.fetch("""
+            # Умова збігається з предикатом idx_orders_active: індекс дає лише невиконані замовлення в потрібному
+            # порядку, а description дочитується з таблиці
+            records = await conn.fetch(f"""
                 SELECT order_id, client_id, status, price, description, created_at
                 FROM orders
-                WHERE status != '✅ Замовлення виконано'
+                WHERE status <> {COMPLETED}
                 ORDER BY created_at DESC;
             """)
             logger.info(f"get_all_active_orders: Знайдено {len(records)} активних замовлень.")
-            for r in records:
-                logger.info(f"Активне замовлення: ID={r['order_id']}, Status='{r['status']}'") # Оновлено логування
-            return [dict(r) for r in records]
+            orders = [_order_row(r) for r in records]
+            for o in orders:
+                logger.info(f"Активне замовлення: ID={o['order_id']}, Status='{o['status']}'") # Оновлено логування
+            return orders
         except Exception as e:
             logger.error(f"Помилка при отриманні всіх активних замовлень: {e}")
             return []
 
+# 🔥 ФУНКЦІЇ ДЛЯ ЗБЕРЕЖЕННЯ context.user_data (persistence.py) 🔥
+
+async def get_persisted_user_data(user_id: int) -> Optional[str]:
+    """Повертає збережений user_data користувача як JSON-рядок, або None, якщо запису немає."""
+    pool = await get_db_pool()
+    if pool is None:
+        logger.warning("Пул з'єднань БД не ініціалізовано. Неможливо отримати user_data.")
+        return None
+    async with pool.acquire() as conn:
+        try:
+            return await conn.fetchval("SELECT data::text FROM bot_user_data WHERE user_id = $1", user_id)
+        except Exception as e:
+            logger.error(f"Помилка при отриманні user_data для користувача {user_id}: {e}")
+            return None
+
+async def save_user_data_batch(rows: list[tuple[int, str]]) -> bool:
+    """
+    Зберігає пачку user_data одним executemany.
+    rows — список пар (user_id, JSON-рядок).
+    """
+    if not rows:
+        return True
+    pool = await get_db_pool()
+    if pool is None:
+        logger.warning("Пул з'єднань БД не ініціалізовано. Неможливо зберегти user_data.")
+        return False
+    async with pool.acquire() as conn:
+        try:
+            await conn.executemany("""
+                INSERT INTO bot_user_data (user_id, data, updated_at)
+                VALUES ($1, $2::jsonb, NOW())
+                ON CONFLICT (user_id) DO UPDATE SET
+                    data = EXCLUDED.data,
+                    updated_at = NOW()
+            """, rows)
+            await _notify_invalidation(conn, "user_data", *[user_id for user_id, _ in rows])
+            logger.info(f"Збережено user_data для {len(rows)} користувачів.")
+            return True
+        except Exception as e:
+            logger.error(f"Помилка при збереженні пачки user_data ({len(rows)} записів): {e}")
+            return False
+
+async def delete_persisted_user_data(user_id: int):
+    """Видаляє збережений user_data користувача."""
+    pool = await get_db_pool()
+    if pool is None:
+        logger.warning("Пул з'єднань БД не ініціалізовано. Неможливо видалити user_data.")
+        return
+    async with pool.acquire() as conn:
+        try:
+            await conn.execute("DELETE FROM bot_user_data WHERE user_id = $1", user_id)
+            await _notify_invalidation(conn, "user_data", user_id)
+            logger.info(f"user_data користувача {user_id} видалено.")
+        except Exception as e:
+            logger.error(f"Помилка при видаленні user_data користувача {user_id}: {e}")
+
+# 🔥 ФУНКЦІЇ ДЛЯ МАРШРУТИЗАЦІЇ ВІДПОВІДЕЙ МЕНЕДЖЕРА (REPLY) 🔥
+
+# Зв'язка (manager_id, message_id) -> client_id ніколи не змінюється, тому кешується без інвалідації
+FORWARDED_CACHE_SIZE = int(os.getenv("FORWARDED_CACHE_SIZE", 10000))
+_forwarded_cache: "OrderedDict[tuple[int, int], int]" = OrderedDict()
+
+def _forwarded_cache_put(manager_id: int, message_id: int, client_id: int):
+    _forwarded_cache[(manager_id, message_id)] = client_id
+    _forwarded_cache.move_to_end((manager_id, message_id))
+    if len(_forwarded_cache) > FORWARDED_CACHE_SIZE:
+        _forwarded_cache.popitem(last=False)
+
+@_deferrable()
+async def add_forwarded_message(manager_id: int, message_id: int, client_id: int):
+    """Запам'ятовує, що повідомлення message_id у чаті менеджера належить діалогу з client_id."""
+    _forwarded_cache_put(manager_id, message_id, client_id)
+    pool = await get_db_pool()
+    if pool is None:
+        logger.warning("Пул з'єднань БД не ініціалізовано. Неможливо зберегти зв'язку пересланого повідомлення.")
+        return False
+    async with pool.acquire() as conn:
+        try:
+            await conn.execute("""
+                INSERT INTO forwarded_messages (manager_id, message_id, client_id)
+                VALUES ($1, $2, $3)
+                ON CONFLICT (manager_id, message_id) DO NOTHING
+            """, manager_id, message_id, client_id)
+            return True
+        except Exception as e:
+            logger.error(f"Помилка при збереженні зв'язки повідомлення {message_id} менеджера {manager_id}: {e}")
+            return False
+
+async def get_forwarded_message_client(manager_id: int, message_id: int) -> Optional[int]:
+    """Повертає client_id, якому належить повідомлення message_id у чаті менеджера, або None."""
+    cached = _forwarded_cache.get((manager_id, message_id))
+    if cached is not None:
+        _forwarded_cache.move_to_end((manager_id, message_id))
+        return cached
+    pool = await get_db_pool()
+    if pool is None:
+        logger.warning("Пул з'єднань БД не ініціалізовано. Неможливо отримати зв'язку пересланого повідомлення.")
+        return None
+    async with pool.acquire() as conn:
+        try:
+            client_id = await conn.fetchval(
+                "SELECT client_id FROM forwarded_messages WHERE manager_id = $1 AND message_id = $2",
+                manager_id, message_id
+            )
+            if client_id is not None:
+                _forwarded_cache_put(manager_id, message_id, client_id)
+            return client_id
+        except Exception as e:
+            logger.error(f"Помилка при отриманні зв'язки повідомлення {message_id} менеджера {manager_id}: {e}")
+            return None
+
+async def purge_forwarded_messages(older_than_days: int) -> int:
+    """Видаляє зв'язки пересланих повідомлень, старші за older_than_days днів. Повертає кількість видалених."""
+    pool = await get_db_pool()
+    if pool is None:
+        logger.warning("Пул з'єднань БД не ініціалізовано. Неможливо очистити зв'язки пересланих повідомлень.")
+        return 0
+    async with pool.acquire() as conn:
+        try:
+            result = await conn.execute(
+                "DELETE FROM forwarded_messages WHERE created_at < NOW() - make_interval(days => $1)",
+                older_than_days
+            )
+            deleted = int(result.split()[-1])
+            logger.info(f"Видалено {deleted} застарілих зв'язок пересланих повідомлень.")
+            return deleted
+        except Exception as e:
+            logger.error(f"Помилка при очищенні зв'язок пересланих повідомлень: {e}")
+            return 0
+
+# 🔥 ФУНКЦІЇ ДЛЯ ІДЕМПОТЕНТНОЇ ОБРОБКИ ОНОВЛЕНЬ TELEGRAM 🔥
+
+async def claim_update(update_id: int) -> bool:
+    """
+    Позначає update_id як оброблений. Повертає True, якщо оновлення ще не оброблялось
+    (цей процес має його обробити), і False для повторної доставки.
+    Якщо БД недоступна, повертає True: краще обробити оновлення, ніж втратити його.
+    """
+    pool = await get_db_pool()
+    if pool is None:
+        logger.warning("Пул з'єднань БД не ініціалізовано. Оновлення обробляється без перевірки на дублікати.")
+        return True
+    async with pool.acquire() as conn:
+        try:
+            claimed = await conn.fetchval("""
+                INSERT INTO processed_updates (update_id) VALUES ($1)
+                ON CONFLICT (update_id) DO NOTHING
+                RETURNING update_id
+            """, update_id)
+            return claimed is not None
+        except Exception as e:
+            logger.error(f"Помилка при позначенні оновлення {update_id} як обробленого: {e}")
+            return True
+
+async def record_processed_updates(update_ids: list[int]) -> bool:
+    """Позначає пачку update_id як оброблені одним запитом. Повертає True при успіху."""
+    if not update_ids:
+        return True
+    pool = await get_db_pool()
+    if pool is None:
+        logger.warning(f"Пул з'єднань БД не ініціалізовано. {len(update_ids)} оброблених оновлень не позначено.")
+        return False
+    async with pool.acquire() as conn:
+        try:
+            await conn.execute("""
+                INSERT INTO processed_updates (update_id)
+                SELECT unnest($1::bigint[])
+                ON CONFLICT (update_id) DO NOTHING
+            """, update_ids)
+            return True
+        except Exception as e:
+            logger.error(f"Помилка при позначенні {len(update_ids)} оновлень як оброблених: {e}")
+            return False
+
+async def get_recent_processed_updates(limit: int) -> list[int]:
+    """Повертає до limit найбільших оброблених update_id (для відновлення вікна дублікатів після перезапуску)."""
+    pool = await get_db_pool()
+    if pool is None:
+        logger.warning("Пул з'єднань БД не ініціалізовано. Неможливо отримати оброблені оновлення.")
+        return []
+    async with pool.acquire() as conn:
+        try:
+            records = await conn.fetch(
+                "SELECT update_id FROM processed_updates ORDER BY update_id DESC LIMIT $1", limit
+            )
+            return [r["update_id"] for r in reversed(records)]
+        except Exception as e:
+            logger.error(f"Помилка при отриманні оброблених оновлень: {e}")
+            return []
+
+async def release_update(update_id: int):
+    """Знімає позначку з update_id, щоб Telegram міг доставити оновлення повторно (після помилки обробки)."""
+    pool = await get_db_pool()
+    if pool is None:
+        return
+    async with pool.acquire() as conn:
+        try:
+            await conn.execute("DELETE FROM processed_updates WHERE update_id = $1", update_id)
+        except Exception as e:
+            logger.error(f"Помилка при знятті позначки з оновлення {update_id}: {e}")
+
+async def get_polling_offset(bot_id: int) -> Optional[int]:
+    """Повертає збережений offset getUpdates для бота bot_id або None, якщо polling ще не запускався."""
+    pool = await get_db_pool()
+    if pool is None:
+        logger.warning("Пул з'єднань БД не ініціалізовано. Неможливо отримати offset getUpdates.")
+        return None
+    async with pool.acquire() as conn:
+        try:
+            return await conn.fetchval("SELECT next_offset FROM polling_offsets WHERE bot_id = $1", bot_id)
+        except Exception as e:
+            logger.error(f"Помилка при отриманні offset getUpdates для бота {bot_id}: {e}")
+            return None
 
+async def save_polling_offset(bot_id: int, next_offset: int) -> bool:
+    """Зберігає offset getUpdates (update_id наступного необробленого оновлення). Повертає True при успіху."""
+    pool = await get_db_pool()
+    if pool is None:
+        logger.warning("Пул з'єднань БД не ініціалізовано. Неможливо зберегти offset getUpdates.")
+        return False
+    async with pool.acquire() as conn:
+        try:
+            await conn.execute("""
+                INSERT INTO polling_offsets (bot_id, next_offset, updated_at)
+                VALUES ($1, $2, NOW())
+                ON CONFLICT (bot_id) DO UPDATE SET
+                    next_offset = GREATEST(polling_offsets.next_offset, EXCLUDED.next_offset),
+                    updated_at = NOW()
+            """, bot_id, next_offset)
+            return True
+        except Exception as e:
+            logger.error(f"Помилка при збереженні offset getUpdates для бота {bot_id}: {e}")
+            return False
 
+async def purge_processed_updates(older_than_hours: int) -> int:
+    """Видаляє записи про оброблені оновлення, старші за older_than_hours годин. Повертає кількість видалених."""
+    pool = await get_db_pool()
+    if pool is None:
+        logger.warning("Пул з'єднань БД не ініціалізовано. Неможливо очистити оброблені оновлення.")
+        return 0
+    async with pool.acquire() as conn:
+        try:
+            result = await conn.execute(
+                "DELETE FROM processed_updates WHERE processed_at < NOW() - make_interval(hours => $1)",
+                older_than_hours
+            )
+            deleted = int(result.split()[-1])
+            logger.info(f"Видалено {deleted} застарілих записів про оброблені оновлення.")
+            return deleted
+        except Exception as e:
+            logger.error(f"Помилка при очищенні оброблених оновлень: {e}")
+            return 0
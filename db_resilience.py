@@ -0,0 +1,217 @@
+import os
+import time
+import random
+import asyncio
+import logging
+from contextvars import ContextVar
+from typing import Callable, Optional
+
+import asyncpg
+
+logger = logging.getLogger(__name__)
+
+# Стійкість до збоїв БД (використовується в db.py).
+#
+# Помилки класифікуються:
+#   - RETRYABLE: транзакцію відкочено сервером (серіалізація, deadlock, блокування) - запит можна безпечно
+#     повторити на тому самому з'єднанні, якщо він виконувався поза явною транзакцією;
+#   - CONNECTION: БД або пулер недоступні (з'єднання не встановлено / розірвано / таймаут) - рахується
+#     запобіжником; отримання з'єднання з пулу повторюється, а перерваний запит - ні (невідомо, чи виконався він);
+#   - PERMANENT: помилки даних і запитів - повертаються одразу.
+# Повтори мають експоненційну затримку з випадковим розкидом (full jitter), щоб воркери не били в БД одночасно.
+#
+# Запобіжник (circuit breaker): після DB_BREAKER_FAILURES помилок з'єднання поспіль він "відкривається", і
+# протягом DB_BREAKER_RESET_SECONDS запити до БД не виконуються взагалі - функції db.py одразу повертають
+# свої резервні значення замість очікування таймауту з'єднання. Потім один пробний запит (half-open)
+# вирішує, чи закрити запобіжник, чи знову відкрити.
+
+DB_RETRY_ATTEMPTS = int(os.getenv("DB_RETRY_ATTEMPTS", 3))
+DB_RETRY_BASE_DELAY = float(os.getenv("DB_RETRY_BASE_DELAY", 0.1))
+DB_RETRY_MAX_DELAY = 2.0
+DB_BREAKER_FAILURES = int(os.getenv("DB_BREAKER_FAILURES", 5))
+DB_BREAKER_RESET_SECONDS = float(os.getenv("DB_BREAKER_RESET_SECONDS", 30))
+
+RETRYABLE = "retryable"
+CONNECTION = "connection"
+PERMANENT = "permanent"
+
+# serialization_failure, deadlock_detected, lock_not_available
+_RETRYABLE_SQLSTATES = {"40001", "40P01", "55P03"}
+# connection_exception (08...), admin/crash shutdown, cannot_connect_now, too_many_connections
+_CONNECTION_SQLSTATES = {"57P01", "57P02", "57P03", "53300"}
+
+# Чи була помилка з'єднання під час звернень до БД у поточній задачі з моменту reset_connection_failed().
+# Функції db.py ловлять винятки самі й повертають False, тож так відрізняється "БД недоступна" від "запит відхилено"
+_connection_failed: ContextVar[bool] = ContextVar("db_connection_failed", default=False)
+
+def reset_connection_failed():
+    _connection_failed.set(False)
+
+def connection_failed() -> bool:
+    return _connection_failed.get()
+
+def classify_error(error: BaseException) -> str:
+    """Клас помилки для рішення про повтор і для запобіжника."""
+    sqlstate = getattr(error, "sqlstate", None)
+    if sqlstate in _RETRYABLE_SQLSTATES:
+        return RETRYABLE
+    if sqlstate in _CONNECTION_SQLSTATES or (sqlstate or "").startswith("08"):
+        return CONNECTION
+    if isinstance(error, (OSError, asyncio.TimeoutError, asyncpg.exceptions.ConnectionDoesNotExistError)):
+        # Розрив сокета, таймаут підключення, з'єднання закрите посеред запиту.
+        # Інші InterfaceError (зокрема DataError - некоректні параметри) - помилки запиту, а не БД
+        return CONNECTION
+    return PERMANENT
+
+def backoff_delay(attempt: int) -> float:
+    """Затримка перед повтором attempt (1, 2, ...): випадкова в межах експоненційно зростаючої стелі."""
+    return random.uniform(0, min(DB_RETRY_MAX_DELAY, DB_RETRY_BASE_DELAY * 2 ** (attempt - 1)))
+
+class CircuitBreaker:
+    """Запобіжник: closed -> open (після failure_threshold помилок поспіль) -> half_open (пробний запит) -> closed."""
+
+    CLOSED = "closed"
+    OPEN = "open"
+    HALF_OPEN = "half_open"
+
+    def __init__(self, failure_threshold: int, reset_seconds: float):
+        self.failure_threshold = failure_threshold
+        self.reset_seconds = reset_seconds
+        self.state = self.CLOSED
+        self.failures = 0
+        self.opened_at = 0.0
+        self.times_opened = 0
+        self._probe_started = 0.0
+        self._on_close: list[Callable[[], None]] = []
+
+    def on_close(self, callback: Callable[[], None]):
+        """Реєструє callback(), який викликається, коли БД знову доступна (запобіжник закрився)."""
+        self._on_close.append(callback)
+
+    def allow_request(self) -> bool:
+        """Чи можна зараз звертатися до БД. У стані half_open дозволяється лише один пробний запит."""
+        if self.state == self.CLOSED:
+            return True
+        if self.state == self.OPEN:
+            if time.monotonic() - self.opened_at < self.reset_seconds:
+                return False
+            self.state = self.HALF_OPEN
+            self._probe_started = 0.0
+            logger.info("Запобіжник БД: пробний запит після паузи.")
+        now = time.monotonic()
+        # Пробний запит, який так і не дійшов до БД (виклик обірвався раніше), не блокує наступну спробу
+        if now - self._probe_started < self.reset_seconds:
+            return False
+        self._probe_started = now
+        return True
+
+    def record_success(self):
+        self.failures = 0
+        if self.state != self.CLOSED:
+            self.state = self.CLOSED
+            logger.info("Запобіжник БД закрито: з'єднання відновлено.")
+            for callback in self._on_close:
+                try:
+                    callback()
+                except Exception as e:
+                    logger.error(f"Помилка в колбеку відновлення БД: {e}")
+
+    def record_failure(self):
+        self.failures += 1
+        _connection_failed.set(True)
+        if self.state == self.HALF_OPEN or (self.state == self.CLOSED and self.failures >= self.failure_threshold):
+            self.state = self.OPEN
+            self.opened_at = time.monotonic()
+            self.times_opened += 1
+            logger.error(f"Запобіжник БД відкрито після {self.failures} помилок з'єднання: "
+                         f"запити до БД призупинено на {self.reset_seconds:g} с.")
+
+    @property
+    def is_open(self) -> bool:
+        """БД вважається недоступною (відкритий запобіжник, пробний запит ще не вдався)."""
+        return self.state != self.CLOSED
+
+class ResilientConnection:
+    """Обгортка з'єднання asyncpg: повтори RETRYABLE-помилок поза транзакцією та облік помилок запобіжником."""
+
+    __slots__ = ("_conn", "_breaker")
+
+    def __init__(self, conn, breaker: CircuitBreaker):
+        self._conn = conn
+        self._breaker = breaker
+
+    def __getattr__(self, name):
+        return getattr(self._conn, name)
+
+    async def _run(self, method: str, args, kwargs):
+        for attempt in range(1, DB_RETRY_ATTEMPTS + 1):
+            try:
+                result = await getattr(self._conn, method)(*args, **kwargs)
+            except Exception as e:
+                kind = classify_error(e)
+                if kind == CONNECTION:
+                    self._breaker.record_failure()
+                elif kind == PERMANENT and isinstance(e, asyncpg.PostgresError):
+                    self._breaker.record_success() # БД відповіла, помилка в самому запиті
+                if kind != RETRYABLE or self._conn.is_in_transaction() or attempt == DB_RETRY_ATTEMPTS:
+                    raise
+                delay = backoff_delay(attempt)
+                logger.warning(f"Тимчасова помилка БД ({e.__class__.__name__}), повтор {attempt}/{DB_RETRY_ATTEMPTS - 1} через {delay:.2f} с.")
+                await asyncio.sleep(delay)
+            else:
+                self._breaker.record_success()
+                return result
+
+    async def execute(self, *args, **kwargs):
+        return await self._run("execute", args, kwargs)
+
+    async def executemany(self, *args, **kwargs):
+        return await self._run("executemany", args, kwargs)
+
+    async def fetch(self, *args, **kwargs):
+        return await self._run("fetch", args, kwargs)
+
+    async def fetchrow(self, *args, **kwargs):
+        return await self._run("fetchrow", args, kwargs)
+
+    async def fetchval(self, *args, **kwargs):
+        return await self._run("fetchval", args, kwargs)
+
+class _ResilientAcquire:
+    def __init__(self, pool: asyncpg.Pool, breaker: CircuitBreaker, timeout: Optional[float]):
+        self._pool = pool
+        self._breaker = breaker
+        self._timeout = timeout
+        self._conn = None
+
+    async def __aenter__(self) -> ResilientConnection:
+        for attempt in range(1, DB_RETRY_ATTEMPTS + 1):
+            try:
+                self._conn = await self._pool.acquire(timeout=self._timeout)
+                return ResilientConnection(self._conn, self._breaker)
+            except Exception as e:
+                if classify_error(e) != CONNECTION:
+                    raise
+                self._breaker.record_failure()
+                if self._breaker.is_open or attempt == DB_RETRY_ATTEMPTS:
+                    raise
+                delay = backoff_delay(attempt)
+                logger.warning(f"Не вдалося отримати з'єднання з БД ({e}), повтор {attempt}/{DB_RETRY_ATTEMPTS - 1} через {delay:.2f} с.")
+                await asyncio.sleep(delay)
+
+    async def __aexit__(self, *exc_info):
+        await self._pool.release(self._conn)
+
+class ResilientPool:
+    """Обгортка пулу asyncpg: acquire() повторює тимчасові помилки підключення і віддає ResilientConnection."""
+
+    def __init__(self, pool: asyncpg.Pool, breaker: CircuitBreaker, acquire_timeout: Optional[float] = None):
+        self._pool = pool
+        self._breaker = breaker
+        self._acquire_timeout = acquire_timeout
+
+    def __getattr__(self, name):
+        return getattr(self._pool, name)
+
+    def acquire(self) -> _ResilientAcquire:
+        return _ResilientAcquire(self._pool, self._breaker, self._acquire_timeout)
@@ -0,0 +1,201 @@
+import os
+import asyncio
+import logging
+from typing import Optional
+
+from telegram import Update
+from telegram.ext import Application, ContextTypes
+
+from storage import claim_update, record_processed_updates, get_recent_processed_updates, release_update
+
+logger = logging.getLogger(__name__)
+
+# Захист від повторної доставки оновлень Telegram.
+# Якщо вебхук відповів помилкою або не встиг відповісти, Telegram надсилає той самий update_id ще раз,
+# і без перевірки бот вдруге записав би повідомлення, сповістив групу менеджерів або нарахував бонус.
+#
+# Два рівні:
+#   - кільцевий бітсет останніх UPDATE_DEDUP_WINDOW update_id у пам'яті процесу - основна перевірка, без
+#     звернень до БД. update_id зростають послідовно, тому майже всі оновлення потрапляють у вікно;
+#   - таблиця processed_updates: прийняті оновлення записуються в неї пачками у фоні (раз на
+#     UPDATE_RECORD_INTERVAL секунд), а при першому оновленні після старту вікно відновлюється з неї, тож
+#     повторна доставка після перезапуску теж відкидається. Окремий запит до БД (INSERT ... ON CONFLICT)
+#     робиться лише для update_id, старших за вікно.
+# Вікно в кожного воркера своє: повторну доставку, яка потрапила на інший воркер протягом
+# UPDATE_RECORD_INTERVAL, вікно не побачить - це плата за перевірку без запиту до БД.
+#
+# Помилки обробників PTB не пропускає назовні (Application.process_update передає їх обробникам помилок),
+# тому process_update_tracked відстежує їх через власний обробник помилок: після помилки захоплення
+# знімається, і вебхук/polling просить Telegram доставити оновлення ще раз.
+
+UPDATE_DEDUP_WINDOW = int(os.getenv("UPDATE_DEDUP_WINDOW", 65536))
+UPDATE_RECORD_INTERVAL = float(os.getenv("UPDATE_RECORD_INTERVAL", 1))
+
+class UpdateIdWindow:
+    """
+    Бітсет update_id у ковзному вікні [high - size + 1, high].
+    update_id у Telegram зростають послідовно, тому вікно зсувається разом з найбільшим отриманим id,
+    а біти, що виходять з вікна, очищуються.
+    """
+
+    def __init__(self, size: int):
+        self._size = size
+        self._bits = bytearray((size + 7) // 8)
+        self._high: Optional[int] = None
+
+    def _clear(self, update_id: int):
+        pos = update_id % self._size
+        self._bits[pos >> 3] &= ~(1 << (pos & 7)) & 0xFF
+
+    def _advance(self, update_id: int):
+        if self._high is None or update_id - self._high >= self._size:
+            self._bits = bytearray(len(self._bits))
+        else:
+            for stale_id in range(self._high + 1, update_id + 1):
+                self._clear(stale_id)
+        self._high = update_id
+
+    def in_window(self, update_id: int) -> bool:
+        return self._high is not None and self._high - self._size < update_id <= self._high
+
+    def seen(self, update_id: int) -> bool:
+        if not self.in_window(update_id):
+            return False
+        pos = update_id % self._size
+        return bool(self._bits[pos >> 3] & (1 << (pos & 7)))
+
+    def add(self, update_id: int):
+        if self._high is None or update_id > self._high:
+            self._advance(update_id)
+        elif not self.in_window(update_id):
+            return # Занадто старий id: відповідь дасть лише таблиця в БД
+        pos = update_id % self._size
+        self._bits[pos >> 3] |= 1 << (pos & 7)
+
+    def discard(self, update_id: int):
+        if self.in_window(update_id):
+            self._clear(update_id)
+
+    def is_older(self, update_id: int) -> bool:
+        """update_id старший за вікно (або вікно ще порожнє) - відповідь може дати лише таблиця в БД."""
+        return self._high is None or update_id <= self._high - self._size
+
+_window = UpdateIdWindow(UPDATE_DEDUP_WINDOW)
+_window_loaded = False
+_window_lock = asyncio.Lock()
+_unrecorded: list[int] = [] # прийняті update_id, ще не записані в processed_updates
+_record_task: Optional[asyncio.Task] = None
+_tracked: set[int] = set() # update_id, які зараз обробляє process_update_tracked
+_failed: set[int] = set() # ... і обробка яких завершилась помилкою
+
+async def _load_window():
+    """Відновлює вікно з processed_updates при першому оновленні після старту."""
+    global _window_loaded
+    async with _window_lock:
+        if _window_loaded:
+            return
+        try:
+            update_ids = await get_recent_processed_updates(UPDATE_DEDUP_WINDOW)
+        except Exception as e:
+            logger.error(f"Не вдалося відновити вікно дублікатів з БД: {e}")
+            update_ids = []
+        for update_id in update_ids:
+            _window.add(update_id)
+        _window_loaded = True
+        logger.info(f"Вікно дублікатів відновлено: {len(update_ids)} оброблених оновлень.")
+
+async def _record_later():
+    await asyncio.sleep(UPDATE_RECORD_INTERVAL)
+    await flush_processed_updates()
+    if _unrecorded:
+        # Пачку не вдалося записати - повторимо пізніше
+        asyncio.get_running_loop().call_soon(_schedule_record)
+
+def _schedule_record():
+    global _record_task
+    if _unrecorded and (_record_task is None or _record_task.done()):
+        _record_task = asyncio.create_task(_record_later())
+
+async def flush_processed_updates() -> bool:
+    """Записує в processed_updates усі прийняті, але ще не записані update_id. False - не вдалося."""
+    if not _unrecorded:
+        return True
+    update_ids = _unrecorded[:]
+    _unrecorded.clear()
+    saved = False
+    try:
+        saved = await record_processed_updates(update_ids)
+    except Exception as e:
+        logger.error(f"Помилка при записі {len(update_ids)} оброблених оновлень: {e}")
+    finally:
+        if not saved:
+            _unrecorded[:0] = update_ids
+    return saved
+
+async def is_duplicate_update(update_id: int) -> bool:
+    """
+    Повертає True, якщо оновлення вже оброблялось (або зараз обробляється) і його треба відкинути.
+    Інакше позначає update_id як захоплений цим процесом.
+    """
+    if not _window_loaded:
+        await _load_window()
+    if not _window.is_older(update_id):
+        if _window.seen(update_id):
+            logger.info(f"Оновлення {update_id} вже оброблено (локальне вікно), пропускаємо.")
+            return True
+        _window.add(update_id)
+        _unrecorded.append(update_id)
+        _schedule_record()
+        return False
+    # Старший за вікно update_id: позначаємо до звернення до БД, щоб одночасна повторна доставка теж відкидалась
+    _window.add(update_id)
+    try:
+        claimed = await claim_update(update_id)
+    except Exception:
+        # БД недоступна: оновлення не захоплене, тож повторна доставка від Telegram має пройти
+        _window.discard(update_id)
+        raise
+    if not claimed:
+        logger.info(f"Оновлення {update_id} вже оброблено іншим процесом, пропускаємо.")
+        return True
+    return False
+
+async def release_update_claim(update_id: int):
+    """Скасовує захоплення оновлення, якщо його обробка завершилась помилкою, щоб Telegram повторив доставку."""
+    _window.discard(update_id)
+    if update_id in _unrecorded:
+        _unrecorded.remove(update_id)
+    try:
+        await release_update(update_id)
+    except Exception as e:
+        logger.error(f"Не вдалося зняти захоплення оновлення {update_id} у БД: {e}")
+
+async def _on_handler_error(update: object, context: ContextTypes.DEFAULT_TYPE):
+    if isinstance(update, Update) and update.update_id in _tracked:
+        _failed.add(update.update_id)
+    logger.error(f"Помилка в обробнику оновлення: {context.error}", exc_info=context.error)
+
+def track_handler_errors(application: Application):
+    """Реєструє обробник помилок, через який process_update_tracked дізнається про помилки обробників."""
+    application.add_error_handler(_on_handler_error)
+
+async def process_update_tracked(application: Application, update: Update) -> bool:
+    """
+    Передає оновлення в application.process_update. Повертає False (і знімає захоплення оновлення),
+    якщо обробник завершився помилкою, щоб Telegram доставив оновлення повторно.
+    Потребує track_handler_errors(application).
+    """
+    update_id = update.update_id
+    _tracked.add(update_id)
+    try:
+        await application.process_update(update)
+        failed = update_id in _failed
+    except Exception as e:
+        logger.exception(f"Помилка при обробці оновлення {update_id}: {e}")
+        failed = True
+    finally:
+        _tracked.discard(update_id)
+        _failed.discard(update_id)
+    if failed:
+        await release_update_claim(update_id)
+    return not failed
@@ -0,0 +1,64 @@
+import os
+import json
+import zlib
+import logging
+from datetime import datetime
+from typing import Any, Dict
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+logger = logging.getLogger(__name__)
+
+# Стиснений архів завершених діалогів.
+# Після періоду очікування всі рядки діалогу з client_messages замінюються одним записом у dialog_archives:
+# JSON-масив повідомлень [sender_type, message_text, timestamp] (для медіа ще media_type і file_id Telegram -
+# сам файл не копіюється, його можна надіслати повторно за file_id), стиснений zlib (або zstd, якщо встановлено
+# пакет zstandard і DIALOG_ARCHIVE_CODEC=zstd). Кодек зберігається разом з архівом, тому старі архіви
+# читаються і після зміни налаштування.
+
+DIALOG_ARCHIVE_CODEC = os.getenv("DIALOG_ARCHIVE_CODEC", "zlib").lower()
+ZLIB_LEVEL = 9
+ZSTD_LEVEL = 19
+
+if DIALOG_ARCHIVE_CODEC == "zstd" and zstandard is None:
+    logger.warning("DIALOG_ARCHIVE_CODEC=zstd, але пакет zstandard не встановлено. Використовується zlib.")
+    DIALOG_ARCHIVE_CODEC = "zlib"
+elif DIALOG_ARCHIVE_CODEC not in ("zlib", "zstd"):
+    raise ValueError(f"Невідомий DIALOG_ARCHIVE_CODEC '{DIALOG_ARCHIVE_CODEC}'. Допустимі значення: zlib, zstd.")
+
+def encode_dialog(messages: list[Dict[str, Any]], codec: str = DIALOG_ARCHIVE_CODEC) -> bytes:
+    """Пакує повідомлення діалогу (sender_type, message_text, timestamp, media_type, file_id) в стиснений blob."""
+    rows = []
+    for m in messages:
+        row = [m["sender_type"], m["message_text"], m["timestamp"].isoformat() if m["timestamp"] else None]
+        if m.get("file_id"):
+            row += [m["media_type"], m["file_id"]]
+        rows.append(row)
+    raw = json.dumps(rows, ensure_ascii=False, separators=(",", ":")).encode("utf-8")
+    if codec == "zstd":
+        return zstandard.ZstdCompressor(level=ZSTD_LEVEL).compress(raw)
+    return zlib.compress(raw, ZLIB_LEVEL)
+
+def decode_dialog(payload: bytes, codec: str) -> list[Dict[str, Any]]:
+    """Розпаковує blob архіву у список повідомлень у форматі get_client_messages."""
+    if codec == "zstd":
+        if zstandard is None:
+            raise RuntimeError("Архів діалогу стиснено zstd, але пакет zstandard не встановлено.")
+        raw = zstandard.ZstdDecompressor().decompress(payload)
+    else:
+        raw = zlib.decompress(payload)
+    messages = []
+    for row in json.loads(raw):
+        # Текстові повідомлення (і архіви до підтримки медіа) мають три поля
+        sender_type, message_text, timestamp, media_type, file_id = row + [None] * (5 - len(row))
+        messages.append({
+            "sender_type": sender_type,
+            "message_text": message_text,
+            "timestamp": datetime.fromisoformat(timestamp) if timestamp else None,
+            "media_type": media_type,
+            "file_id": file_id,
+        })
+    return messages
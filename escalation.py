@@ -0,0 +1,127 @@
+import os
+import heapq
+import asyncio
+import logging
+from datetime import datetime, timezone
+from typing import Any, Awaitable, Callable, Dict, Iterable, Optional
+
+logger = logging.getLogger(__name__)
+
+# Нагадування менеджерам про клієнтів, які довго чекають у черзі.
+# Лідер тримає в пам'яті чергу очікуючих клієнтів: купу (heap) з часом наступного нагадування для кожного.
+# Один таймер спить до найближчого терміну, тому запитів до БД для перевірки черги немає; черга
+# відновлюється з БД (get_pending_clients) при отриманні лідерства, а далі оновлюється подіями:
+# новий запит, взяття клієнта, завершення діалогу (локально та через інвалідацію з інших процесів).
+# Записи купи не видаляються при взятті клієнта: запис вважається застарілим, якщо клієнт більше не
+# чекає або чекає з іншого моменту, і просто пропускається, коли доходить до вершини купи.
+
+ESCALATION_THRESHOLDS_MINUTES = sorted(
+    int(x) for x in os.getenv("ESCALATION_THRESHOLDS_MINUTES", "20,60").split(",") if x.strip()
+)
+
+EscalationCallback = Callable[[list[Dict[str, Any]]], Awaitable[None]]
+
+_waiting: Dict[int, datetime] = {} # client_id -> з якого моменту клієнт чекає
+_heap: list[tuple[float, int, int, datetime]] = [] # (час нагадування, client_id, рівень, waiting_since)
+_wakeup: Optional[asyncio.Event] = None
+_timer_task: Optional[asyncio.Task] = None
+
+def is_running() -> bool:
+    """Чи працює черга нагадувань у цьому процесі (лише на лідері)."""
+    return _timer_task is not None
+
+def _schedule(client_id: int, since: datetime, now: float):
+    """Додає в купу найближчий поріг, який ще не минув (минулі пороги при відновленні не повторюються)."""
+    waited_minutes = (now - since.timestamp()) / 60
+    for level, minutes in enumerate(ESCALATION_THRESHOLDS_MINUTES):
+        if minutes > waited_minutes:
+            heapq.heappush(_heap, (since.timestamp() + minutes * 60, client_id, level, since))
+            if _wakeup is not None:
+                _wakeup.set()
+            return
+
+def track_client(client_id: int, waiting_since: datetime):
+    """Клієнт чекає на менеджера з моменту waiting_since."""
+    if _timer_task is None or _waiting.get(client_id) == waiting_since:
+        return
+    _waiting[client_id] = waiting_since
+    _schedule(client_id, waiting_since, datetime.now(timezone.utc).timestamp())
+
+def untrack_client(client_id: int):
+    """Клієнт більше не чекає (взятий менеджером або діалог завершено)."""
+    _waiting.pop(client_id, None)
+
+def waiting_clients() -> Dict[int, datetime]:
+    """Копія черги: client_id -> з якого моменту чекає."""
+    return dict(_waiting)
+
+def _pop_due(now: float) -> list[Dict[str, Any]]:
+    due = []
+    while _heap and _heap[0][0] <= now:
+        _, client_id, level, since = heapq.heappop(_heap)
+        if _waiting.get(client_id) != since:
+            continue # застарілий запис
+        due.append({
+            "client_id": client_id,
+            "waiting_since": since,
+            "waited_minutes": int((now - since.timestamp()) // 60),
+            "threshold_minutes": ESCALATION_THRESHOLDS_MINUTES[level],
+            "level": level,
+        })
+        _schedule(client_id, since, now)
+    return due
+
+async def _timer_loop(callback: EscalationCallback):
+    while True:
+        # Прибираємо застарілі записи з вершини, щоб не прокидатись через них
+        while _heap and _waiting.get(_heap[0][1]) != _heap[0][3]:
+            heapq.heappop(_heap)
+        _wakeup.clear()
+        timeout = None
+        if _heap:
+            timeout = max(_heap[0][0] - datetime.now(timezone.utc).timestamp(), 0)
+        try:
+            await asyncio.wait_for(_wakeup.wait(), timeout)
+            continue # з'явився ближчий термін - перераховуємо
+        except asyncio.TimeoutError:
+            pass
+        due = _pop_due(datetime.now(timezone.utc).timestamp())
+        if not due:
+            continue
+        try:
+            await callback(due)
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            logger.exception(f"Помилка при надсиланні нагадувань про чергу: {e}")
+
+async def start_escalations(callback: EscalationCallback, pending_clients: Iterable[Dict[str, Any]]):
+    """
+    Запускає таймер нагадувань. pending_clients - очікуючі клієнти з БД ({client_id, last_activity}).
+    callback(due) отримує пачку клієнтів, для яких настав поріг нагадування.
+    """
+    global _wakeup, _timer_task
+    if _timer_task is not None or not ESCALATION_THRESHOLDS_MINUTES:
+        return
+    _waiting.clear()
+    _heap.clear()
+    _wakeup = asyncio.Event()
+    _timer_task = asyncio.create_task(_timer_loop(callback))
+    for client in pending_clients:
+        track_client(client["client_id"], client["last_activity"])
+    logger.info(f"Черга нагадувань запущена: {len(_waiting)} клієнтів чекають, пороги {ESCALATION_THRESHOLDS_MINUTES} хв.")
+
+async def stop_escalations():
+    """Зупиняє таймер і очищає чергу."""
+    global _timer_task
+    if _timer_task is None:
+        return
+    _timer_task.cancel()
+    try:
+        await _timer_task
+    except asyncio.CancelledError:
+        pass
+    _timer_task = None
+    _waiting.clear()
+    _heap.clear()
+    logger.info("Черга нагадувань зупинена.")
@@ -0,0 +1,83 @@
+import os
+import time
+import logging
+from collections import OrderedDict
+
+logger = logging.getLogger(__name__)
+
+# Захист від флуду: обмеження частоти оновлень від одного користувача до будь-яких звернень до БД.
+# Кожен користувач має "відро" з FLOOD_BURST токенами, яке поповнюється на FLOOD_RATE_PER_SECOND токенів
+# за секунду; оновлення без токена відкидається. Хто продовжує слати після вичерпання ліміту
+# (FLOOD_MUTE_AFTER відкинутих оновлень поспіль), ігнорується FLOOD_MUTE_SECONDS секунд.
+# Стан лише в пам'яті процесу: перевірка коштує мікросекунди, а після перезапуску ліміти починаються заново.
+
+FLOOD_RATE_PER_SECOND = float(os.getenv("FLOOD_RATE_PER_SECOND", 1))
+FLOOD_BURST = float(os.getenv("FLOOD_BURST", 8))
+FLOOD_MUTE_AFTER = int(os.getenv("FLOOD_MUTE_AFTER", 10))
+FLOOD_MUTE_SECONDS = float(os.getenv("FLOOD_MUTE_SECONDS", 60))
+# Не частіше ніж раз на стільки секунд користувач отримує попередження, що його повідомлення відкинуто
+FLOOD_NOTICE_INTERVAL = float(os.getenv("FLOOD_NOTICE_INTERVAL", 30))
+# Після стількох користувачів у таблиці прибираються записи найдавніше активних, чиє відро вже повне
+FLOOD_MAX_TRACKED_USERS = 100_000
+
+ALLOWED = "allowed"
+LIMITED_NOW = "limited_now" # оновлення відкинуто, користувача варто попередити (перше відкидання)
+LIMITED = "limited" # оновлення відкинуто, ліміт вичерпано
+MUTED_NOW = "muted_now" # користувача щойно заглушено (варто один раз попередити)
+MUTED = "muted" # користувач заглушений
+
+class TokenBucket:
+    __slots__ = ("tokens", "updated_at", "rejected", "muted_until", "noticed_at")
+
+    def __init__(self, now: float):
+        self.tokens = FLOOD_BURST
+        self.updated_at = now
+        self.rejected = 0
+        self.muted_until = 0.0
+        self.noticed_at = float("-inf")
+
+    def refill(self, now: float):
+        self.tokens = min(FLOOD_BURST, self.tokens + (now - self.updated_at) * FLOOD_RATE_PER_SECOND)
+        self.updated_at = now
+
+_buckets: "OrderedDict[int, TokenBucket]" = OrderedDict() # у порядку останнього оновлення від користувача
+
+def _evict_idle(now: float):
+    """
+    Прибирає з початку таблиці користувачів, які не писали достатньо довго, щоб відро повністю поповнилось.
+    Зупиняється на першому, кого прибрати ще не можна: решта писали пізніше, тож перевірка не переглядає всю таблицю.
+    """
+    full_after = FLOOD_BURST / FLOOD_RATE_PER_SECOND
+    while len(_buckets) >= FLOOD_MAX_TRACKED_USERS:
+        user_id, bucket = next(iter(_buckets.items()))
+        if bucket.muted_until > now or now - bucket.updated_at < full_after:
+            return
+        del _buckets[user_id]
+
+def check_user(user_id: int) -> str:
+    """Списує токен за оновлення користувача. Повертає ALLOWED, LIMITED_NOW, LIMITED, MUTED_NOW або MUTED."""
+    now = time.monotonic()
+    bucket = _buckets.get(user_id)
+    if bucket is None:
+        _evict_idle(now)
+        bucket = _buckets[user_id] = TokenBucket(now)
+    else:
+        _buckets.move_to_end(user_id)
+    if bucket.muted_until > now:
+        return MUTED
+    bucket.refill(now)
+    if bucket.tokens >= 1:
+        bucket.tokens -= 1
+        bucket.rejected = 0
+        return ALLOWED
+    bucket.rejected += 1
+    if bucket.rejected >= FLOOD_MUTE_AFTER:
+        bucket.muted_until = now + FLOOD_MUTE_SECONDS
+        bucket.rejected = 0
+        logger.warning(f"Користувач {user_id} заглушений на {FLOOD_MUTE_SECONDS:g} с через флуд.")
+        return MUTED_NOW
+    if now - bucket.noticed_at >= FLOOD_NOTICE_INTERVAL:
+        # Довге повідомлення, розбите Telegram на частини, не повинно зникати без пояснення
+        bucket.noticed_at = now
+        return LIMITED_NOW
+    return LIMITED
@@ -0,0 +1,117 @@
+import os
+import asyncio
+import logging
+from typing import Awaitable, Callable, Dict, Optional
+
+from storage import hold_leader_lock, release_leader_lock
+
+logger = logging.getLogger(__name__)
+
+# Вибір лідера серед воркерів/вузлів бота.
+# Лише лідер виконує одноразові дії при старті (реєстрація вебхука) та періодичні завдання.
+# Інші процеси раз на LEADER_CHECK_INTERVAL пробують взяти блокування, тому якщо лідер
+# помирає, його роль автоматично переходить до іншого процесу.
+
+LEADER_CHECK_INTERVAL = float(os.getenv("LEADER_CHECK_INTERVAL", 5))
+
+_is_leader = False
+_election_task: Optional[asyncio.Task] = None
+_on_elected: list[Callable[[], Awaitable[None]]] = []
+_on_step_down: list[Callable[[], Awaitable[None]]] = []
+_jobs: Dict[str, tuple[float, Callable[[], Awaitable[None]]]] = {}
+_job_tasks: Dict[str, asyncio.Task] = {}
+_running_jobs: set[str] = set() # завдання, які виконуються саме зараз (а не чекають наступного запуску)
+
+def is_leader() -> bool:
+    """Чи є цей процес зараз лідером."""
+    return _is_leader
+
+def running_jobs() -> list[str]:
+    """Назви періодичних завдань, які виконуються саме зараз (для звіту при зупинці)."""
+    return sorted(_running_jobs)
+
+def on_elected(callback: Callable[[], Awaitable[None]]):
+    """Реєструє корутину, яку лідер виконує один раз щоразу, коли отримує лідерство."""
+    _on_elected.append(callback)
+
+def on_step_down(callback: Callable[[], Awaitable[None]]):
+    """Реєструє корутину, яку процес виконує, коли втрачає лідерство (або зупиняється, будучи лідером)."""
+    _on_step_down.append(callback)
+
+def add_leader_job(name: str, interval: float, job: Callable[[], Awaitable[None]]):
+    """
+    Реєструє періодичне завдання, яке виконується раз на interval секунд лише на лідері.
+    Якщо процес вже лідер, завдання запускається одразу.
+    """
+    _jobs[name] = (interval, job)
+    if _is_leader and name not in _job_tasks:
+        _job_tasks[name] = asyncio.create_task(_run_job(name, interval, job))
+
+async def _run_job(name: str, interval: float, job: Callable[[], Awaitable[None]]):
+    while True:
+        await asyncio.sleep(interval)
+        _running_jobs.add(name)
+        try:
+            await job()
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            logger.exception(f"Помилка у періодичному завданні '{name}': {e}")
+        finally:
+            _running_jobs.discard(name)
+
+async def _become_leader():
+    global _is_leader
+    _is_leader = True
+    logger.info("Цей процес став лідером.")
+    for callback in _on_elected:
+        try:
+            await callback()
+        except Exception as e:
+            logger.exception(f"Помилка при виконанні дії лідера {getattr(callback, '__name__', callback)}: {e}")
+    for name, (interval, job) in _jobs.items():
+        if name not in _job_tasks:
+            _job_tasks[name] = asyncio.create_task(_run_job(name, interval, job))
+
+async def _step_down():
+    global _is_leader
+    _is_leader = False
+    for task in _job_tasks.values():
+        task.cancel()
+    await asyncio.gather(*_job_tasks.values(), return_exceptions=True)
+    _job_tasks.clear()
+    for callback in _on_step_down:
+        try:
+            await callback()
+        except Exception as e:
+            logger.exception(f"Помилка при виконанні дії після втрати лідерства {getattr(callback, '__name__', callback)}: {e}")
+    logger.info("Цей процес більше не лідер, періодичні завдання зупинено.")
+
+async def _election_loop():
+    while True:
+        holds_lock = await hold_leader_lock()
+        if holds_lock and not _is_leader:
+            await _become_leader()
+        elif not holds_lock and _is_leader:
+            await _step_down()
+        await asyncio.sleep(LEADER_CHECK_INTERVAL)
+
+async def start_leader_election():
+    """Запускає фоновий цикл виборів лідера."""
+    global _election_task
+    if _election_task is None:
+        _election_task = asyncio.create_task(_election_loop())
+
+async def stop_leader_election():
+    """Зупиняє вибори, завдання лідера та звільняє блокування."""
+    global _election_task
+    if _election_task is not None:
+        _election_task.cancel()
+        try:
+            await _election_task
+        except asyncio.CancelledError:
+            pass
+        _election_task = None
+    if _is_leader:
+        await _step_down()
+    await release_leader_lock()
@@ -1,6 +1,8 @@
 import os
 import logging
 import random
+import re
+import argparse
 from dotenv import load_dotenv
 from telegram import (
     Update,
@@ -18,7 +20,7 @@ from telegram.ext import (
     filters
 )
 import asyncio
-from datetime import datetime
+from datetime import datetime, timezone
 from telegram.error import BadRequest
 from decimal import Decimal # <<< ДОДАНО: Імпорт Decimal для точних розрахунків
 
@@ -27,30 +29,109 @@ from typing import Dict, Any, Optional
 
 import uvicorn
 
-from db import (
-    init_db_pool, close_db_pool, get_db_pool,
-    add_order, update_order_status, get_order_details, export_orders_to_excel,
+from storage import (
+    init_db_pool, close_db_pool, get_db_health, is_db_degraded,
+    start_cache_listener, stop_cache_listener,
+    add_order, update_order_status, bulk_update_order_status, get_order_details, export_orders_to_excel,
+    export_order_changes_to_excel, commit_export_watermark,
     add_client_state, get_client_state, update_client_active_status,
-    update_client_notified_status, update_client_manager,
-    add_client_message, get_client_messages,
+    update_client_notified_status, update_client_manager, close_stale_dialogs,
+    add_client_message, get_client_messages, flush_client_messages, pending_client_messages,
     get_client_id_by_order_id,
+    get_order_timeline,
+    get_status_dwell_stats,
+    search_orders,
+    search_client_messages,
+    get_order_stats,
+    compute_support_dialog_metrics,
+    get_support_sla_stats,
     get_manager_active_dialogs,
     update_manager_active_dialog,
     get_pending_clients,
+    claim_client,
+    register_manager,
+    set_manager_online,
+    set_manager_max_dialogs,
+    get_managers_load,
+    assign_client_to_least_loaded_manager,
+    add_forwarded_message,
+    get_forwarded_message_client,
+    purge_forwarded_messages,
+    purge_processed_updates,
+    maintain_client_messages_partitions,
+    archive_completed_orders,
+    archive_closed_dialogs,
     create_or_get_bonus_account,
     update_bonus_balance,
+    set_bonus_balance,
     get_bonus_code_details,
     activate_bonus_code,
     get_telegram_id_by_instagram_id,
     link_instagram_to_telegram_account,
     get_client_orders,
-    get_all_active_orders
+    get_all_active_orders,
+    add_invalidation_callback
 )
+from persistence import DbPersistence
+from leader import on_elected, on_step_down, add_leader_job, start_leader_election, stop_leader_election, running_jobs
+from escalation import (
+    ESCALATION_THRESHOLDS_MINUTES, is_running as escalations_running, track_client, untrack_client,
+    start_escalations, stop_escalations
+)
+from router import MessageRouter
+from dedup import (
+    is_duplicate_update, release_update_claim, flush_processed_updates, track_handler_errors, process_update_tracked
+)
+from sender import send_many, send_message_throttled, pending_sends, cancel_pending_sends
+from flood import (
+    check_user as flood_check_user, ALLOWED as FLOOD_ALLOWED, LIMITED_NOW as FLOOD_LIMITED_NOW,
+    MUTED_NOW as FLOOD_MUTED_NOW, FLOOD_MUTE_SECONDS
+)
+from polling import start_polling, stop_polling
+from metrics import add_collector, render_metrics, set_gauge, inc_counter
+from order_status import STATUS_LABELS, ASSEMBLING, AWAITING_EU_DELIVERY, DELIVERY_UKRAINE, COMPLETED
 
 load_dotenv()
 TOKEN = os.getenv("BOT_TOKEN")
-MANAGER_ID = int(os.getenv("MANAGER_ID")) # Це може бути ID одного менеджера, якщо у вас їх декілька, то потрібно буде змінити логіку для MANAGER_GROUP_ID
+MANAGER_ID = int(os.getenv("MANAGER_ID")) # Основний менеджер; додаткові менеджери перелічуються в MANAGER_IDS
+# Усі менеджери бота: MANAGER_ID плюс ID через кому з MANAGER_IDS
+MANAGER_IDS = {MANAGER_ID} | {int(x) for x in os.getenv("MANAGER_IDS", "").split(",") if x.strip()}
+# Ліміт одночасних діалогів для нових менеджерів у реєстрі (змінюється командою /capacity)
+MANAGER_MAX_DIALOGS = int(os.getenv("MANAGER_MAX_DIALOGS", 5))
+# Як часто (с) лідер пробує розподілити очікуючих клієнтів між вільними менеджерами
+ASSIGNMENT_INTERVAL = float(os.getenv("ASSIGNMENT_INTERVAL", 30))
+# Скільки днів зберігати зв'язки "повідомлення менеджера -> клієнт" для відповідей через Reply
+FORWARDED_MESSAGES_RETENTION_DAYS = int(os.getenv("FORWARDED_MESSAGES_RETENTION_DAYS", 30))
+# Скільки годин зберігати update_id оброблених оновлень (Telegram повторює доставку не довше доби)
+PROCESSED_UPDATES_RETENTION_HOURS = int(os.getenv("PROCESSED_UPDATES_RETENTION_HOURS", 48))
+# Скільки місяців зберігати історію діалогів; старші місячні секції видаляються (drop) або від'єднуються (detach)
+CLIENT_MESSAGES_RETENTION_MONTHS = int(os.getenv("CLIENT_MESSAGES_RETENTION_MONTHS", 12))
+CLIENT_MESSAGES_RETENTION_MODE = os.getenv("CLIENT_MESSAGES_RETENTION_MODE", "drop").lower()
+# Виконані замовлення, старші за ORDERS_ARCHIVE_AFTER_DAYS, переносяться в orders_archive пачками з паузами
+ORDERS_ARCHIVE_AFTER_DAYS = int(os.getenv("ORDERS_ARCHIVE_AFTER_DAYS", 180))
+ORDERS_ARCHIVE_BATCH_SIZE = int(os.getenv("ORDERS_ARCHIVE_BATCH_SIZE", 500))
+ORDERS_ARCHIVE_BATCH_PAUSE = float(os.getenv("ORDERS_ARCHIVE_BATCH_PAUSE", 1))
+ORDERS_ARCHIVE_MAX_BATCHES = int(os.getenv("ORDERS_ARCHIVE_MAX_BATCHES", 100))
+# Через скільки годин після останнього повідомлення завершений діалог стискається в один архівний запис
+DIALOG_ARCHIVE_GRACE_HOURS = int(os.getenv("DIALOG_ARCHIVE_GRACE_HOURS", 72))
+DIALOG_ARCHIVE_BATCH_SIZE = int(os.getenv("DIALOG_ARCHIVE_BATCH_SIZE", 200))
+# Діалоги без повідомлень довше DIALOG_IDLE_CLOSE_MINUTES хвилин завершуються автоматично (0 - вимкнено)
+DIALOG_IDLE_CLOSE_MINUTES = int(os.getenv("DIALOG_IDLE_CLOSE_MINUTES", 12 * 60))
+DIALOG_IDLE_CLOSE_INTERVAL = float(os.getenv("DIALOG_IDLE_CLOSE_INTERVAL", 10 * 60))
+DIALOG_IDLE_CLOSE_BATCH_SIZE = int(os.getenv("DIALOG_IDLE_CLOSE_BATCH_SIZE", 500))
+# Як часто (с) обчислюються метрики SLA для нових і завершених діалогів
+SUPPORT_METRICS_INTERVAL = float(os.getenv("SUPPORT_METRICS_INTERVAL", 300))
+SUPPORT_METRICS_BATCH_SIZE = int(os.getenv("SUPPORT_METRICS_BATCH_SIZE", 1000))
+# Якщо задано, /metrics вимагає заголовок Authorization: Bearer <METRICS_TOKEN>
+METRICS_TOKEN = os.getenv("METRICS_TOKEN")
 MANAGER_GROUP_ID = int(os.getenv("MANAGER_GROUP_ID")) # Ця група буде отримувати нові запити
+# Скільки секунд при зупинці чекати завершення оновлень і розсилок, що обробляються
+SHUTDOWN_DRAIN_TIMEOUT = float(os.getenv("SHUTDOWN_DRAIN_TIMEOUT", 20))
+# Як бот отримує оновлення: webhook (production) або polling (getUpdates; запасний режим і локальні тести).
+# Можна перевизначити при запуску: python main.py --mode polling
+BOT_MODE = os.getenv("BOT_MODE", "webhook").lower()
+if BOT_MODE not in ("webhook", "polling"):
+    raise ValueError(f"Невідомий BOT_MODE '{BOT_MODE}'. Допустимі значення: webhook, polling.")
 WEBHOOK_URL = os.getenv("WEBHOOK_URL")
 WEBHOOK_SECRET_TOKEN = os.getenv("WEBHOOK_SECRET_TOKEN")
 WEB_SERVER_PORT = int(os.getenv("PORT", 8000))
@@ -95,6 +176,7 @@ manager_requests_menu = ReplyKeyboardMarkup([
 
 manager_processed_orders_menu = ReplyKeyboardMarkup([
     ["✏️ Змінити статус замовлення"],
+    ["📦 Масова зміна статусу"],
     ["🔙 Назад до запитів"]
 ], resize_keyboard=True)
 
@@ -113,13 +195,85 @@ order_status_change_menu = ReplyKeyboardMarkup([
 ], resize_keyboard=True)
 
 telegram_app: Application = None
+# Стан прийому оновлень: при зупинці нові оновлення відхиляються, а ті, що обробляються, дочікуються
+accepting_updates = True
+inflight_updates: dict[int, asyncio.Task] = {} # update_id -> задача, що його обробляє
+manager_filter = filters.User(user_id=MANAGER_IDS)
+
+def is_manager(user_id: int) -> bool:
+    return user_id in MANAGER_IDS
 
 # --- ДОПОМІЖНІ ФУНКЦІЇ ---
+
+# Медіа в діалогах пересилаються copy_message за file_id: бот не завантажує і не вивантажує файл повторно.
+# В історії зберігається лише file_id, тож архів діалогу може надіслати медіа знову так само без передачі файлу.
+MEDIA_LABELS = {"photo": "📷 Фото", "document": "📄 Документ", "voice": "🎤 Голосове повідомлення"}
+MEDIA_SENDERS = {"photo": "send_photo", "document": "send_document", "voice": "send_voice"}
+# Скільки останніх медіа з історії надсилати менеджеру, коли він бере клієнта
+HISTORY_MEDIA_LIMIT = 10
+# Відповідь замість "немає даних", коли БД недоступна і збережених значень немає
+DB_UNAVAILABLE_TEXT = "⚠️ Сервіс тимчасово недоступний. Спробуйте, будь ласка, за кілька хвилин."
+
+def extract_media(message) -> tuple[Optional[str], Optional[str]]:
+    """Тип медіа повідомлення і його file_id (найбільший розмір для фото) або (None, None)."""
+    if message.photo:
+        return "photo", message.photo[-1].file_id
+    if message.document:
+        return "document", message.document.file_id
+    if message.voice:
+        return "voice", message.voice.file_id
+    return None, None
+
+def message_body(message) -> str:
+    """Текст повідомлення або підпис медіа (для історії діалогу)."""
+    return message.text or message.caption or ""
+
+def format_history(history_records: list[Dict[str, Any]]) -> str:
+    lines = []
+    for rec in history_records:
+        text = rec["message_text"]
+        if rec.get("media_type"):
+            text = f"[{MEDIA_LABELS.get(rec['media_type'], rec['media_type'])}] {text}".rstrip()
+        lines.append(f"{rec['sender_type'].capitalize()}: {text}")
+    return "\n".join(lines) or "📭 Історія порожня"
+
+async def relay_message(bot, chat_id: int, message, header: Optional[str] = None) -> int:
+    """
+    Пересилає текст або медіа повідомлення в chat_id. Медіа копіюється copy_message (без завантаження файлу),
+    header (Markdown) додається перед текстом або підписом. Повертає message_id надісланого повідомлення.
+    """
+    if extract_media(message)[0] is None:
+        text = f"{header}\n{message.text}" if header else message.text
+        sent = await bot.send_message(chat_id, text, parse_mode="Markdown" if header else None)
+        return sent.message_id
+    if header:
+        caption = f"{header}\n{message.caption}" if message.caption else header
+        copied = await bot.copy_message(chat_id, message.chat_id, message.message_id, caption=caption, parse_mode="Markdown")
+    else:
+        copied = await bot.copy_message(chat_id, message.chat_id, message.message_id)
+    return copied.message_id
+
+async def send_history_media(bot, manager_id: int, client_id: int, history_records: list[Dict[str, Any]]):
+    """Надсилає менеджеру останні медіа з історії клієнта за збереженими file_id (Reply на них відповідає клієнту)."""
+    media = [rec for rec in history_records if rec.get("file_id")][-HISTORY_MEDIA_LIMIT:]
+    for rec in media:
+        method = MEDIA_SENDERS.get(rec["media_type"])
+        if method is None:
+            continue
+        who = "клієнта" if rec["sender_type"] == "client" else "менеджера"
+        caption = f"📎 З історії {who} (ID клієнта: {client_id})"
+        if rec["message_text"]:
+            caption += f"\n{rec['message_text']}"
+        try:
+            sent = await getattr(bot, method)(manager_id, rec["file_id"], caption=caption)
+            await add_forwarded_message(manager_id, sent.message_id, client_id)
+        except Exception as e:
+            logger.warning(f"Не вдалося надіслати медіа з історії клієнта {client_id} менеджеру {manager_id}: {e}")
+
 async def send_dialog_archive(client_id: int, context: ContextTypes.DEFAULT_TYPE):
     """Надсилає архів повідомлень діалогу в групу менеджера."""
     history_records = await get_client_messages(client_id)
-    history_formatted = "\n".join([f"{rec['sender_type'].capitalize()}: {rec['message_text']}" for rec in history_records])
-    history = history_formatted or "📭 Історія порожня"
+    history = format_history(history_records)
 
     await context.bot.send_message(
         MANAGER_GROUP_ID,
@@ -140,11 +294,14 @@ async def close_client_dialog(client_id: int, context: ContextTypes.DEFAULT_TYPE
 
     await update_client_active_status(client_id, is_active=False)
     await update_client_notified_status(client_id, is_notified=False)
+    untrack_client(client_id)
 
     manager_id_for_client = client_state.get("current_manager_id")
     if manager_id_for_client:
         await update_client_manager(client_id, None)
-        await update_manager_active_dialog(manager_id_for_client, None)
+        # Менеджер може вести кілька діалогів: очищаємо активний лише якщо це був саме цей клієнт
+        if await get_manager_active_dialogs(manager_id_for_client) == client_id:
+            await update_manager_active_dialog(manager_id_for_client, None)
         logger.info(f"Менеджер {manager_id_for_client} відкріплений від клієнта {client_id}.")
 
         client_info = None
@@ -172,6 +329,105 @@ async def close_client_dialog(client_id: int, context: ContextTypes.DEFAULT_TYPE
     )
     logger.info(f"Діалог з клієнтом {client_id} завершено {initiator}.")
 
+    if manager_id_for_client:
+        # У менеджера звільнилось місце — віддаємо йому наступного клієнта з черги
+        await assign_pending_clients(context.application)
+
+async def set_manager_menu_state(application: Application, manager_id: int, state: str):
+    """Змінює стан меню менеджера поза його власним оновленням (наприклад, при автопризначенні клієнта)."""
+    manager_data = application.user_data[manager_id]
+    if application.persistence:
+        # Підтягуємо збережений user_data, щоб не перезаписати його неповною копією
+        await application.persistence.refresh_user_data(manager_id, manager_data)
+    manager_data["manager_menu_state"] = state
+    application.mark_data_for_update_persistence(user_ids=[manager_id])
+
+async def start_manager_dialog(application: Application, manager_id: int, client_id: int, make_active: bool = False):
+    """
+    Відкриває діалог менеджера з уже закріпленим за ним клієнтом: надсилає менеджеру історію і повідомляє клієнта.
+    Діалог стає активним, якщо make_active або в менеджера ще немає активного діалогу;
+    інакше менеджер відповідає клієнту через Reply на повідомлення з історією.
+    """
+    manager_current_dialog = await get_manager_active_dialogs(manager_id)
+    history_records = await get_client_messages(client_id)
+    history = format_history(history_records)
+
+    if make_active or not manager_current_dialog or manager_current_dialog == client_id:
+        await update_manager_active_dialog(manager_id, client_id)
+        sent = await application.bot.send_message(
+            manager_id,
+            f"✅ **Діалог з клієнтом (ID: `{client_id}`) взято в роботу.**\n"
+            f"✉️ **Історія діалогу:**\n{history}\n\n"
+            f"Тепер ви можете відповідати клієнту, просто надсилаючи повідомлення, "
+            f"а іншим клієнтам — через Reply на їхні повідомлення.",
+            reply_markup=active_dialog_client_buttons,
+            parse_mode="Markdown"
+        )
+        await set_manager_menu_state(application, manager_id, "active_dialog")
+    else:
+        sent = await application.bot.send_message(
+            manager_id,
+            f"📥 **Вам призначено клієнта (ID: `{client_id}`).**\n"
+            f"✉️ **Історія діалогу:**\n{history}\n\n"
+            f"↩️ Щоб відповісти цьому клієнту, зробіть Reply на це або будь-яке його повідомлення.",
+            parse_mode="Markdown"
+        )
+        logger.info(f"Клієнта {client_id} призначено менеджеру {manager_id} як додатковий діалог.")
+    await add_forwarded_message(manager_id, sent.message_id, client_id)
+    await send_history_media(application.bot, manager_id, client_id, history_records)
+
+    try:
+        await application.bot.send_message(client_id, "🎉 Менеджер приєднався до діалогу!")
+    except Exception as e:
+        logger.warning(f"Не вдалося надіслати повідомлення клієнту {client_id} про приєднання менеджера: {e}")
+
+async def reply_to_client(update: Update, context: ContextTypes.DEFAULT_TYPE, client_id: int):
+    """Надсилає повідомлення (текст або медіа) менеджера конкретному клієнту (активний діалог або Reply на переслане повідомлення)."""
+    uid = update.effective_user.id
+    target_client_state = await get_client_state(client_id)
+    if not target_client_state or not target_client_state.get("is_active") or target_client_state.get("current_manager_id") != uid:
+        await update.message.reply_text(f"❌ Діалог з клієнтом (ID: `{client_id}`) вже завершено або він не у вас в роботі.", parse_mode="Markdown")
+        if await get_manager_active_dialogs(uid) == client_id:
+            await update_manager_active_dialog(uid, None)
+        logger.warning(f"Менеджер {uid} намагався відповісти неактивному клієнту {client_id}.")
+        return
+
+    await add_client_message(client_id, "manager", message_body(update.message), *extract_media(update.message))
+    try:
+        await relay_message(context.bot, client_id, update.message)
+        await update.message.reply_text(f"✅ Відповідь надіслано клієнту (ID: `{client_id}`).", parse_mode="Markdown")
+        logger.info(f"Менеджер {uid} відповів клієнту {client_id}.")
+    except Exception as e:
+        logger.warning(f"Не вдалося надіслати повідомлення клієнту {client_id}: {e}")
+        await update.message.reply_text(f"❌ Не вдалося надіслати повідомлення клієнту (можливо, він заблокував бота).")
+
+async def assign_pending_clients(application: Application) -> Dict[int, int]:
+    """
+    Розподіляє очікуючих клієнтів (починаючи з тих, хто чекає найдовше) між онлайн-менеджерами
+    з найменшим навантаженням у межах їхніх лімітів. Повертає {client_id: manager_id}.
+    """
+    managers = await get_managers_load()
+    free_slots = sum(max(m["max_dialogs"] - m["active_dialogs"], 0) for m in managers if m["is_online"])
+    assignments: Dict[int, int] = {}
+    if free_slots <= 0:
+        return assignments
+
+    for client in await get_pending_clients():
+        if len(assignments) >= free_slots:
+            break
+        client_id = client["client_id"]
+        manager_id = await assign_client_to_least_loaded_manager(client_id)
+        if manager_id is None:
+            continue
+        assignments[client_id] = manager_id
+        untrack_client(client_id)
+        await update_client_notified_status(client_id, True)
+        try:
+            await start_manager_dialog(application, manager_id, client_id)
+        except Exception as e:
+            logger.warning(f"Не вдалося повідомити менеджера {manager_id} про призначеного клієнта {client_id}: {e}")
+    return assignments
+
 # --- КОМАНДИ І ОБРОБНИКИ ---
 async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
     uid = update.effective_user.id
@@ -193,7 +449,7 @@ async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
         if client_db_state.get("is_active"):
             await close_client_dialog(uid, context, "автоматично при /start")
 
-    if uid == MANAGER_ID: # Тут потрібно буде додати логіку для багатьох менеджерів
+    if is_manager(uid):
         context.user_data.pop("manager_awaiting_balance_client_id", None)
         context.user_data.pop("manager_awaiting_balance_amount", None)
         context.user_data.pop("temp_client_id_for_balance", None)
@@ -221,7 +477,7 @@ async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
 
 async def manager_menu_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
     uid = update.effective_user.id
-    if uid != MANAGER_ID:
+    if not is_manager(uid):
         await update.message.reply_text("❌ Ця команда доступна лише для менеджера.")
         return
 
@@ -245,7 +501,7 @@ async def manager_menu_command(update: Update, context: ContextTypes.DEFAULT_TYP
 
 async def client_info_command(update: Update, context: ContextTypes.DEFAULT_TYPE, target_id_from_handler: Optional[int] = None):
     uid = update.effective_user.id
-    if uid != MANAGER_ID:
+    if not is_manager(uid):
         await update.message.reply_text("❌ Ця команда доступна лише для менеджера.")
         return
 
@@ -308,7 +564,7 @@ async def client_info_command(update: Update, context: ContextTypes.DEFAULT_TYPE
 
 async def manager_requests_menu_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
     uid = update.effective_user.id
-    if uid != MANAGER_ID:
+    if not is_manager(uid):
         await update.message.reply_text("❌ Ця команда доступна лише для менеджера.")
         return
 
@@ -321,7 +577,7 @@ async def manager_requests_menu_handler(update: Update, context: ContextTypes.DE
 
 async def active_dialog_details_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
     uid = update.effective_user.id
-    if uid != MANAGER_ID:
+    if not is_manager(uid):
         await update.message.reply_text("❌ Ця команда доступна лише для менеджера.")
         return
 
@@ -352,7 +608,7 @@ async def active_dialog_details_handler(update: Update, context: ContextTypes.DE
 
 async def new_requests_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
     uid = update.effective_user.id
-    if uid != MANAGER_ID:
+    if not is_manager(uid):
         await update.message.reply_text("❌ Ця команда доступна лише для менеджера.")
         return
 
@@ -410,7 +666,7 @@ async def new_requests_command(update: Update, context: ContextTypes.DEFAULT_TYP
 
 async def processed_orders_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
     uid = update.effective_user.id
-    if uid != MANAGER_ID:
+    if not is_manager(uid):
         await update.message.reply_text("❌ Ця команда доступна лише для менеджера.")
         return
 
@@ -431,7 +687,8 @@ async def processed_orders_command(update: Update, context: ContextTypes.DEFAULT
                 response_text += f"📝 Опис: {order['description']}\n"
             response_text += "\n"
 
-        response_text += "Щоб змінити статус замовлення, натисніть кнопку '✏️ Змінити статус замовлення' та введіть номер замовлення."
+        response_text += "Щоб змінити статус замовлення, натисніть кнопку '✏️ Змінити статус замовлення' та введіть номер замовлення.\n"
+        response_text += "Щоб змінити статус одразу кількох замовлень, натисніть '📦 Масова зміна статусу'."
     else:
         response_text += "--- **Наразі немає активних замовлень.** ---\n"
 
@@ -440,6 +697,77 @@ async def processed_orders_command(update: Update, context: ContextTypes.DEFAULT
     await update.message.reply_text(response_text, parse_mode="Markdown", reply_markup=reply_markup)
     logger.info(f"Менеджер {uid} переглянув оформлені замовлення.")
 
+# --- МАРШРУТИЗАЦІЯ ТЕКСТОВИХ ПОВІДОМЛЕНЬ ---
+# Кожна кнопка та кожен режим очікування вводу має власний обробник (update, context, client_db_state).
+# handle_message лише визначає роль і стан користувача та знаходить обробник у message_router.
+
+# Режими очікування вводу менеджера. Якщо встановлено прапорець, стан менеджера - це його назва.
+MANAGER_INPUT_FLAGS = (
+    "manager_awaiting_order_id_for_status_change",
+    "manager_awaiting_balance_client_id",
+    "manager_awaiting_balance_amount",
+    "manager_awaiting_client_info_id",
+    "manager_awaiting_order_price",
+    "manager_awaiting_order_description",
+    "manager_awaiting_bulk_order_ids",
+)
+MANAGER_INPUT_TEMP_KEYS = (
+    "temp_order_id_for_status_change",
+    "temp_client_id_for_balance",
+    "temp_order_client_id",
+    "temp_order_price",
+)
+ORDER_STATUS_BUTTONS = {
+    "🔄 Комплектування": STATUS_LABELS[ASSEMBLING],
+    "🚚 З ЄС": STATUS_LABELS[AWAITING_EU_DELIVERY],
+    "📮 По Україні": STATUS_LABELS[DELIVERY_UKRAINE],
+    "✅ Виконано": STATUS_LABELS[COMPLETED]
+}
+# Скільки замовлень показувати в інлайн-клавіатурі масової зміни статусу (Telegram обмежує кількість кнопок)
+BULK_STATUS_KEYBOARD_LIMIT = 60
+
+message_router: Optional[MessageRouter] = None
+
+def get_manager_state(context: ContextTypes.DEFAULT_TYPE) -> str:
+    for flag in MANAGER_INPUT_FLAGS:
+        if context.user_data.get(flag):
+            return flag
+    return context.user_data.get("manager_menu_state") or "main"
+
+def get_client_menu_state(context: ContextTypes.DEFAULT_TYPE) -> str:
+    return context.user_data.get("client_menu_state") or "main"
+
+def clear_manager_input(context: ContextTypes.DEFAULT_TYPE):
+    """Скидає всі режими очікування вводу менеджера (при переході в інший розділ меню)."""
+    for key in MANAGER_INPUT_FLAGS + MANAGER_INPUT_TEMP_KEYS:
+        context.user_data.pop(key, None)
+
+async def handle_media(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Фото, документи та голосові: пересилаються лише в межах діалогу клієнта з менеджером."""
+    uid = update.effective_user.id
+    if is_manager(uid):
+        reply_to = update.message.reply_to_message
+        reply_client_id = await get_forwarded_message_client(uid, reply_to.message_id) if reply_to else None
+        if reply_client_id:
+            await reply_to_client(update, context, reply_client_id)
+        elif await get_manager_active_dialogs(uid):
+            await manager_active_dialog_text(update, context, {})
+        else:
+            await update.message.reply_text(
+                "📎 Щоб надіслати файл клієнту, відкрийте активний діалог або зробіть Reply на повідомлення клієнта.",
+                reply_markup=manager_main_menu
+            )
+        return
+
+    client_db_state = await get_client_state(uid)
+    if not client_db_state or not client_db_state.get("is_active"):
+        await update.message.reply_text(
+            "📎 Щоб надіслати фото чи файл менеджеру, спочатку створіть запит.", reply_markup=main_menu
+        )
+        logger.info(f"Клієнт {uid} надіслав медіа поза активним діалогом.")
+        return
+    await client_free_text(update, context, client_db_state)
+
 async def handle_message(update: Update, context: ContextTypes.DEFAULT_TYPE):
     uid = update.effective_user.id
     text = update.message.text
@@ -453,612 +781,865 @@ async def handle_message(update: Update, context: ContextTypes.DEFAULT_TYPE):
             await update.message.reply_text("Вибачте, сталася помилка. Спробуйте ще раз або зверніться до підтримки.")
             return
 
-    # --- ЛОГІКА ДЛЯ МЕНЕДЖЕРА ---
-    if uid == MANAGER_ID:
-        # Перевірка на режими очікування введення
-        if context.user_data.get("manager_awaiting_order_id_for_status_change"):
-            order_id_to_change = text.strip()
-            order_details = await get_order_details(order_id_to_change)
-            if order_details:
-                context.user_data["temp_order_id_for_status_change"] = order_id_to_change
-                context.user_data["manager_awaiting_order_id_for_status_change"] = False
-                context.user_data["manager_menu_state"] = "awaiting_status_selection"
-                await update.message.reply_text(
-                    f"📦 Замовлення `{order_id_to_change}`. Поточний статус: **{order_details.get('status', 'N/A')}**\n"
-                    "Оберіть новий статус:",
-                    parse_mode="Markdown",
-                    reply_markup=order_status_change_menu
-                )
-                logger.info(f"Менеджер {uid} перейшов до зміни статусу замовлення {order_id_to_change}.")
-            else:
-                await update.message.reply_text("❌ Замовлення з таким номером не знайдено. Спробуйте ще раз або натисніть 'Назад'.", reply_markup=back_button)
-                logger.warning(f"Менеджер {uid} ввів неіснуючий номер замовлення '{order_id_to_change}' для зміни статусу.")
-            return
-
-        elif context.user_data.get("manager_awaiting_balance_client_id"):
-            try:
-                target_tg_id = int(text.strip())
-                bonus_acc = await create_or_get_bonus_account(target_tg_id)
-                if not bonus_acc:
-                    await update.message.reply_text(f"❌ Не вдалося знайти/створити бонусний акаунт для клієнта (ID: `{target_tg_id}`). Спробуйте ще раз або натисніть 'Назад'.", parse_mode="Markdown", reply_markup=back_button)
-                    logger.warning(f"Менеджер {uid} ввів неіснуючий TG ID {target_tg_id} для зміни балансу.")
-                    return
-
-                context.user_data["temp_client_id_for_balance"] = target_tg_id
-                context.user_data["manager_awaiting_balance_client_id"] = False
-                context.user_data["manager_awaiting_balance_amount"] = True
-                await update.message.reply_text(
-                    f"✅ ID клієнта `{target_tg_id}` прийнято.\n"
-                    "🔢 Тепер введіть суму або новий баланс.\n"
-                    "Наприклад: `100` (додати 100), `-50` (списати 50), `=200` (встановити 200).",
-                    parse_mode="Markdown",
-                    reply_markup=back_button
-                )
-                logger.info(f"Менеджер {uid} перейшов до введення суми для клієнта {target_tg_id}.")
-                return
-            except ValueError:
-                await update.message.reply_text("❌ Невірний формат ID клієнта. Введіть лише числове ID.", reply_markup=back_button)
-                logger.warning(f"Менеджер {uid} ввів невірний формат ID для зміни балансу: '{text}'.")
+    if is_manager(uid):
+        # Reply на переслане повідомлення клієнта: відповідь іде саме цьому клієнту, незалежно від меню
+        reply_to = update.message.reply_to_message
+        if reply_to:
+            reply_client_id = await get_forwarded_message_client(uid, reply_to.message_id)
+            if reply_client_id:
+                await reply_to_client(update, context, reply_client_id)
                 return
+        handler = message_router.resolve("manager", get_manager_state(context), text)
+    else:
+        handler = message_router.resolve("client", get_client_menu_state(context), text)
 
-        elif context.user_data.get("manager_awaiting_balance_amount"):
-            target_tg_id = context.user_data.get("temp_client_id_for_balance")
-            if not target_tg_id:
-                await update.message.reply_text("❌ Виникла внутрішня помилка. Спробуйте почати зміну балансу знову.", reply_markup=manager_main_menu)
-                context.user_data.pop("manager_awaiting_balance_amount", None)
-                context.user_data.pop("temp_client_id_for_balance", None)
-                return
+    await handler(update, context, client_db_state)
 
-            try:
-                amount_str = text.strip()
-                if amount_str == "🔙 Назад": # Handle back button here again, as it's a specific mode
-                    context.user_data.pop("manager_awaiting_balance_amount", None)
-                    context.user_data.pop("temp_client_id_for_balance", None)
-                    await update.message.reply_text("🔙 Повертаємось до меню менеджера.", reply_markup=manager_main_menu)
-                    logger.info(f"Менеджер {uid} повернувся до меню менеджера з режиму введення суми.")
-                    return
-
-                # Save original context.args if needed later
-                original_context_args = context.args[:] if context.args else []
-
-                if amount_str.startswith("="):
-                    processed_amount_str = amount_str[1:]
-                    context.args = [str(target_tg_id), processed_amount_str]
-                    await set_bonus_command_manager(update, context)
-                else:
-                    context.args = [str(target_tg_id), amount_str]
-                    await add_bonus_command_manager(update, context)
-
-                context.args = original_context_args # Restore original args
-                context.user_data.pop("manager_awaiting_balance_amount", None)
-                context.user_data.pop("temp_client_id_for_balance", None)
-                await update.message.reply_text("✅ Операцію з балансом виконано.", reply_markup=manager_main_menu)
-                logger.info(f"Менеджер {uid} змінив баланс клієнта {target_tg_id} через текстовий ввід.")
-                return
-            except ValueError:
-                await update.message.reply_text("❌ Невірний формат суми. Введіть число (наприклад, `100`, `-50`, `=200`).", parse_mode="Markdown", reply_markup=back_button)
-                logger.warning(f"Менеджер {uid} ввів невірний формат суми для зміни балансу: '{text}'.")
-                return
-            except Exception as e:
-                logger.error(f"Помилка при обробці суми балансу від менеджера: {e}")
-                await update.message.reply_text(f"Виникла непередбачена помилка: {e}", reply_markup=manager_main_menu)
-                context.user_data.pop("manager_awaiting_balance_amount", None)
-                context.user_data.pop("temp_client_id_for_balance", None)
-                return
+# --- МЕНЕДЖЕР: РЕЖИМИ ОЧІКУВАННЯ ВВОДУ ---
 
-        elif context.user_data.get("manager_awaiting_client_info_id"):
-            try:
-                target_tg_id = int(text.strip())
-                await client_info_command(update, context, target_id_from_handler=target_tg_id)
+async def manager_input_order_id_for_status(update: Update, context: ContextTypes.DEFAULT_TYPE, client_db_state: Dict[str, Any]):
+    uid = update.effective_user.id
+    order_id_to_change = update.message.text.strip()
+    order_details = await get_order_details(order_id_to_change)
+    if order_details:
+        context.user_data["temp_order_id_for_status_change"] = order_id_to_change
+        context.user_data["manager_awaiting_order_id_for_status_change"] = False
+        context.user_data["manager_menu_state"] = "awaiting_status_selection"
+        await update.message.reply_text(
+            f"📦 Замовлення `{order_id_to_change}`. Поточний статус: **{order_details.get('status', 'N/A')}**\n"
+            "Оберіть новий статус:",
+            parse_mode="Markdown",
+            reply_markup=order_status_change_menu
+        )
+        logger.info(f"Менеджер {uid} перейшов до зміни статусу замовлення {order_id_to_change}.")
+    else:
+        await update.message.reply_text("❌ Замовлення з таким номером не знайдено. Спробуйте ще раз або натисніть 'Назад'.", reply_markup=back_button)
+        logger.warning(f"Менеджер {uid} ввів неіснуючий номер замовлення '{order_id_to_change}' для зміни статусу.")
 
-                context.user_data.pop("manager_awaiting_client_info_id", None)
-                await update.message.reply_text("✅ Інформація про клієнта надана.", reply_markup=manager_main_menu)
-                logger.info(f"Менеджер {uid} отримав інфо про клієнта {target_tg_id}.")
-                return
-            except ValueError:
-                await update.message.reply_text("❌ Невірний формат ID. Введіть лише числове Telegram ID.", reply_markup=manager_main_menu)
-                logger.warning(f"Менеджер {uid} ввів невірний формат ID для інфо про клієнта: '{text}'.")
-                return
+async def manager_input_balance_client_id(update: Update, context: ContextTypes.DEFAULT_TYPE, client_db_state: Dict[str, Any]):
+    uid = update.effective_user.id
+    text = update.message.text
+    try:
+        target_tg_id = int(text.strip())
+    except ValueError:
+        await update.message.reply_text("❌ Невірний формат ID клієнта. Введіть лише числове ID.", reply_markup=back_button)
+        logger.warning(f"Менеджер {uid} ввів невірний формат ID для зміни балансу: '{text}'.")
+        return
 
-        elif context.user_data.get("manager_awaiting_order_price"):
-            client_id_for_order = context.user_data.get("temp_order_client_id")
-            manager_current_dialog = await get_manager_active_dialogs(MANAGER_ID) # Re-fetch to be safe
+    bonus_acc = await create_or_get_bonus_account(target_tg_id)
+    if not bonus_acc:
+        await update.message.reply_text(f"❌ Не вдалося знайти/створити бонусний акаунт для клієнта (ID: `{target_tg_id}`). Спробуйте ще раз або натисніть 'Назад'.", parse_mode="Markdown", reply_markup=back_button)
+        logger.warning(f"Менеджер {uid} ввів неіснуючий TG ID {target_tg_id} для зміни балансу.")
+        return
 
-            if not client_id_for_order or not manager_current_dialog == client_id_for_order:
-                await update.message.reply_text("❌ Виникла внутрішня помилка або діалог з клієнтом змінився. Спробуйте оформити замовлення знову.", reply_markup=active_dialog_client_buttons)
-                context.user_data.pop("manager_awaiting_order_price", None)
-                context.user_data.pop("temp_order_client_id", None)
-                return
-            try:
-                price = Decimal(text.strip()) # Змінено float на Decimal
-                if price <= Decimal('0'): # Змінено 0 на Decimal('0')
-                    await update.message.reply_text("❌ Ціна має бути позитивним числом. Введіть коректну ціну:", reply_markup=back_button)
-                    return
-                context.user_data["temp_order_price"] = price
-                context.user_data["manager_awaiting_order_price"] = False
-                context.user_data["manager_awaiting_order_description"] = True
-                await update.message.reply_text("📝 Тепер введіть опис замовлення (наприклад, код запчастини, тип, бренд):", reply_markup=back_button)
-                logger.info(f"Менеджер {uid} ввів ціну {price} для замовлення клієнта {client_id_for_order}.")
-                return
-            except ValueError:
-                await update.message.reply_text("❌ Невірний формат ціни. Введіть число (наприклад, `1500.50`):", reply_markup=back_button)
-                logger.warning(f"Менеджер {uid} ввів невірний формат ціни: '{text}'.")
-                return
+    context.user_data["temp_client_id_for_balance"] = target_tg_id
+    context.user_data["manager_awaiting_balance_client_id"] = False
+    context.user_data["manager_awaiting_balance_amount"] = True
+    await update.message.reply_text(
+        f"✅ ID клієнта `{target_tg_id}` прийнято.\n"
+        "🔢 Тепер введіть суму або новий баланс.\n"
+        "Наприклад: `100` (додати 100), `-50` (списати 50), `=200` (встановити 200).",
+        parse_mode="Markdown",
+        reply_markup=back_button
+    )
+    logger.info(f"Менеджер {uid} перейшов до введення суми для клієнта {target_tg_id}.")
 
-        elif context.user_data.get("manager_awaiting_order_description"):
-            client_id_for_order = context.user_data.get("temp_order_client_id")
-            price_for_order = context.user_data.get("temp_order_price")
-            manager_current_dialog = await get_manager_active_dialogs(MANAGER_ID) # Re-fetch to be safe
+async def manager_input_balance_amount(update: Update, context: ContextTypes.DEFAULT_TYPE, client_db_state: Dict[str, Any]):
+    uid = update.effective_user.id
+    text = update.message.text
+    target_tg_id = context.user_data.get("temp_client_id_for_balance")
+    if not target_tg_id:
+        await update.message.reply_text("❌ Виникла внутрішня помилка. Спробуйте почати зміну балансу знову.", reply_markup=manager_main_menu)
+        context.user_data.pop("manager_awaiting_balance_amount", None)
+        context.user_data.pop("temp_client_id_for_balance", None)
+        return
 
-            if not client_id_for_order or price_for_order is None or not manager_current_dialog == client_id_for_order:
-                await update.message.reply_text("❌ Виникла внутрішня помилка або діалог з клієнтом змінився. Спробуйте оформити замовлення знову.", reply_markup=active_dialog_client_buttons)
-                context.user_data.pop("manager_awaiting_order_description", None)
-                context.user_data.pop("temp_order_client_id", None)
-                context.user_data.pop("temp_order_price", None)
-                return
+    try:
+        amount_str = text.strip()
+        # Save original context.args if needed later
+        original_context_args = context.args[:] if context.args else []
+
+        if amount_str.startswith("="):
+            processed_amount_str = amount_str[1:]
+            context.args = [str(target_tg_id), processed_amount_str]
+            await set_bonus_command_manager(update, context)
+        else:
+            context.args = [str(target_tg_id), amount_str]
+            await add_bonus_command_manager(update, context)
 
-            description = text.strip()
-            # Генерація унікального ID замовлення
-            order_id_val = f"{random.randint(100000, 999999)}{str(client_id_for_order)[-4:]}"
-            await add_order(order_id_val, client_id_for_order, "🔄 Комплектування замовлення", price_for_order, description)
+        context.args = original_context_args # Restore original args
+        context.user_data.pop("manager_awaiting_balance_amount", None)
+        context.user_data.pop("temp_client_id_for_balance", None)
+        await update.message.reply_text("✅ Операцію з балансом виконано.", reply_markup=manager_main_menu)
+        logger.info(f"Менеджер {uid} змінив баланс клієнта {target_tg_id} через текстовий ввід.")
+    except ValueError:
+        await update.message.reply_text("❌ Невірний формат суми. Введіть число (наприклад, `100`, `-50`, `=200`).", parse_mode="Markdown", reply_markup=back_button)
+        logger.warning(f"Менеджер {uid} ввів невірний формат суми для зміни балансу: '{text}'.")
+    except Exception as e:
+        logger.error(f"Помилка при обробці суми балансу від менеджера: {e}")
+        await update.message.reply_text(f"Виникла непередбачена помилка: {e}", reply_markup=manager_main_menu)
+        context.user_data.pop("manager_awaiting_balance_amount", None)
+        context.user_data.pop("temp_client_id_for_balance", None)
 
-            try:
-                await context.bot.send_message(client_id_for_order, f"📦 Ваше замовлення сформоване!\nНомер: `{order_id_val}`\n💰 Ціна: **{price_for_order:.2f} грн**\n📝 Опис: {description}", parse_mode="Markdown", reply_markup=end_dialog_client_button)
-            except Exception as e:
-                logger.warning(f"Не вдалося надіслати повідомлення клієнту {client_id_for_order} про оформлення замовлення: {e}")
+async def manager_input_client_info_id(update: Update, context: ContextTypes.DEFAULT_TYPE, client_db_state: Dict[str, Any]):
+    uid = update.effective_user.id
+    text = update.message.text
+    try:
+        target_tg_id = int(text.strip())
+    except ValueError:
+        await update.message.reply_text("❌ Невірний формат ID. Введіть лише числове Telegram ID.", reply_markup=manager_main_menu)
+        logger.warning(f"Менеджер {uid} ввів невірний формат ID для інфо про клієнта: '{text}'.")
+        return
 
-            try:
-                await context.bot.send_message(uid, # Надсилаємо саме менеджеру, який оформив
-                                               f"📦 Замовлення оформлено!\nНомер: `{order_id_val}`\n💰 Ціна: **{price_for_order:.2f} грн**\n📝 Опис: {description}",
-                                               parse_mode="Markdown")
-            except Exception as e:
-                logger.warning(f"Не вдалося надіслати повідомлення менеджеру {uid} про оформлення замовлення: {e}")
+    await client_info_command(update, context, target_id_from_handler=target_tg_id)
+    context.user_data.pop("manager_awaiting_client_info_id", None)
+    await update.message.reply_text("✅ Інформація про клієнта надана.", reply_markup=manager_main_menu)
+    logger.info(f"Менеджер {uid} отримав інфо про клієнта {target_tg_id}.")
 
-            await update.message.reply_text(f"✅ Замовлення `{order_id_val}` оформлено для клієнта `{client_id_for_order}`.", parse_mode="Markdown", reply_markup=active_dialog_client_buttons)
-            logger.info(f"Менеджер {uid} оформив замовлення {order_id_val} для клієнта {client_id_for_order} з ціною {price_for_order} та описом '{description}'.")
+async def manager_input_order_price(update: Update, context: ContextTypes.DEFAULT_TYPE, client_db_state: Dict[str, Any]):
+    uid = update.effective_user.id
+    text = update.message.text
+    client_id_for_order = context.user_data.get("temp_order_client_id")
+    manager_current_dialog = await get_manager_active_dialogs(uid) # Re-fetch to be safe
 
-            context.user_data.pop("manager_awaiting_order_description", None)
-            context.user_data.pop("temp_order_client_id", None)
-            context.user_data.pop("temp_order_price", None)
-            return
+    if not client_id_for_order or not manager_current_dialog == client_id_for_order:
+        await update.message.reply_text("❌ Виникла внутрішня помилка або діалог з клієнтом змінився. Спробуйте оформити замовлення знову.", reply_markup=active_dialog_client_buttons)
+        context.user_data.pop("manager_awaiting_order_price", None)
+        context.user_data.pop("temp_order_client_id", None)
+        return
+    try:
+        price = Decimal(text.strip()) # Змінено float на Decimal
+    except (ValueError, ArithmeticError):
+        await update.message.reply_text("❌ Невірний формат ціни. Введіть число (наприклад, `1500.50`):", reply_markup=back_button)
+        logger.warning(f"Менеджер {uid} ввів невірний формат ціни: '{text}'.")
+        return
+    if price <= Decimal('0'): # Змінено 0 на Decimal('0')
+        await update.message.reply_text("❌ Ціна має бути позитивним числом. Введіть коректну ціну:", reply_markup=back_button)
+        return
+    context.user_data["temp_order_price"] = price
+    context.user_data["manager_awaiting_order_price"] = False
+    context.user_data["manager_awaiting_order_description"] = True
+    await update.message.reply_text("📝 Тепер введіть опис замовлення (наприклад, код запчастини, тип, бренд):", reply_markup=back_button)
+    logger.info(f"Менеджер {uid} ввів ціну {price} для замовлення клієнта {client_id_for_order}.")
 
-        # Обробка кнопок "Змінити статус замовлення" (вибір нового статусу)
-        elif text in ["🔄 Комплектування", "🚚 З ЄС", "📮 По Україні", "✅ Виконано"] and context.user_data.get("manager_menu_state") == "awaiting_status_selection":
-            order_id_to_change = context.user_data.get("temp_order_id_for_status_change")
-            if not order_id_to_change:
-                await update.message.reply_text("❌ Виникла помилка: не знайдено ID замовлення для зміни статусу. Спробуйте ще раз.", reply_markup=manager_main_menu)
-                context.user_data.pop("manager_awaiting_order_id_for_status_change", None)
-                context.user_data.pop("temp_order_id_for_status_change", None)
-                context.user_data["manager_menu_state"] = "main"
-                return
+async def manager_input_order_description(update: Update, context: ContextTypes.DEFAULT_TYPE, client_db_state: Dict[str, Any]):
+    uid = update.effective_user.id
+    client_id_for_order = context.user_data.get("temp_order_client_id")
+    price_for_order = context.user_data.get("temp_order_price")
+    manager_current_dialog = await get_manager_active_dialogs(uid) # Re-fetch to be safe
 
-            status_map = {
-                "🔄 Комплектування": "🔄 Комплектування замовлення",
-                "🚚 З ЄС": "🚚 Очікуємо доставку з ЄС",
-                "📮 По Україні": "📮 Доставка по Україні",
-                "✅ Виконано": "✅ Замовлення виконано"
-            }
-            new_status = status_map.get(text)
-            if new_status:
-                await update_order_status(order_id_to_change, new_status)
-                client_id_from_order = await get_client_id_by_order_id(order_id_to_change)
-                if client_id_from_order:
-                    try:
-                        await context.bot.send_message(client_id_from_order, f"📦 Новий статус вашого замовлення:\n**{new_status}**", parse_mode="Markdown")
-                        logger.info(f"Клієнту {client_id_from_order} надіслано оновлення статусу замовлення {order_id_to_change}.")
-                    except Exception as e:
-                        logger.warning(f"Не вдалося надіслати сповіщення клієнту {client_id_from_order} про оновлення статусу: {e}")
-
-                await update.message.reply_text(f"✅ Статус замовлення `{order_id_to_change}` оновлено на: **{new_status}**", parse_mode="Markdown", reply_markup=manager_main_menu)
-                context.user_data.pop("manager_awaiting_order_id_for_status_change", None)
-                context.user_data.pop("temp_order_id_for_status_change", None)
-                context.user_data["manager_menu_state"] = "main"
-                logger.info(f"Менеджер {uid} оновив статус замовлення {order_id_to_change} на {new_status}.")
-            else:
-                await update.message.reply_text("Невідомий статус. Будь ласка, оберіть зі списку.", reply_markup=order_status_change_menu)
-                logger.warning(f"Менеджер {uid} спробував встановити невідомий статус для замовлення {order_id_to_change}.")
-            return
+    if not client_id_for_order or price_for_order is None or not manager_current_dialog == client_id_for_order:
+        await update.message.reply_text("❌ Виникла внутрішня помилка або діалог з клієнтом змінився. Спробуйте оформити замовлення знову.", reply_markup=active_dialog_client_buttons)
+        context.user_data.pop("manager_awaiting_order_description", None)
+        context.user_data.pop("temp_order_client_id", None)
+        context.user_data.pop("temp_order_price", None)
+        return
 
-        # Обробка кнопки "Назад" у режимі очікування номера замовлення для зміни статусу АБО вибору статусу
-        elif (context.user_data.get("manager_awaiting_order_id_for_status_change") or \
-              context.user_data.get("manager_menu_state") == "awaiting_status_selection") and text == "🔙 Назад":
-            context.user_data.pop("manager_awaiting_order_id_for_status_change", None)
-            context.user_data.pop("temp_order_id_for_status_change", None)
-            context.user_data["manager_menu_state"] = "requests_menu" # Повертаємо до меню запитів
-            await processed_orders_command(update, context) # Показуємо знову список замовлень, з якого йшли
-            logger.info(f"Менеджер {uid} повернувся до списку оформлених замовлень.")
-            return
+    description = update.message.text.strip()
+    # Генерація унікального ID замовлення
+    order_id_val = f"{random.randint(100000, 999999)}{str(client_id_for_order)[-4:]}"
+    if not await add_order(order_id_val, client_id_for_order, STATUS_LABELS[ASSEMBLING], price_for_order, description, changed_by=uid):
+        # Замовлення не збережено - клієнту нічого не повідомляємо, менеджер може спробувати ще раз
+        await update.message.reply_text(
+            "❌ Не вдалося зберегти замовлення. Спробуйте оформити його ще раз.", reply_markup=active_dialog_client_buttons
+        )
+        logger.error(f"Замовлення {order_id_val} для клієнта {client_id_for_order} не збережено.")
+        context.user_data.pop("manager_awaiting_order_description", None)
+        context.user_data.pop("temp_order_client_id", None)
+        context.user_data.pop("temp_order_price", None)
+        return
 
-        # --- ОБРОБКА ПОВІДОМЛЕНЬ В АКТИВНОМУ ДІАЛОЗІ МЕНЕДЖЕРА ---
-        manager_current_dialog = await get_manager_active_dialogs(MANAGER_ID)
-        if manager_current_dialog and \
-           context.user_data.get("manager_menu_state") == "active_dialog":
-            client_id_to_reply = manager_current_dialog
-            target_client_state = await get_client_state(client_id_to_reply)
-
-            # Проверяем, является ли сообщение одной из кнопок активного диалога менеджера
-            if text not in ["📦 Оформити замовлення", "📂 Архів повідомлень", "📜 Замовлення клієнта", "❌ Завершити діалог", "🔙 Назад"]:
-                if target_client_state and target_client_state.get("is_active"):
-                    await add_client_message(client_id_to_reply, "manager", text)
-                    try:
-                        await context.bot.send_message(client_id_to_reply, text)
-                        await update.message.reply_text(f"✅ Відповідь надіслано клієнту (ID: `{client_id_to_reply}`).", parse_mode="Markdown", reply_markup=active_dialog_client_buttons)
-                        logger.info(f"Менеджер {uid} відповів клієнту {client_id_to_reply}.")
-                    except Exception as e:
-                        logger.warning(f"Не вдалося надіслати повідомлення клієнту {client_id_to_reply}: {e}")
-                        await update.message.reply_text(f"❌ Не вдалося надіслати повідомлення клієнту (можливо, він заблокував бота).", reply_markup=active_dialog_client_buttons)
-                else:
-                    await update.message.reply_text(f"❌ Діалог з клієнтом (ID: `{client_id_to_reply}`) вже завершено.", parse_mode="Markdown", reply_markup=manager_main_menu)
-                    await update_manager_active_dialog(MANAGER_ID, None)
-                    logger.warning(f"Менеджер {uid} намагався відповісти неактивному клієнту {client_id_to_reply}.")
-                return
+    try:
+        await context.bot.send_message(client_id_for_order, f"📦 Ваше замовлення сформоване!\nНомер: `{order_id_val}`\n💰 Ціна: **{price_for_order:.2f} грн**\n📝 Опис: {description}", parse_mode="Markdown", reply_markup=end_dialog_client_button)
+    except Exception as e:
+        logger.warning(f"Не вдалося надіслати повідомлення клієнту {client_id_for_order} про оформлення замовлення: {e}")
 
-        # --- ОБРОБКА КНОПОК МЕНЕДЖЕРА ---
-        if text == "📊 Запити клієнтів":
-            await manager_requests_menu_handler(update, context)
-        elif text == "📝 Змінити баланс":
-            context.user_data["manager_awaiting_balance_client_id"] = True
-            await update.message.reply_text(
-                "🔢 Будь ласка, введіть Telegram ID клієнта, баланс якого ви хочете змінити:",
-                reply_markup=back_button
-            )
-            logger.info(f"Менеджер {uid} увійшов в режим зміни балансу (очікує ID клієнта).")
-        elif text == "📤 Експорт замовлень":
-            path = await export_orders_to_excel()
-            if path:
-                try:
-                    await context.bot.send_document(uid, document=open(path, "rb"))
-                except Exception as e:
-                    logger.error(f"Не вдалося надіслати файл експорту менеджеру {uid}: {e}")
-                    await update.message.reply_text("❌ Виникла помилка при відправці файлу.", reply_markup=manager_main_menu)
-                    return
-                os.remove(path)
-                logger.info(f"Менеджер {uid} експортував замовлення в Excel.")
-                await update.message.reply_text("✅ Замовлення експортовано.", reply_markup=manager_main_menu)
-            else:
-                await update.message.reply_text("📭 Немає замовлень для експорту.", reply_markup=manager_main_menu)
-        elif text == "🔍 Інфо по клієнту":
-            context.user_data["manager_awaiting_client_info_id"] = True
-            await update.message.reply_text("🔢 Введіть Telegram ID клієнта для отримання інформації:", reply_markup=back_button)
-            logger.info(f"Менеджер {uid} увійшов в режим запиту інфо про клієнта.")
-
-        # --- НОВІ КНОПКИ ПІДМЕНЮ "ЗАПИТИ КЛІЄНТІВ" ---
-        elif text == "💬 Активний діалог" and context.user_data.get("manager_menu_state") == "requests_menu":
-            await active_dialog_details_handler(update, context)
-        elif text == "📨 Нові запити" and context.user_data.get("manager_menu_state") == "requests_menu":
-            await new_requests_command(update, context)
-        elif text == "✅ Оформлені замовлення" and context.user_data.get("manager_menu_state") == "requests_menu":
-            await processed_orders_command(update, context)
-
-        # --- КНОПКИ В МЕНЮ АКТИВНОГО ДІАЛОГУ ---
-        elif text == "📦 Оформити замовлення" and context.user_data.get("manager_menu_state") == "active_dialog":
-            manager_current_dialog = await get_manager_active_dialogs(MANAGER_ID)
-            if manager_current_dialog:
-                context.user_data["manager_awaiting_order_price"] = True
-                context.user_data["temp_order_client_id"] = manager_current_dialog
-                await update.message.reply_text("🔢 Будь ласка, введіть ціну замовлення (число, наприклад, `1250.75`):", parse_mode="Markdown", reply_markup=back_button)
-                logger.info(f"Менеджер {uid} ініціював оформлення замовлення для клієнта {manager_current_dialog}.")
-            else:
-                await update.message.reply_text("❌ Для оформлення замовлення спочатку візьміть клієнта в роботу.", reply_markup=active_dialog_client_buttons)
-        elif text == "📂 Архів повідомлень" and context.user_data.get("manager_menu_state") == "active_dialog":
-            manager_current_dialog = await get_manager_active_dialogs(MANAGER_ID)
-            if manager_current_dialog:
-                await send_dialog_archive(manager_current_dialog, context)
-                await update.message.reply_text("✅ Архів повідомлень надіслано.", reply_markup=active_dialog_client_buttons)
-            else:
-                await update.message.reply_text("❌ Немає активного діалогу для перегляду архіву.", reply_markup=active_dialog_client_buttons)
-        elif text == "📜 Замовлення клієнта" and context.user_data.get("manager_menu_state") == "active_dialog":
-            manager_current_dialog = await get_manager_active_dialogs(MANAGER_ID)
-            if manager_current_dialog:
-                client_orders = await get_client_orders(manager_current_dialog)
-                if client_orders:
-                    orders_text = f"📜 **Історія замовлень клієнта (ID: `{manager_current_dialog}`):**\n\n"
-                    for order in client_orders:
-                        order_id = order.get('order_id', 'N/A')
-                        orders_text += f"📦 Номер: `{order_id}`\n"
-                        orders_text += f"📊 Статус: **{order.get('status', 'N/A')}**\n"
-                        if order.get('price') is not None:
-                            orders_text += f"💰 Ціна: **{order['price']:.2f} грн**\n"
-                        if order.get('description'):
-                            orders_text += f"📝 Опис: {order['description']}\n"
-                        orders_text += f"📅 Дата: {order.get('created_at', datetime.now()).strftime('%d.%m.%Y %H:%M:%S')}\n"
-                        orders_text += "\n"
-                    await update.message.reply_text(orders_text, parse_mode="Markdown", reply_markup=active_dialog_client_buttons)
-                else:
-                    await update.message.reply_text(f"📭 У клієнта (ID: `{manager_current_dialog}`) немає оформлених замовлень.", parse_mode="Markdown", reply_markup=active_dialog_client_buttons)
-                logger.info(f"Менеджер {uid} переглянув замовлення клієнта {manager_current_dialog}.")
-            else:
-                await update.message.reply_text("❌ Немає активного діалогу для перегляду замовлень.", reply_markup=active_dialog_client_buttons)
-        elif text == "❌ Завершити діалог" and context.user_data.get("manager_menu_state") == "active_dialog":
-            manager_current_dialog = await get_manager_active_dialogs(MANAGER_ID)
-            if manager_current_dialog:
-                await close_client_dialog(manager_current_dialog, context, "менеджером (з меню активного діалогу)")
-                await update.message.reply_text(f"✅ Активний діалог з клієнтом (ID: `{manager_current_dialog}`) завершено.", parse_mode="Markdown", reply_markup=manager_main_menu)
-                context.user_data["manager_menu_state"] = "main"
-            else:
-                await update.message.reply_text("❌ Наразі немає активного діалогу для завершення.", reply_markup=active_dialog_client_buttons)
-            logger.info(f"Менеджер {uid} завершив діалог через кнопку в активному діалозі.")
+    try:
+        await context.bot.send_message(uid, # Надсилаємо саме менеджеру, який оформив
+                                       f"📦 Замовлення оформлено!\nНомер: `{order_id_val}`\n💰 Ціна: **{price_for_order:.2f} грн**\n📝 Опис: {description}",
+                                       parse_mode="Markdown")
+    except Exception as e:
+        logger.warning(f"Не вдалося надіслати повідомлення менеджеру {uid} про оформлення замовлення: {e}")
 
-        # --- КНОПКИ В МЕНЮ ОФОРМЛЕНИХ ЗАМОВЛЕНЬ ---
-        elif text == "✏️ Змінити статус замовлення" and context.user_data.get("manager_menu_state") == "processed_orders_list":
-            context.user_data["manager_awaiting_order_id_for_status_change"] = True
-            await update.message.reply_text(
-                "🔢 Будь ласка, введіть номер замовлення, статус якого ви хочете змінити:",
-                reply_markup=back_button
-            )
-            logger.info(f"Менеджер {uid} ініціював зміну статусу замовлення.")
-
-        # --- ОБРОБКА КНОПКИ "НАЗАД" В МЕНЮ МЕНЕДЖЕРА ТА ЇЇ ПІДМЕНЮ ---
-        elif text == "🔙 Назад":
-            current_manager_state = context.user_data.get("manager_menu_state")
-
-            if context.user_data.get("manager_awaiting_balance_client_id") or \
-               context.user_data.get("manager_awaiting_balance_amount") or \
-               context.user_data.get("manager_awaiting_client_info_id") or \
-               context.user_data.get("manager_awaiting_order_price") or \
-               context.user_data.get("manager_awaiting_order_description"):
-                # Якщо ми були в режимі очікування вводу, повертаємось в головне меню менеджера
-                context.user_data.pop("manager_awaiting_balance_client_id", None)
-                context.user_data.pop("manager_awaiting_balance_amount", None)
-                context.user_data.pop("temp_client_id_for_balance", None)
-                context.user_data.pop("manager_awaiting_client_info_id", None)
-                context.user_data.pop("manager_awaiting_order_price", None)
-                context.user_data.pop("manager_awaiting_order_description", None)
-                context.user_data.pop("temp_order_client_id", None)
-                context.user_data.pop("temp_order_price", None)
-                context.user_data["manager_menu_state"] = "main"
-                await update.message.reply_text("🔙 Повертаємось до головного меню менеджера.", reply_markup=manager_main_menu)
-                logger.info(f"Менеджер {uid} повернувся до головного меню менеджера з режиму очікування вводу.")
-            elif current_manager_state == "requests_menu":
-                context.user_data["manager_menu_state"] = "main"
-                await update.message.reply_text("🔙 Повертаємось до головного меню менеджера.", reply_markup=manager_main_menu)
-                logger.info(f"Менеджер {uid} повернувся до головного меню менеджера з меню запитів.")
-            elif current_manager_state == "active_dialog":
-                context.user_data["manager_menu_state"] = "requests_menu"
-                await update.message.reply_text("🔙 Повертаємось до меню запитів.", reply_markup=manager_requests_menu)
-                logger.info(f"Менеджер {uid} повернувся до меню запитів з активного діалогу.")
-            elif current_manager_state == "new_requests_list":
-                context.user_data["manager_menu_state"] = "requests_menu"
-                await update.message.reply_text("🔙 Повертаємось до меню запитів.", reply_markup=manager_requests_menu)
-                logger.info(f"Менеджер {uid} повернувся до меню запитів з нових запитів.")
-            elif current_manager_state == "processed_orders_list":
-                context.user_data["manager_menu_state"] = "requests_menu"
-                await update.message.reply_text("🔙 Повертаємось до меню запитів.", reply_markup=manager_requests_menu)
-                logger.info(f"Менеджер {uid} повернувся до меню запитів з оформлених замовлень.")
-            else:
-                await update.message.reply_text("🤖 Я вас не розумію. Скористайтесь меню менеджера.", reply_markup=manager_main_menu)
-                logger.info(f"Менеджер {uid} надіслав нерозпізнане повідомлення '{text}' у неактивному діалозі.")
-            return
+    await update.message.reply_text(f"✅ Замовлення `{order_id_val}` оформлено для клієнта `{client_id_for_order}`.", parse_mode="Markdown", reply_markup=active_dialog_client_buttons)
+    logger.info(f"Менеджер {uid} оформив замовлення {order_id_val} для клієнта {client_id_for_order} з ціною {price_for_order} та описом '{description}'.")
 
-        # Якщо менеджер ввів щось, що не є кнопкою і не є частиною режиму очікування вводу
-        else:
-            await update.message.reply_text("🤖 Я вас не розумію. Скористайтесь меню менеджера.", reply_markup=manager_main_menu)
-            logger.info(f"Менеджер {uid} надіслав нерозпізнане повідомлення '{text}' у неактивному діалозі.")
-        return # Важливо вийти з функції, якщо повідомлення оброблене менеджером
+    context.user_data.pop("manager_awaiting_order_description", None)
+    context.user_data.pop("temp_order_client_id", None)
+    context.user_data.pop("temp_order_price", None)
 
-    # --- ЛОГІКА ДЛЯ КЛІЄНТА ---
-    if text == "📦 Зробити запит/замовлення":
-        # Якщо клієнт вже був в активному діалозі, завершуємо його перед створенням нового
-        if client_db_state.get("is_active"):
-            await close_client_dialog(uid, context, "автоматично (новий запит)")
+async def manager_status_selected(update: Update, context: ContextTypes.DEFAULT_TYPE, client_db_state: Dict[str, Any]):
+    uid = update.effective_user.id
+    order_id_to_change = context.user_data.get("temp_order_id_for_status_change")
+    if not order_id_to_change:
+        await update.message.reply_text("❌ Виникла помилка: не знайдено ID замовлення для зміни статусу. Спробуйте ще раз.", reply_markup=manager_main_menu)
+        context.user_data.pop("manager_awaiting_order_id_for_status_change", None)
+        context.user_data.pop("temp_order_id_for_status_change", None)
+        context.user_data["manager_menu_state"] = "main"
+        return
 
-        await update_client_active_status(uid, is_active=True)
-        await update_client_notified_status(uid, is_notified=False) # Скидаємо прапорець сповіщення
-        await update.message.reply_text(
-            "✍️ Напишіть повідомлення. Менеджер відповість найближчим часом.",
-            reply_markup=end_dialog_client_button
-        )
-        context.user_data["client_menu_state"] = "active_dialog"
-        logger.info(f"Клієнт {uid} ініціював запит/замовлення.")
+    new_status = ORDER_STATUS_BUTTONS[update.message.text]
+    await update_order_status(order_id_to_change, new_status, changed_by=uid)
+    client_id_from_order = await get_client_id_by_order_id(order_id_to_change)
+    if client_id_from_order:
+        try:
+            await context.bot.send_message(client_id_from_order, f"📦 Новий статус вашого замовлення:\n**{new_status}**", parse_mode="Markdown")
+            logger.info(f"Клієнту {client_id_from_order} надіслано оновлення статусу замовлення {order_id_to_change}.")
+        except Exception as e:
+            logger.warning(f"Не вдалося надіслати сповіщення клієнту {client_id_from_order} про оновлення статусу: {e}")
 
-    elif text == "❌ Завершити діалог":
-        await close_client_dialog(uid, context, "клієнтом")
-        context.user_data["client_menu_state"] = "main"
-        logger.info(f"Клієнт {uid} натиснув 'Завершити діалог'.")
+    await update.message.reply_text(f"✅ Статус замовлення `{order_id_to_change}` оновлено на: **{new_status}**", parse_mode="Markdown", reply_markup=manager_main_menu)
+    context.user_data.pop("manager_awaiting_order_id_for_status_change", None)
+    context.user_data.pop("temp_order_id_for_status_change", None)
+    context.user_data["manager_menu_state"] = "main"
+    logger.info(f"Менеджер {uid} оновив статус замовлення {order_id_to_change} на {new_status}.")
 
-    elif text == "ℹ️ Інформація":
-        await update.message.reply_text("ℹ️ Виберіть:", reply_markup=info_menu)
-        context.user_data["client_menu_state"] = "info"
-        logger.info(f"Клієнт {uid} перейшов в меню 'Інформація'.")
+# --- МЕНЕДЖЕР: КНОПКИ ГОЛОВНОГО МЕНЮ ТА МЕНЮ ЗАПИТІВ (діють у будь-якому стані) ---
 
-    elif text == "🎁 Мої бонуси":
+async def manager_open_requests_menu(update: Update, context: ContextTypes.DEFAULT_TYPE, client_db_state: Dict[str, Any]):
+    clear_manager_input(context)
+    await manager_requests_menu_handler(update, context)
+
+async def manager_start_balance_change(update: Update, context: ContextTypes.DEFAULT_TYPE, client_db_state: Dict[str, Any]):
+    clear_manager_input(context)
+    context.user_data["manager_awaiting_balance_client_id"] = True
+    await update.message.reply_text(
+        "🔢 Будь ласка, введіть Telegram ID клієнта, баланс якого ви хочете змінити:",
+        reply_markup=back_button
+    )
+    logger.info(f"Менеджер {update.effective_user.id} увійшов в режим зміни балансу (очікує ID клієнта).")
+
+async def manager_export_orders(update: Update, context: ContextTypes.DEFAULT_TYPE, client_db_state: Dict[str, Any]):
+    """Експортує лише замовлення, створені або змінені після попереднього експорту цього менеджера."""
+    uid = update.effective_user.id
+    clear_manager_input(context)
+    path, exported_until = await export_order_changes_to_excel(uid)
+    if exported_until is None:
+        await update.message.reply_text("❌ Виникла помилка при експорті замовлень.", reply_markup=manager_main_menu)
+        return
+    if path:
+        try:
+            await context.bot.send_document(uid, document=open(path, "rb"))
+        except Exception as e:
+            logger.error(f"Не вдалося надіслати файл експорту змін менеджеру {uid}: {e}")
+            await update.message.reply_text("❌ Виникла помилка при відправці файлу.", reply_markup=manager_main_menu)
+            return
+        finally:
+            os.remove(path)
+        # Позначка зсувається лише після доставки файлу, інакше зміни потрапять у наступний експорт
+        await commit_export_watermark(uid, exported_until)
+        logger.info(f"Менеджер {uid} експортував зміни замовлень в Excel.")
         await update.message.reply_text(
-            "🎁 Виберіть дію з бонусами:",
-            reply_markup=bonus_main_menu
+            "✅ Експортовано замовлення, нові або змінені з минулого експорту. Повний експорт: /export_full",
+            reply_markup=manager_main_menu
         )
-        context.user_data["awaiting_bonus_code"] = False # Скидаємо цей стан
-        context.user_data["client_menu_state"] = "bonus"
-        logger.info(f"Клієнт {uid} перейшов в меню 'Мої бонуси'.")
-
-    elif text == "💰 Перевірити баланс":
-        bonus_acc = await create_or_get_bonus_account(uid)
-        balance = bonus_acc.get("bonus_balance", Decimal('0.00')) if bonus_acc else Decimal('0.00') # Змінено 0.00 на Decimal('0.00')
+    else:
         await update.message.reply_text(
-            f"💰 Ваш поточний баланс бонусів: **{balance:.2f} грн**",
-            parse_mode="Markdown",
-            reply_markup=bonus_main_menu
+            "📭 З минулого експорту замовлення не змінювались. Повний експорт: /export_full",
+            reply_markup=manager_main_menu
         )
-        logger.info(f"Клієнт {uid} перевірив баланс бонусів.")
 
-    elif text == "⬆️ Ввести бонус-код":
-        context.user_data["awaiting_bonus_code"] = True
-        context.user_data["client_menu_state"] = "awaiting_bonus_code_input"
+async def export_full_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """/export_full - експорт усіх замовлень (позначку інкрементального експорту не змінює)."""
+    uid = update.effective_user.id
+    path = await export_orders_to_excel()
+    if path:
+        try:
+            await context.bot.send_document(uid, document=open(path, "rb"))
+        except Exception as e:
+            logger.error(f"Не вдалося надіслати файл експорту менеджеру {uid}: {e}")
+            await update.message.reply_text("❌ Виникла помилка при відправці файлу.", reply_markup=manager_main_menu)
+            return
+        finally:
+            os.remove(path)
+        logger.info(f"Менеджер {uid} експортував усі замовлення в Excel.")
+        await update.message.reply_text("✅ Замовлення експортовано.", reply_markup=manager_main_menu)
+    else:
+        await update.message.reply_text("📭 Немає замовлень для експорту.", reply_markup=manager_main_menu)
+
+async def manager_start_client_info(update: Update, context: ContextTypes.DEFAULT_TYPE, client_db_state: Dict[str, Any]):
+    clear_manager_input(context)
+    context.user_data["manager_awaiting_client_info_id"] = True
+    await update.message.reply_text("🔢 Введіть Telegram ID клієнта для отримання інформації:", reply_markup=back_button)
+    logger.info(f"Менеджер {update.effective_user.id} увійшов в режим запиту інфо про клієнта.")
+
+async def manager_show_active_dialog(update: Update, context: ContextTypes.DEFAULT_TYPE, client_db_state: Dict[str, Any]):
+    clear_manager_input(context)
+    await active_dialog_details_handler(update, context)
+
+async def manager_show_new_requests(update: Update, context: ContextTypes.DEFAULT_TYPE, client_db_state: Dict[str, Any]):
+    clear_manager_input(context)
+    await new_requests_command(update, context)
+
+async def manager_show_processed_orders(update: Update, context: ContextTypes.DEFAULT_TYPE, client_db_state: Dict[str, Any]):
+    clear_manager_input(context)
+    await processed_orders_command(update, context)
+
+# --- МЕНЕДЖЕР: МЕНЮ АКТИВНОГО ДІАЛОГУ ---
+
+async def manager_active_dialog_text(update: Update, context: ContextTypes.DEFAULT_TYPE, client_db_state: Dict[str, Any]):
+    """Довільний текст або медіа менеджера в активному діалозі пересилається клієнту."""
+    uid = update.effective_user.id
+    client_id_to_reply = await get_manager_active_dialogs(uid)
+    if not client_id_to_reply:
+        await manager_unknown_message(update, context, client_db_state)
+        return
+
+    target_client_state = await get_client_state(client_id_to_reply)
+    if target_client_state and target_client_state.get("is_active"):
+        await add_client_message(client_id_to_reply, "manager", message_body(update.message), *extract_media(update.message))
+        try:
+            await relay_message(context.bot, client_id_to_reply, update.message)
+            await update.message.reply_text(f"✅ Відповідь надіслано клієнту (ID: `{client_id_to_reply}`).", parse_mode="Markdown", reply_markup=active_dialog_client_buttons)
+            logger.info(f"Менеджер {uid} відповів клієнту {client_id_to_reply}.")
+        except Exception as e:
+            logger.warning(f"Не вдалося надіслати повідомлення клієнту {client_id_to_reply}: {e}")
+            await update.message.reply_text(f"❌ Не вдалося надіслати повідомлення клієнту (можливо, він заблокував бота).", reply_markup=active_dialog_client_buttons)
+    else:
+        await update.message.reply_text(f"❌ Діалог з клієнтом (ID: `{client_id_to_reply}`) вже завершено.", parse_mode="Markdown", reply_markup=manager_main_menu)
+        await update_manager_active_dialog(uid, None)
+        logger.warning(f"Менеджер {uid} намагався відповісти неактивному клієнту {client_id_to_reply}.")
+
+async def manager_start_order(update: Update, context: ContextTypes.DEFAULT_TYPE, client_db_state: Dict[str, Any]):
+    uid = update.effective_user.id
+    manager_current_dialog = await get_manager_active_dialogs(uid)
+    if manager_current_dialog:
+        context.user_data["manager_awaiting_order_price"] = True
+        context.user_data["temp_order_client_id"] = manager_current_dialog
+        await update.message.reply_text("🔢 Будь ласка, введіть ціну замовлення (число, наприклад, `1250.75`):", parse_mode="Markdown", reply_markup=back_button)
+        logger.info(f"Менеджер {uid} ініціював оформлення замовлення для клієнта {manager_current_dialog}.")
+    else:
+        await update.message.reply_text("❌ Для оформлення замовлення спочатку візьміть клієнта в роботу.", reply_markup=active_dialog_client_buttons)
+
+async def manager_dialog_archive(update: Update, context: ContextTypes.DEFAULT_TYPE, client_db_state: Dict[str, Any]):
+    manager_current_dialog = await get_manager_active_dialogs(update.effective_user.id)
+    if manager_current_dialog:
+        await send_dialog_archive(manager_current_dialog, context)
+        await update.message.reply_text("✅ Архів повідомлень надіслано.", reply_markup=active_dialog_client_buttons)
+    else:
+        await update.message.reply_text("❌ Немає активного діалогу для перегляду архіву.", reply_markup=active_dialog_client_buttons)
+
+async def manager_dialog_client_orders(update: Update, context: ContextTypes.DEFAULT_TYPE, client_db_state: Dict[str, Any]):
+    uid = update.effective_user.id
+    manager_current_dialog = await get_manager_active_dialogs(uid)
+    if not manager_current_dialog:
+        await update.message.reply_text("❌ Немає активного діалогу для перегляду замовлень.", reply_markup=active_dialog_client_buttons)
+        return
+
+    client_orders = await get_client_orders(manager_current_dialog)
+    if client_orders:
+        orders_text = f"📜 **Історія замовлень клієнта (ID: `{manager_current_dialog}`):**\n\n"
+        for order in client_orders:
+            order_id = order.get('order_id', 'N/A')
+            orders_text += f"📦 Номер: `{order_id}`\n"
+            orders_text += f"📊 Статус: **{order.get('status', 'N/A')}**\n"
+            if order.get('price') is not None:
+                orders_text += f"💰 Ціна: **{order['price']:.2f} грн**\n"
+            if order.get('description'):
+                orders_text += f"📝 Опис: {order['description']}\n"
+            orders_text += f"📅 Дата: {order.get('created_at', datetime.now()).strftime('%d.%m.%Y %H:%M:%S')}\n"
+            orders_text += "\n"
+        await update.message.reply_text(orders_text, parse_mode="Markdown", reply_markup=active_dialog_client_buttons)
+    else:
+        if is_db_degraded():
+            await update.message.reply_text(DB_UNAVAILABLE_TEXT, reply_markup=active_dialog_client_buttons)
+            return
+        await update.message.reply_text(f"📭 У клієнта (ID: `{manager_current_dialog}`) немає оформлених замовлень.", parse_mode="Markdown", reply_markup=active_dialog_client_buttons)
+    logger.info(f"Менеджер {uid} переглянув замовлення клієнта {manager_current_dialog}.")
+
+async def manager_end_dialog(update: Update, context: ContextTypes.DEFAULT_TYPE, client_db_state: Dict[str, Any]):
+    uid = update.effective_user.id
+    manager_current_dialog = await get_manager_active_dialogs(uid)
+    if manager_current_dialog:
+        await close_client_dialog(manager_current_dialog, context, "менеджером (з меню активного діалогу)")
+        await update.message.reply_text(f"✅ Активний діалог з клієнтом (ID: `{manager_current_dialog}`) завершено.", parse_mode="Markdown", reply_markup=manager_main_menu)
+        context.user_data["manager_menu_state"] = "main"
+    else:
+        await update.message.reply_text("❌ Наразі немає активного діалогу для завершення.", reply_markup=active_dialog_client_buttons)
+    logger.info(f"Менеджер {uid} завершив діалог через кнопку в активному діалозі.")
+
+# --- МЕНЕДЖЕР: МЕНЮ ОФОРМЛЕНИХ ЗАМОВЛЕНЬ ---
+
+async def manager_start_status_change(update: Update, context: ContextTypes.DEFAULT_TYPE, client_db_state: Dict[str, Any]):
+    context.user_data["manager_awaiting_order_id_for_status_change"] = True
+    await update.message.reply_text(
+        "🔢 Будь ласка, введіть номер замовлення, статус якого ви хочете змінити:",
+        reply_markup=back_button
+    )
+    logger.info(f"Менеджер {update.effective_user.id} ініціював зміну статусу замовлення.")
+
+# --- МЕНЕДЖЕР: МАСОВА ЗМІНА СТАТУСУ ---
+# Менеджер позначає замовлення в інлайн-клавіатурі (або надсилає список номерів) і обирає статус.
+# Вибір зберігається в user_data: bulk_orders - [[order_id, status], ...], bulk_selected - позначені номери.
+
+def build_bulk_status_keyboard(orders: list, selected: list) -> InlineKeyboardMarkup:
+    selected_set = set(selected)
+    rows = []
+    order_buttons = [
+        InlineKeyboardButton(
+            f"{'☑️' if order_id in selected_set else '⬜'} {order_id} {status[:1] if status else ''}".rstrip(),
+            callback_data=f"bulk_t_{order_id}"
+        )
+        for order_id, status in orders[:BULK_STATUS_KEYBOARD_LIMIT]
+    ]
+    for i in range(0, len(order_buttons), 2):
+        rows.append(order_buttons[i:i + 2])
+    rows.append([InlineKeyboardButton(f"Вибрати всі / зняти ({len(selected_set)} з {len(orders)})", callback_data="bulk_all")])
+    status_buttons = [
+        InlineKeyboardButton(label, callback_data=f"bulk_s_{index}")
+        for index, label in enumerate(ORDER_STATUS_BUTTONS)
+    ]
+    rows.append(status_buttons[:2])
+    rows.append(status_buttons[2:])
+    rows.append([InlineKeyboardButton("❌ Скасувати", callback_data="bulk_cancel")])
+    return InlineKeyboardMarkup(rows)
+
+def clear_bulk_selection(context: ContextTypes.DEFAULT_TYPE):
+    context.user_data.pop("manager_awaiting_bulk_order_ids", None)
+    context.user_data.pop("bulk_orders", None)
+    context.user_data.pop("bulk_selected", None)
+
+async def manager_start_bulk_status_change(update: Update, context: ContextTypes.DEFAULT_TYPE, client_db_state: Dict[str, Any]):
+    uid = update.effective_user.id
+    orders = await get_all_active_orders()
+    context.user_data["bulk_orders"] = [[o["order_id"], o["status"]] for o in orders[:BULK_STATUS_KEYBOARD_LIMIT]]
+    context.user_data["bulk_selected"] = []
+    context.user_data["manager_awaiting_bulk_order_ids"] = True
+
+    await update.message.reply_text(
+        "📋 Позначте замовлення нижче або надішліть список номерів (через пробіл, кому чи з нового рядка), "
+        "потім оберіть новий статус.",
+        reply_markup=back_button
+    )
+    if orders:
+        note = ""
+        if len(orders) > BULK_STATUS_KEYBOARD_LIMIT:
+            note = f"\nПоказано {BULK_STATUS_KEYBOARD_LIMIT} з {len(orders)}; решту можна додати списком номерів."
         await update.message.reply_text(
-            "🔢 Будь ласка, введіть ваш бонусний код:",
-            reply_markup=back_button
+            f"📦 Активні замовлення:{note}",
+            reply_markup=build_bulk_status_keyboard(context.user_data["bulk_orders"], [])
         )
-        logger.info(f"Клієнт {uid} ініціював введення бонус-коду.")
-
-    elif context.user_data.get("awaiting_bonus_code"):
-        bonus_code_input = text.strip().upper()
-        code_details = await get_bonus_code_details(bonus_code_input)
-
-        if code_details and code_details["is_active"]:
-            value = Decimal(code_details["value"]) # Переконайтеся, що значення з бази даних також обробляється як Decimal
-            activated = await activate_bonus_code(code_details["id"], uid)
-            if activated:
-                await update_bonus_balance(uid, value)
-
-                if code_details.get("assigned_to_ig_user_id"):
-                    await link_instagram_to_telegram_account(uid, code_details["assigned_to_ig_user_id"])
-                    logger.info(f"Зв'язано IG ID {code_details['assigned_to_ig_user_id']} з TG ID {uid} через активацію бонусу.")
-
-                await update.message.reply_text(
-                    f"🎉 Вітаємо! Код `{bonus_code_input}` успішно активовано! Вам нараховано **{value:.2f} грн** бонусів.",
-                    parse_mode="Markdown",
-                    reply_markup=main_menu
-                )
-                logger.info(f"Клієнт {uid} активував бонусний код '{bonus_code_input}' на {value} грн.")
-            else:
-                await update.message.reply_text(
-                    "❌ Виникла помилка під час активації коду. Спробуйте пізніше або зверніться до підтримки.",
-                    reply_markup=main_menu
-                )
-                logger.error(f"Не вдалося активувати код {bonus_code_input} для {uid}.")
+    logger.info(f"Менеджер {uid} розпочав масову зміну статусу ({len(orders)} активних замовлень).")
+
+async def manager_input_bulk_order_ids(update: Update, context: ContextTypes.DEFAULT_TYPE, client_db_state: Dict[str, Any]):
+    uid = update.effective_user.id
+    order_ids = list(dict.fromkeys(x for x in re.split(r"[\s,;]+", update.message.text) if 0 < len(x) <= 50))
+    if not order_ids:
+        await update.message.reply_text("❌ Не знайдено жодного номера замовлення. Спробуйте ще раз або натисніть 'Назад'.", reply_markup=back_button)
+        return
+    known = {order_id: status for order_id, status in context.user_data.get("bulk_orders", [])}
+    orders = [[order_id, known.get(order_id, "")] for order_id in order_ids]
+    context.user_data["bulk_orders"] = orders
+    context.user_data["bulk_selected"] = order_ids
+    await update.message.reply_text(
+        f"📦 Вибрано замовлень: {len(order_ids)}. Оберіть новий статус:",
+        reply_markup=build_bulk_status_keyboard(orders, order_ids)
+    )
+    logger.info(f"Менеджер {uid} надіслав список з {len(order_ids)} замовлень для масової зміни статусу.")
+
+async def notify_clients_about_status(bot, updated_orders: list[Dict[str, Any]], new_status: str):
+    """Надсилає клієнтам сповіщення про новий статус: одне повідомлення на клієнта, з обмеженням швидкості."""
+    orders_by_client: Dict[int, list[str]] = {}
+    for order in updated_orders:
+        orders_by_client.setdefault(order["client_id"], []).append(order["order_id"])
+    messages = []
+    for client_id, order_ids in orders_by_client.items():
+        if len(order_ids) == 1:
+            text = f"📦 Новий статус вашого замовлення `{order_ids[0]}`:\n**{new_status}**"
+        else:
+            text = f"📦 Новий статус ваших замовлень {', '.join(f'`{o}`' for o in order_ids)}:\n**{new_status}**"
+        messages.append((client_id, text, {"parse_mode": "Markdown"}))
+    sent, failed = await send_many(bot, messages)
+    logger.info(f"Сповіщення про статус '{new_status}': надіслано {sent}, не доставлено {failed}.")
+
+async def handle_bulk_status_callback(query, context: ContextTypes.DEFAULT_TYPE):
+    manager_id = query.from_user.id
+    data = query.data
+    orders = context.user_data.get("bulk_orders")
+    selected = context.user_data.get("bulk_selected", [])
+    if orders is None:
+        await query.edit_message_text("⌛ Вибір замовлень застарів. Натисніть '📦 Масова зміна статусу' ще раз.")
+        return
+
+    if data == "bulk_cancel":
+        clear_bulk_selection(context)
+        await query.edit_message_text("❌ Масову зміну статусу скасовано.")
+        logger.info(f"Менеджер {manager_id} скасував масову зміну статусу.")
+        return
+
+    if data.startswith("bulk_t_") or data == "bulk_all":
+        if data == "bulk_all":
+            selected = [] if len(selected) == len(orders) else [order_id for order_id, _ in orders]
+        else:
+            order_id = data[len("bulk_t_"):]
+            selected = [o for o in selected if o != order_id] if order_id in selected else selected + [order_id]
+        context.user_data["bulk_selected"] = selected
+        try:
+            await query.edit_message_reply_markup(reply_markup=build_bulk_status_keyboard(orders, selected))
+        except BadRequest as e:
+            if "Message is not modified" not in str(e):
+                raise
+        return
+
+    if data.startswith("bulk_s_"):
+        if not selected:
+            await context.bot.send_message(manager_id, "☝️ Спочатку позначте хоча б одне замовлення.")
+            return
+        new_status = list(ORDER_STATUS_BUTTONS.values())[int(data[len("bulk_s_"):])]
+        updated = await bulk_update_order_status(selected, new_status, changed_by=manager_id)
+        updated_ids = {o["order_id"] for o in updated}
+        missing = [o for o in selected if o not in updated_ids]
+        clear_bulk_selection(context)
+
+        # Клієнтів повідомляємо лише про замовлення, статус яких справді змінився
+        changed = [o for o in updated if o["changed"]]
+        summary = f"✅ Статус **{new_status}** встановлено для {len(changed)} замовлень."
+        if len(changed) < len(updated):
+            summary += f"\nℹ️ Вже мали цей статус: {len(updated) - len(changed)}"
+        if missing:
+            summary += f"\n❌ Не знайдено: {', '.join(f'`{o}`' for o in missing)}"
+        await query.edit_message_text(summary, parse_mode="Markdown")
+        logger.info(f"Менеджер {manager_id} змінив статус {len(changed)} замовлень на {new_status}.")
+        # Сповіщення клієнтам надсилаються у фоні, щоб не затримувати відповідь менеджеру
+        if changed:
+            context.application.create_task(notify_clients_about_status(context.bot, changed, new_status))
+
+# --- МЕНЕДЖЕР: КНОПКА "НАЗАД" ---
+
+async def manager_back_from_input(update: Update, context: ContextTypes.DEFAULT_TYPE, client_db_state: Dict[str, Any]):
+    # Якщо ми були в режимі очікування вводу, повертаємось в головне меню менеджера
+    clear_manager_input(context)
+    context.user_data["manager_menu_state"] = "main"
+    await update.message.reply_text("🔙 Повертаємось до головного меню менеджера.", reply_markup=manager_main_menu)
+    logger.info(f"Менеджер {update.effective_user.id} повернувся до головного меню менеджера з режиму очікування вводу.")
+
+async def manager_back_from_status_change(update: Update, context: ContextTypes.DEFAULT_TYPE, client_db_state: Dict[str, Any]):
+    context.user_data.pop("manager_awaiting_order_id_for_status_change", None)
+    context.user_data.pop("manager_awaiting_bulk_order_ids", None)
+    context.user_data.pop("temp_order_id_for_status_change", None)
+    context.user_data["manager_menu_state"] = "requests_menu" # Повертаємо до меню запитів
+    await processed_orders_command(update, context) # Показуємо знову список замовлень, з якого йшли
+    logger.info(f"Менеджер {update.effective_user.id} повернувся до списку оформлених замовлень.")
+
+async def manager_back_to_main(update: Update, context: ContextTypes.DEFAULT_TYPE, client_db_state: Dict[str, Any]):
+    context.user_data["manager_menu_state"] = "main"
+    await update.message.reply_text("🔙 Повертаємось до головного меню менеджера.", reply_markup=manager_main_menu)
+    logger.info(f"Менеджер {update.effective_user.id} повернувся до головного меню менеджера з меню запитів.")
+
+async def manager_back_to_requests_menu(update: Update, context: ContextTypes.DEFAULT_TYPE, client_db_state: Dict[str, Any]):
+    previous_state = context.user_data.get("manager_menu_state")
+    context.user_data["manager_menu_state"] = "requests_menu"
+    await update.message.reply_text("🔙 Повертаємось до меню запитів.", reply_markup=manager_requests_menu)
+    logger.info(f"Менеджер {update.effective_user.id} повернувся до меню запитів зі стану '{previous_state}'.")
+
+async def manager_unknown_message(update: Update, context: ContextTypes.DEFAULT_TYPE, client_db_state: Dict[str, Any]):
+    # Якщо менеджер ввів щось, що не є кнопкою і не є частиною режиму очікування вводу
+    await update.message.reply_text("🤖 Я вас не розумію. Скористайтесь меню менеджера.", reply_markup=manager_main_menu)
+    logger.info(f"Менеджер {update.effective_user.id} надіслав нерозпізнане повідомлення '{update.message.text}' у неактивному діалозі.")
+
+# --- КЛІЄНТ ---
+
+async def client_new_request(update: Update, context: ContextTypes.DEFAULT_TYPE, client_db_state: Dict[str, Any]):
+    uid = update.effective_user.id
+    # Якщо клієнт вже був в активному діалозі, завершуємо його перед створенням нового
+    if client_db_state.get("is_active"):
+        await close_client_dialog(uid, context, "автоматично (новий запит)")
+
+    await update_client_active_status(uid, is_active=True)
+    await update_client_notified_status(uid, is_notified=False) # Скидаємо прапорець сповіщення
+    track_client(uid, datetime.now(timezone.utc))
+    await update.message.reply_text(
+        "✍️ Напишіть повідомлення. Менеджер відповість найближчим часом.",
+        reply_markup=end_dialog_client_button
+    )
+    context.user_data["client_menu_state"] = "active_dialog"
+    logger.info(f"Клієнт {uid} ініціював запит/замовлення.")
+
+async def client_end_dialog(update: Update, context: ContextTypes.DEFAULT_TYPE, client_db_state: Dict[str, Any]):
+    uid = update.effective_user.id
+    await close_client_dialog(uid, context, "клієнтом")
+    context.user_data["client_menu_state"] = "main"
+    logger.info(f"Клієнт {uid} натиснув 'Завершити діалог'.")
+
+async def client_info_menu(update: Update, context: ContextTypes.DEFAULT_TYPE, client_db_state: Dict[str, Any]):
+    await update.message.reply_text("ℹ️ Виберіть:", reply_markup=info_menu)
+    context.user_data["client_menu_state"] = "info"
+    logger.info(f"Клієнт {update.effective_user.id} перейшов в меню 'Інформація'.")
+
+async def client_bonus_menu(update: Update, context: ContextTypes.DEFAULT_TYPE, client_db_state: Dict[str, Any]):
+    await update.message.reply_text(
+        "🎁 Виберіть дію з бонусами:",
+        reply_markup=bonus_main_menu
+    )
+    context.user_data["awaiting_bonus_code"] = False # Скидаємо цей стан
+    context.user_data["client_menu_state"] = "bonus"
+    logger.info(f"Клієнт {update.effective_user.id} перейшов в меню 'Мої бонуси'.")
+
+async def client_check_balance(update: Update, context: ContextTypes.DEFAULT_TYPE, client_db_state: Dict[str, Any]):
+    uid = update.effective_user.id
+    bonus_acc = await create_or_get_bonus_account(uid)
+    balance = bonus_acc.get("bonus_balance", Decimal('0.00')) if bonus_acc else Decimal('0.00') # Змінено 0.00 на Decimal('0.00')
+    await update.message.reply_text(
+        f"💰 Ваш поточний баланс бонусів: **{balance:.2f} грн**",
+        parse_mode="Markdown",
+        reply_markup=bonus_main_menu
+    )
+    logger.info(f"Клієнт {uid} перевірив баланс бонусів.")
+
+async def client_start_bonus_code(update: Update, context: ContextTypes.DEFAULT_TYPE, client_db_state: Dict[str, Any]):
+    context.user_data["awaiting_bonus_code"] = True
+    context.user_data["client_menu_state"] = "awaiting_bonus_code_input"
+    await update.message.reply_text(
+        "🔢 Будь ласка, введіть ваш бонусний код:",
+        reply_markup=back_button
+    )
+    logger.info(f"Клієнт {update.effective_user.id} ініціював введення бонус-коду.")
+
+async def client_bonus_code_input(update: Update, context: ContextTypes.DEFAULT_TYPE, client_db_state: Dict[str, Any]):
+    uid = update.effective_user.id
+    bonus_code_input = update.message.text.strip().upper()
+    code_details = await get_bonus_code_details(bonus_code_input)
+
+    if code_details and code_details["is_active"]:
+        value = Decimal(code_details["value"]) # Переконайтеся, що значення з бази даних також обробляється як Decimal
+        activated = await activate_bonus_code(code_details["id"], uid)
+        if activated:
+            await update_bonus_balance(uid, value)
+
+            if code_details.get("assigned_to_ig_user_id"):
+                await link_instagram_to_telegram_account(uid, code_details["assigned_to_ig_user_id"])
+                logger.info(f"Зв'язано IG ID {code_details['assigned_to_ig_user_id']} з TG ID {uid} через активацію бонусу.")
+
+            await update.message.reply_text(
+                f"🎉 Вітаємо! Код `{bonus_code_input}` успішно активовано! Вам нараховано **{value:.2f} грн** бонусів.",
+                parse_mode="Markdown",
+                reply_markup=main_menu
+            )
+            logger.info(f"Клієнт {uid} активував бонусний код '{bonus_code_input}' на {value} грн.")
         else:
             await update.message.reply_text(
-                "❌ Невірний або вже використаний бонусний код. Перевірте та спробуйте ще раз.",
+                "❌ Виникла помилка під час активації коду. Спробуйте пізніше або зверніться до підтримки.",
                 reply_markup=main_menu
             )
-            logger.warning(f"Клієнт {uid} ввів невірний/використаний бонусний код: '{bonus_code_input}'.")
-        context.user_data.pop("awaiting_bonus_code", None)
-        context.user_data["client_menu_state"] = "main"
-        logger.info(f"Клієнт {uid} завершив введення бонус-коду.")
-
-    elif text == "📦 Доставка":
+            logger.error(f"Не вдалося активувати код {bonus_code_input} для {uid}.")
+    else:
         await update.message.reply_text(
-            "📦 Замовлення їдуть з Європи\n⏱️ 3–5 робочих днів\n"
-            "📮 Далі відправка Новою Поштою або іншим перевізником\n"
-            "📬 Доставка згідно тарифів перевізника\n"
-            "🚚 Безкоштовна доставка при замовленні від 3000 грн", reply_markup=back_button
+            "❌ Невірний або вже використаний бонусний код. Перевірте та спробуйте ще раз.",
+            reply_markup=main_menu
         )
-        context.user_data["client_menu_state"] = "info_delivery"
-        logger.info(f"Клієнт {uid} переглянув 'Доставку'.")
-
-    elif text == "📞 Контакти":
-        keyboard = InlineKeyboardMarkup([
-            [InlineKeyboardButton("📲 Telegram", url="https://t.me/zapchastimarket69")],
-            [InlineKeyboardButton("📸 Instagram", url="https://www.instagram.com/zapchastimarket69")],
-        ])
-        await update.message.reply_text("📲 Наші контакти:", reply_markup=keyboard)
-        context.user_data["client_menu_state"] = "info_contacts"
-        logger.info(f"Клієнт {uid} переглянув 'Контакти'.")
-
-    elif text == "👥 Про нас":
-        await update.message.reply_text(
-            """🧰 Ми – Zapchasti Market 69.
+        logger.warning(f"Клієнт {uid} ввів невірний/використаний бонусний код: '{bonus_code_input}'.")
+    context.user_data.pop("awaiting_bonus_code", None)
+    context.user_data["client_menu_state"] = "main"
+    logger.info(f"Клієнт {uid} завершив введення бонус-коду.")
+
+async def client_delivery_info(update: Update, context: ContextTypes.DEFAULT_TYPE, client_db_state: Dict[str, Any]):
+    await update.message.reply_text(
+        "📦 Замовлення їдуть з Європи\n⏱️ 3–5 робочих днів\n"
+        "📮 Далі відправка Новою Поштою або іншим перевізником\n"
+        "📬 Доставка згідно тарифів перевізника\n"
+        "🚚 Безкоштовна доставка при замовленні від 3000 грн", reply_markup=back_button
+    )
+    context.user_data["client_menu_state"] = "info_delivery"
+    logger.info(f"Клієнт {update.effective_user.id} переглянув 'Доставку'.")
+
+async def client_contacts(update: Update, context: ContextTypes.DEFAULT_TYPE, client_db_state: Dict[str, Any]):
+    keyboard = InlineKeyboardMarkup([
+        [InlineKeyboardButton("📲 Telegram", url="https://t.me/zapchastimarket69")],
+        [InlineKeyboardButton("📸 Instagram", url="https://www.instagram.com/zapchastimarket69")],
+    ])
+    await update.message.reply_text("📲 Наші контакти:", reply_markup=keyboard)
+    context.user_data["client_menu_state"] = "info_contacts"
+    logger.info(f"Клієнт {update.effective_user.id} переглянув 'Контакти'.")
+
+async def client_about_us(update: Update, context: ContextTypes.DEFAULT_TYPE, client_db_state: Dict[str, Any]):
+    await update.message.reply_text(
+        """🧰 Ми – Zapchasti Market 69.
 🔩 Продаємо оригінальні автозапчастини з Європи
 💸 Найкращі ціни
 📍 Доставка по Україні
 🔍 Підбір по VIN та коду запчастини
 💬 Пиши — підберу як для себе!""",
-            reply_markup=back_button
-        )
-        context.user_data["client_menu_state"] = "info_about_us"
-        logger.info(f"Клієнт {uid} переглянув 'Про нас'.")
-
-    elif text == "🔍 Перевірити замовлення":
-        client_orders = await get_client_orders(uid)
-        if client_orders:
-            orders_text = "📜 **Ваша історія замовлень:**\n\n"
-            for order in client_orders:
-                order_id = order.get('order_id', 'N/A')
-                orders_text += f"📦 Номер: `{order_id}`\n"
-                orders_text += f"📊 Статус: **{order.get('status', 'N/A')}**\n"
-                if order.get('price') is not None:
-                    orders_text += f"💰 Ціна: **{order['price']:.2f} грн**\n"
-                if order.get('description'):
-                    orders_text += f"📝 Опис: {order['description']}\n"
-                orders_text += f"📅 Дата: {order.get('created_at', datetime.now()).strftime('%d.%m.%Y %H:%M:%S')}\n"
-                orders_text += "\n"
-            await update.message.reply_text(orders_text, parse_mode="Markdown", reply_markup=main_menu)
-            logger.info(f"Клієнт {uid} переглянув свою історію замовлень.")
-        else:
-            await update.message.reply_text("📭 У вас немає оформлених замовлень.", reply_markup=main_menu)
-            logger.info(f"Клієнт {uid} не має оформлених замовлень.")
-        context.user_data["client_menu_state"] = "main"
-        return
+        reply_markup=back_button
+    )
+    context.user_data["client_menu_state"] = "info_about_us"
+    logger.info(f"Клієнт {update.effective_user.id} переглянув 'Про нас'.")
 
-    elif text == "🎯 Акція":
-        await update.message.reply_text(
-            "🎯 Акція: Безкоштовна доставка при замовленні пари гальмівних дисків\n"
-            "📅 Термін дії: 01.07.2025 – 31.08.2025", reply_markup=back_button
-        )
-        context.user_data["client_menu_state"] = "promo"
-        logger.info(f"Клієнт {uid} переглянув 'Акцію'.")
-
-    elif text == "🔙 Назад":
-        client_current_state = context.user_data.get("client_menu_state")
-
-        if client_current_state == "awaiting_bonus_code_input":
-            context.user_data.pop("awaiting_bonus_code", None)
-            context.user_data["client_menu_state"] = "bonus"
-            await update.message.reply_text("🔙 Повертаємось до меню бонусів.", reply_markup=bonus_main_menu)
-            logger.info(f"Клієнт {uid} вийшов з режиму введення коду.")
-        elif client_current_state in ["info_delivery", "info_contacts", "info_about_us"]:
-            context.user_data["client_menu_state"] = "info"
-            await update.message.reply_text("🔙 Повертаємось до меню інформації.", reply_markup=info_menu)
-            logger.info(f"Клієнт {uid} повернувся до меню інформації.")
-        elif client_current_state == "bonus":
-            context.user_data["client_menu_state"] = "main"
-            await update.message.reply_text("🔙 Повертаємось до головного меню.", reply_markup=main_menu)
-            logger.info(f"Клієнт {uid} повернувся до головного меню з меню бонусів.")
-        elif client_current_state == "info":
-            context.user_data["client_menu_state"] = "main"
-            await update.message.reply_text("🔙 Повертаємось до головного меню.", reply_markup=main_menu)
-            logger.info(f"Клієнт {uid} повернувся до головного меню з меню інформації.")
-        elif client_current_state == "promo":
-            context.user_data["client_menu_state"] = "main"
-            await update.message.reply_text("🔙 Повертаємось до головного меню.", reply_markup=main_menu)
-            logger.info(f"Клієнт {uid} повернувся до головного меню з меню акції.")
-        elif client_current_state == "active_dialog":
-            await update.message.reply_text("Ви вже в активному діалозі. Щоб завершити, натисніть '❌ Завершити діалог'.", reply_markup=end_dialog_client_button)
-            logger.info(f"Клієнт {uid} спробував натиснути 'Назад' в активному діалозі.")
-        else:
-            await update.message.reply_text("🤖 Я вас не розумію. Скористайтесь меню.", reply_markup=main_menu)
-            context.user_data["client_menu_state"] = "main"
-            logger.info(f"Клієнт {uid} надіслав нерозпізнане повідомлення '{text}' у невідомому стані.")
+async def client_check_orders(update: Update, context: ContextTypes.DEFAULT_TYPE, client_db_state: Dict[str, Any]):
+    uid = update.effective_user.id
+    client_orders = await get_client_orders(uid)
+    if client_orders:
+        orders_text = "📜 **Ваша історія замовлень:**\n\n"
+        for order in client_orders:
+            order_id = order.get('order_id', 'N/A')
+            orders_text += f"📦 Номер: `{order_id}`\n"
+            orders_text += f"📊 Статус: **{order.get('status', 'N/A')}**\n"
+            if order.get('price') is not None:
+                orders_text += f"💰 Ціна: **{order['price']:.2f} грн**\n"
+            if order.get('description'):
+                orders_text += f"📝 Опис: {order['description']}\n"
+            orders_text += f"📅 Дата: {order.get('created_at', datetime.now()).strftime('%d.%m.%Y %H:%M:%S')}\n"
+            orders_text += "\n"
+        await update.message.reply_text(orders_text, parse_mode="Markdown", reply_markup=main_menu)
+        logger.info(f"Клієнт {uid} переглянув свою історію замовлень.")
+    else:
+        if is_db_degraded():
+            await update.message.reply_text(DB_UNAVAILABLE_TEXT, reply_markup=main_menu)
+            return
+        await update.message.reply_text("📭 У вас немає оформлених замовлень.", reply_markup=main_menu)
+        logger.info(f"Клієнт {uid} не має оформлених замовлень.")
+    context.user_data["client_menu_state"] = "main"
 
-    # Обробка повідомлень клієнта, якщо діалог активний
-    elif client_db_state.get("is_active"):
-        await add_client_message(uid, "client", text)
+async def client_promo(update: Update, context: ContextTypes.DEFAULT_TYPE, client_db_state: Dict[str, Any]):
+    await update.message.reply_text(
+        "🎯 Акція: Безкоштовна доставка при замовленні пари гальмівних дисків\n"
+        "📅 Термін дії: 01.07.2025 – 31.08.2025", reply_markup=back_button
+    )
+    context.user_data["client_menu_state"] = "promo"
+    logger.info(f"Клієнт {update.effective_user.id} переглянув 'Акцію'.")
+
+async def client_back_to_bonus(update: Update, context: ContextTypes.DEFAULT_TYPE, client_db_state: Dict[str, Any]):
+    context.user_data.pop("awaiting_bonus_code", None)
+    context.user_data["client_menu_state"] = "bonus"
+    await update.message.reply_text("🔙 Повертаємось до меню бонусів.", reply_markup=bonus_main_menu)
+    logger.info(f"Клієнт {update.effective_user.id} вийшов з режиму введення коду.")
+
+async def client_back_to_info(update: Update, context: ContextTypes.DEFAULT_TYPE, client_db_state: Dict[str, Any]):
+    context.user_data["client_menu_state"] = "info"
+    await update.message.reply_text("🔙 Повертаємось до меню інформації.", reply_markup=info_menu)
+    logger.info(f"Клієнт {update.effective_user.id} повернувся до меню інформації.")
+
+async def client_back_to_main(update: Update, context: ContextTypes.DEFAULT_TYPE, client_db_state: Dict[str, Any]):
+    previous_state = context.user_data.get("client_menu_state")
+    context.user_data["client_menu_state"] = "main"
+    await update.message.reply_text("🔙 Повертаємось до головного меню.", reply_markup=main_menu)
+    logger.info(f"Клієнт {update.effective_user.id} повернувся до головного меню зі стану '{previous_state}'.")
+
+async def client_back_in_dialog(update: Update, context: ContextTypes.DEFAULT_TYPE, client_db_state: Dict[str, Any]):
+    await update.message.reply_text("Ви вже в активному діалозі. Щоб завершити, натисніть '❌ Завершити діалог'.", reply_markup=end_dialog_client_button)
+    logger.info(f"Клієнт {update.effective_user.id} спробував натиснути 'Назад' в активному діалозі.")
+
+async def client_unknown_message(update: Update, context: ContextTypes.DEFAULT_TYPE, client_db_state: Dict[str, Any]):
+    # Якщо повідомлення не є командою і діалог не активний
+    await update.message.reply_text("🤖 Я вас не розумію. Скористайтесь меню.", reply_markup=main_menu)
+    context.user_data["client_menu_state"] = "main"
+    logger.info(f"Клієнт {update.effective_user.id} надіслав нерозпізнане повідомлення '{update.message.text}' у невідомому стані.")
+
+async def client_free_text(update: Update, context: ContextTypes.DEFAULT_TYPE, client_db_state: Dict[str, Any]):
+    """Довільний текст або медіа клієнта: в активному діалозі пересилається менеджеру."""
+    if not client_db_state.get("is_active"):
+        await client_unknown_message(update, context, client_db_state)
+        return
 
-        if client_db_state.get("current_manager_id"):
-            manager_id = client_db_state.get("current_manager_id")
-            try:
-                await context.bot.send_message(
-                    chat_id=manager_id,
-                    text=f"✉️ **Від клієнта** {update.effective_user.full_name} (ID: `{uid}`):\n{text}",
-                    parse_mode="Markdown"
-                )
-                logger.info(f"Повідомлення від активного клієнта {uid} переслано менеджеру {manager_id}.")
-            except Exception as e:
-                logger.warning(f"Не вдалося переслати повідомлення від клієнта {uid} до менеджера {manager_id}: {e}")
-        else:
-            # Надсилаємо сповіщення в групу, тільки якщо менеджер ще не був сповіщений
-            if not client_db_state.get("is_notified"):
-                await context.bot.send_message(
-                    chat_id=MANAGER_GROUP_ID,
-                    text=f"🔔 **Новий запит** від {update.effective_user.full_name} (ID: `{uid}`)\n"
-                         f"Натисніть кнопку нижче, щоб взяти запит в роботу та переглянути історію діалогу.",
-                    parse_mode="Markdown",
-                    reply_markup=InlineKeyboardMarkup([[InlineKeyboardButton(f"🛠 Взяти {update.effective_user.full_name}", callback_data=f"take_{uid}")]])
-                )
-                await update_client_notified_status(uid, True)
-                await update.message.reply_text("🔧 Дякуємо! Ваш запит отримано. Менеджер скоро зв'яжеться з вами.", reply_markup=end_dialog_client_button)
-                logger.info(f"Нове повідомлення від клієнта {uid}. Менеджер сповіщений про запит.")
-            else:
-                # Якщо вже сповіщений, просто підтверджуємо отримання
-                await update.message.reply_text("Ваше повідомлення отримано. Будь ласка, зачекайте відповіді менеджера.", reply_markup=end_dialog_client_button)
-                logger.info(f"Клієнт {uid} надіслав повідомлення, менеджер вже був сповіщений.")
+    uid = update.effective_user.id
+    await add_client_message(uid, "client", message_body(update.message), *extract_media(update.message))
 
+    if client_db_state.get("current_manager_id"):
+        manager_id = client_db_state.get("current_manager_id")
+        try:
+            forwarded_message_id = await relay_message(
+                context.bot, manager_id, update.message,
+                header=f"✉️ **Від клієнта** {update.effective_user.full_name} (ID: `{uid}`):"
+            )
+            await add_forwarded_message(manager_id, forwarded_message_id, uid)
+            logger.info(f"Повідомлення від активного клієнта {uid} переслано менеджеру {manager_id}.")
+        except Exception as e:
+            logger.warning(f"Не вдалося переслати повідомлення від клієнта {uid} до менеджера {manager_id}: {e}")
+        return
 
+    # Спочатку пробуємо автоматично призначити вільного менеджера
+    assignments = {}
+    if not client_db_state.get("is_notified"):
+        assignments = await assign_pending_clients(context.application)
+    if uid in assignments:
+        logger.info(f"Нове повідомлення від клієнта {uid}. Клієнта призначено менеджеру {assignments[uid]}.")
+    # Надсилаємо сповіщення в групу, тільки якщо менеджер ще не був сповіщений
+    elif not client_db_state.get("is_notified"):
+        await context.bot.send_message(
+            chat_id=MANAGER_GROUP_ID,
+            text=f"🔔 **Новий запит** від {update.effective_user.full_name} (ID: `{uid}`)\n"
+                 f"Натисніть кнопку нижче, щоб взяти запит в роботу та переглянути історію діалогу.",
+            parse_mode="Markdown",
+            reply_markup=InlineKeyboardMarkup([[InlineKeyboardButton(f"🛠 Взяти {update.effective_user.full_name}", callback_data=f"take_{uid}")]])
+        )
+        await update_client_notified_status(uid, True)
+        await update.message.reply_text("🔧 Дякуємо! Ваш запит отримано. Менеджер скоро зв'яжеться з вами.", reply_markup=end_dialog_client_button)
+        logger.info(f"Нове повідомлення від клієнта {uid}. Менеджер сповіщений про запит.")
     else:
-        # Якщо повідомлення не є командою і діалог не активний
-        await update.message.reply_text("🤖 Я вас не розумію. Скористайтесь меню.", reply_markup=main_menu)
-        context.user_data["client_menu_state"] = "main"
-        logger.info(f"Клієнт {uid} надіслав нерозпізнане повідомлення '{text}' у невідомому стані.")
-
+        # Якщо вже сповіщений, просто підтверджуємо отримання
+        await update.message.reply_text("Ваше повідомлення отримано. Будь ласка, зачекайте відповіді менеджера.", reply_markup=end_dialog_client_button)
+        logger.info(f"Клієнт {uid} надіслав повідомлення, менеджер вже був сповіщений.")
+
+def build_message_router() -> MessageRouter:
+    """Будує таблицю маршрутів текстових повідомлень. Викликається один раз при старті."""
+    router = MessageRouter()
+
+    # Менеджер: кнопки, що діють у будь-якому стані
+    router.on_text("manager", "📊 Запити клієнтів", manager_open_requests_menu)
+    router.on_text("manager", "📝 Змінити баланс", manager_start_balance_change)
+    router.on_text("manager", "📤 Експорт замовлень", manager_export_orders)
+    router.on_text("manager", "🔍 Інфо по клієнту", manager_start_client_info)
+    router.on_text("manager", "💬 Активний діалог", manager_show_active_dialog)
+    router.on_text("manager", "📨 Нові запити", manager_show_new_requests)
+    router.on_text("manager", "✅ Оформлені замовлення", manager_show_processed_orders)
+    router.on_text("manager", "🔙 Назад", manager_unknown_message)
+
+    # Менеджер: меню активного діалогу, оформлених замовлень та вибору статусу
+    router.on_text("manager", "📦 Оформити замовлення", manager_start_order, states=["active_dialog"])
+    router.on_text("manager", "📂 Архів повідомлень", manager_dialog_archive, states=["active_dialog"])
+    router.on_text("manager", "📜 Замовлення клієнта", manager_dialog_client_orders, states=["active_dialog"])
+    router.on_text("manager", "❌ Завершити діалог", manager_end_dialog, states=["active_dialog"])
+    router.on_text("manager", "✏️ Змінити статус замовлення", manager_start_status_change, states=["processed_orders_list"])
+    router.on_text("manager", "📦 Масова зміна статусу", manager_start_bulk_status_change, states=["processed_orders_list"])
+    for status_button in ORDER_STATUS_BUTTONS:
+        router.on_text("manager", status_button, manager_status_selected, states=["awaiting_status_selection"])
+
+    # Менеджер: "Назад" залежно від стану
+    router.on_text("manager", "🔙 Назад", manager_back_from_input, states=[
+        "manager_awaiting_balance_client_id", "manager_awaiting_balance_amount", "manager_awaiting_client_info_id",
+        "manager_awaiting_order_price", "manager_awaiting_order_description",
+    ])
+    router.on_text("manager", "🔙 Назад", manager_back_from_status_change, states=[
+        "manager_awaiting_order_id_for_status_change", "awaiting_status_selection", "manager_awaiting_bulk_order_ids",
+    ])
+    router.on_text("manager", "🔙 Назад", manager_back_to_main, states=["requests_menu"])
+    router.on_text("manager", "🔙 Назад", manager_back_to_requests_menu, states=["active_dialog", "new_requests_list", "processed_orders_list"])
+    router.on_text("manager", "🔙 Назад до запитів", manager_back_to_requests_menu, states=["processed_orders_list"])
+
+    # Менеджер: довільний текст у режимах очікування вводу та в активному діалозі
+    router.on_state("manager", "manager_awaiting_order_id_for_status_change", manager_input_order_id_for_status)
+    router.on_state("manager", "manager_awaiting_balance_client_id", manager_input_balance_client_id)
+    router.on_state("manager", "manager_awaiting_balance_amount", manager_input_balance_amount)
+    router.on_state("manager", "manager_awaiting_client_info_id", manager_input_client_info_id)
+    router.on_state("manager", "manager_awaiting_order_price", manager_input_order_price)
+    router.on_state("manager", "manager_awaiting_order_description", manager_input_order_description)
+    router.on_state("manager", "manager_awaiting_bulk_order_ids", manager_input_bulk_order_ids)
+    router.on_state("manager", "active_dialog", manager_active_dialog_text)
+    router.set_default("manager", manager_unknown_message)
+
+    # Клієнт: кнопки меню
+    router.on_text("client", "📦 Зробити запит/замовлення", client_new_request)
+    router.on_text("client", "❌ Завершити діалог", client_end_dialog)
+    router.on_text("client", "ℹ️ Інформація", client_info_menu)
+    router.on_text("client", "🎁 Мої бонуси", client_bonus_menu)
+    router.on_text("client", "💰 Перевірити баланс", client_check_balance)
+    router.on_text("client", "⬆️ Ввести бонус-код", client_start_bonus_code)
+    router.on_text("client", "📦 Доставка", client_delivery_info)
+    router.on_text("client", "📞 Контакти", client_contacts)
+    router.on_text("client", "👥 Про нас", client_about_us)
+    router.on_text("client", "🔍 Перевірити замовлення", client_check_orders)
+    router.on_text("client", "🎯 Акція", client_promo)
+
+    # Клієнт: "Назад" залежно від стану
+    router.on_text("client", "🔙 Назад", client_back_to_bonus, states=["awaiting_bonus_code_input"])
+    router.on_text("client", "🔙 Назад", client_back_to_info, states=["info_delivery", "info_contacts", "info_about_us"])
+    router.on_text("client", "🔙 Назад", client_back_to_main, states=["bonus", "info", "promo"])
+    router.on_text("client", "🔙 Назад", client_back_in_dialog, states=["active_dialog"])
+    router.on_text("client", "🔙 Назад", client_unknown_message)
+
+    # Клієнт: введення бонус-коду та повідомлення в діалозі
+    router.on_state("client", "awaiting_bonus_code_input", client_bonus_code_input)
+    router.set_default("client", client_free_text)
+    return router
 
 async def handle_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
     query = update.callback_query
@@ -1067,20 +1648,13 @@ async def handle_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
 
     manager_id = query.from_user.id
 
-    if manager_id != MANAGER_ID:
+    if not is_manager(manager_id):
         await query.edit_message_text("❌ Ви не є менеджером.")
         return
 
     if data.startswith("take_"):
         client_id_to_take = int(data.split("_")[1])
 
-        manager_current_dialog = await get_manager_active_dialogs(manager_id)
-        if manager_current_dialog and manager_current_dialog != client_id_to_take:
-            await query.message.reply_text(f"❌ У вас вже є активний діалог з клієнтом (ID: `{manager_current_dialog}`). Будь ласка, завершіть його перед тим, як брати нового клієнта.", parse_mode="Markdown", reply_markup=manager_main_menu)
-            context.user_data["manager_menu_state"] = "main"
-            logger.warning(f"Менеджер {manager_id} намагався взяти нового клієнта {client_id_to_take}, маючи активний діалог з {manager_current_dialog}.")
-            return
-
         client_state = await get_client_state(client_id_to_take)
         if not client_state or not client_state.get("is_active"):
             await query.edit_message_text(f"❌ Діалог з клієнтом (ID: `{client_id_to_take}`) вже завершено або неактивний.", parse_mode="Markdown")
@@ -1097,12 +1671,12 @@ async def handle_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
             await query.answer(f"Цей клієнт вже в роботі у {manager_name}.", show_alert=True)
             return
 
-        await update_client_manager(client_id_to_take, manager_id)
-        await update_manager_active_dialog(manager_id, client_id_to_take)
-
-        history_records = await get_client_messages(client_id_to_take)
-        history_formatted = "\n".join([f"{rec['sender_type'].capitalize()}: {rec['message_text']}" for rec in history_records])
-        history = history_formatted or "📭 Історія порожня"
+        # Атомарне закріплення: інший менеджер або автопризначення могли встигнути раніше
+        if not await claim_client(client_id_to_take, manager_id):
+            await query.answer("Цей клієнт вже в роботі в іншого менеджера або запит неактивний.", show_alert=True)
+            logger.warning(f"Менеджер {manager_id} не встиг взяти клієнта {client_id_to_take}.")
+            return
+        untrack_client(client_id_to_take)
 
         # Після того, як менеджер взяв діалог, видаляємо інлайн-кнопку "Взяти" з оригінального повідомлення
         try:
@@ -1119,22 +1693,21 @@ async def handle_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
             else:
                 logger.error(f"Помилка при оновленні повідомлення (прибирання кнопки 'Взяти') для менеджера {manager_id}: {e}")
 
-        await context.bot.send_message(
-            manager_id,
-            f"✅ **Діалог з клієнтом (ID: `{client_id_to_take}`) взято в роботу.**\n"
-            f"✉️ **Історія діалогу:**\n{history}\n\n"
-            f"Тепер ви можете відповідати клієнту, просто надсилаючи повідомлення.", # Це повідомлення буде надсилатися менеджеру
-            reply_markup=active_dialog_client_buttons,
-            parse_mode="Markdown"
-        )
-        try:
-            await context.bot.send_message(client_id_to_take, "🎉 Менеджер приєднався до діалогу!")
-        except Exception as e:
-            logger.warning(f"Не вдалося надіслати повідомлення клієнту {client_id_to_take} про приєднання менеджера: {e}")
-
-        context.user_data["manager_menu_state"] = "active_dialog"
+        # Взятий вручну клієнт стає активним діалогом; попередні залишаються доступними через Reply
+        await start_manager_dialog(context.application, manager_id, client_id_to_take, make_active=True)
         logger.info(f"Менеджер {manager_id} взяв в роботу діалог з клієнтом {client_id_to_take}.")
 
+    elif data.startswith("bulk_"):
+        await handle_bulk_status_callback(query, context)
+
+    elif data.startswith("search_"):
+        search_query = context.user_data.get("search_query")
+        if not search_query:
+            await query.edit_message_text("⌛ Пошук застарів, повторіть команду /search.")
+            return
+        text, markup = await render_search_page(search_query, int(data[len("search_"):]))
+        await query.edit_message_text(text, reply_markup=markup)
+
     elif data.startswith("taken_"):
         client_id = int(data.split("_")[1])
         client_state = await get_client_state(client_id)
@@ -1198,88 +1771,273 @@ WEBHOOK_PATH = "/webhook"
 
 @fastapi_app.on_event("startup")
 async def startup_event():
-    global telegram_app
+    global telegram_app, message_router
     logger.info("FastAPI startup: Ініціалізація пулу БД...")
     await init_db_pool()
+    # Канал LISTEN/NOTIFY тримає локальні кеші узгодженими між воркерами
+    await start_cache_listener()
+    for manager_id in MANAGER_IDS:
+        await register_manager(manager_id, MANAGER_MAX_DIALOGS)
 
     logger.info("FastAPI startup: Ініціалізація Telegram Application...")
-    telegram_app = Application.builder().token(TOKEN).build()
+    # user_data (стан меню менеджера і клієнта) зберігається в БД, тому переживає перезапуск
+    # і доступний усім воркерам.
+    telegram_app = Application.builder().token(TOKEN).persistence(DbPersistence()).build()
     await telegram_app.initialize()
+    message_router = build_message_router()
 
     # Додавання обробників команд та повідомлень
     telegram_app.add_handler(CommandHandler("start", start))
-    telegram_app.add_handler(CommandHandler("manager_menu", manager_menu_command, filters.User(MANAGER_ID)))
-    telegram_app.add_handler(CommandHandler("client_info", client_info_command, filters.User(MANAGER_ID)))
-
-    # Обробники кнопок меню менеджера
-    telegram_app.add_handler(MessageHandler(filters.Regex("^📊 Запити клієнтів$") & filters.User(MANAGER_ID), manager_requests_menu_handler))
-    telegram_app.add_handler(MessageHandler(filters.Regex("^📝 Змінити баланс$") & filters.User(MANAGER_ID), handle_message)) # handle_message буде обробляти вхід в режим очікування ID
-    telegram_app.add_handler(MessageHandler(filters.Regex("^📤 Експорт замовлень$") & filters.User(MANAGER_ID), handle_message)) # handle_message буде викликати export_orders_to_excel
-    telegram_app.add_handler(MessageHandler(filters.Regex("^🔍 Інфо по клієнту$") & filters.User(MANAGER_ID), handle_message)) # handle_message буде обробляти вхід в режим очікування ID
-
-    # Обробники кнопок підменю "Запити клієнтів"
-    telegram_app.add_handler(MessageHandler(filters.Regex("^💬 Активний діалог$") & filters.User(MANAGER_ID), active_dialog_details_handler))
-    telegram_app.add_handler(MessageHandler(filters.Regex("^📨 Нові запити$") & filters.User(MANAGER_ID), new_requests_command))
-    telegram_app.add_handler(MessageHandler(filters.Regex("^✅ Оформлені замовлення$") & filters.User(MANAGER_ID), processed_orders_command))
-
-    # Обробники кнопок в активному діалозі менеджера
-    telegram_app.add_handler(MessageHandler(filters.Regex("^📦 Оформити замовлення$") & filters.User(MANAGER_ID), handle_message))
-    telegram_app.add_handler(MessageHandler(filters.Regex("^📂 Архів повідомлень$") & filters.User(MANAGER_ID), handle_message))
-    telegram_app.add_handler(MessageHandler(filters.Regex("^📜 Замовлення клієнта$") & filters.User(MANAGER_ID), handle_message))
-    telegram_app.add_handler(MessageHandler(filters.Regex("^❌ Завершити діалог$") & filters.User(MANAGER_ID), handle_message))
-
-    # Обробник кнопки "Змінити статус замовлення" в меню оформлених замовлень
-    telegram_app.add_handler(MessageHandler(filters.Regex("^✏️ Змінити статус замовлення$") & filters.User(MANAGER_ID), handle_message))
-    # Обробники кнопок вибору нового статусу замовлення
-    telegram_app.add_handler(MessageHandler(filters.Regex("^(🔄 Комплектування|🚚 З ЄС|📮 По Україні|✅ Виконано)$") & filters.User(MANAGER_ID), handle_message))
-
-    # Обробники кнопок "Назад" для менеджера
-    telegram_app.add_handler(MessageHandler(filters.Regex("^🔙 Назад$") & filters.User(MANAGER_ID), handle_message))
+    telegram_app.add_handler(CommandHandler("manager_menu", manager_menu_command, manager_filter))
+    telegram_app.add_handler(CommandHandler("client_info", client_info_command, manager_filter))
+
+    # Команди розподілу клієнтів між менеджерами
+    telegram_app.add_handler(CommandHandler("online", manager_online_command, manager_filter))
+    telegram_app.add_handler(CommandHandler("offline", manager_offline_command, manager_filter))
+    telegram_app.add_handler(CommandHandler("capacity", manager_capacity_command, manager_filter))
+    telegram_app.add_handler(CommandHandler("managers", managers_command, manager_filter))
+
+    # Історія статусів замовлень
+    telegram_app.add_handler(CommandHandler("order_timeline", order_timeline_command, manager_filter))
+    telegram_app.add_handler(CommandHandler("status_dwell", status_dwell_command, manager_filter))
+    telegram_app.add_handler(CommandHandler("search", search_command, manager_filter))
+    telegram_app.add_handler(CommandHandler("stats", stats_command, manager_filter))
+    telegram_app.add_handler(CommandHandler("export_full", export_full_command, manager_filter))
+    telegram_app.add_handler(CommandHandler("sla", sla_command, manager_filter))
 
     # Обробники команд для зміни бонусів (менеджерські команди)
-    telegram_app.add_handler(CommandHandler("add_bonus", add_bonus_command_manager, filters.User(MANAGER_ID)))
-    telegram_app.add_handler(CommandHandler("set_bonus", set_bonus_command_manager, filters.User(MANAGER_ID)))
-    telegram_app.add_handler(CommandHandler("get_balance", get_balance_command_manager, filters.User(MANAGER_ID)))
+    telegram_app.add_handler(CommandHandler("add_bonus", add_bonus_command_manager, manager_filter))
+    telegram_app.add_handler(CommandHandler("set_bonus", set_bonus_command_manager, manager_filter))
+    telegram_app.add_handler(CommandHandler("get_balance", get_balance_command_manager, manager_filter))
 
-    # Загальний обробник текстових повідомлень (після всіх команд і специфічних кнопок)
+    # Усі текстові повідомлення (кнопки меню та режими вводу) розподіляє message_router
     telegram_app.add_handler(MessageHandler(filters.TEXT & ~filters.COMMAND, handle_message))
+    # Медіа в діалогах пересилаються за file_id (copy_message)
+    telegram_app.add_handler(MessageHandler(filters.PHOTO | filters.Document.ALL | filters.VOICE, handle_media))
     # Обробник callback-запитів від інлайн-клавіатур
     telegram_app.add_handler(CallbackQueryHandler(handle_callback))
+    # Помилки обробників знімають захоплення оновлення, і Telegram доставляє його повторно
+    track_handler_errors(telegram_app)
 
-    full_webhook_url = f"{WEBHOOK_URL}{WEBHOOK_PATH}"
+    # start() запускає фоновий запис persistence (user_data) раз на update_interval
+    await telegram_app.start()
+
+    if BOT_MODE == "polling":
+        # getUpdates викликає лише лідер; новий лідер продовжує зі збереженого offset
+        on_elected(start_update_polling)
+        on_step_down(stop_polling)
+    else:
+        # Вебхук реєструє лише процес-лідер (і повторно — новий лідер після відмови попереднього)
+        on_elected(register_webhook)
+    # Черга нагадувань про клієнтів, що довго чекають, живе на лідері
+    on_elected(start_waiting_escalations)
+    on_step_down(stop_escalations)
+    add_invalidation_callback(on_client_state_invalidated)
+    add_leader_job("assign_pending_clients", ASSIGNMENT_INTERVAL, assign_pending_clients_job)
+    add_leader_job("purge_forwarded_messages", 24 * 60 * 60, purge_forwarded_messages_job)
+    add_leader_job("purge_processed_updates", 60 * 60, purge_processed_updates_job)
+    add_leader_job("maintain_client_messages_partitions", 24 * 60 * 60, maintain_client_messages_partitions_job)
+    add_leader_job("archive_completed_orders", 6 * 60 * 60, archive_completed_orders_job)
+    add_leader_job("archive_closed_dialogs", 60 * 60, archive_closed_dialogs_job)
+    add_leader_job("compute_support_dialog_metrics", SUPPORT_METRICS_INTERVAL, compute_support_dialog_metrics_job)
+    if DIALOG_IDLE_CLOSE_MINUTES > 0:
+        add_leader_job("close_stale_dialogs", DIALOG_IDLE_CLOSE_INTERVAL, close_stale_dialogs_job)
+    add_collector(collect_sla_metrics)
+    add_collector(collect_db_metrics)
+    await start_leader_election()
+
+async def start_waiting_escalations():
+    await start_escalations(escalate_waiting_clients, await get_pending_clients())
+
+async def escalate_waiting_clients(due: list[Dict[str, Any]]):
+    """Нагадує в групу менеджерів про клієнтів, які чекають довше порогу; на останньому порозі - і основному менеджеру."""
+    messages = []
+    for item in due:
+        client_id = item["client_id"]
+        # Стан береться з кешу (інвалідується іншими процесами), тож це не опитування БД
+        state = await get_client_state(client_id)
+        if not state or not state.get("is_active") or state.get("current_manager_id"):
+            untrack_client(client_id)
+            continue
+        text = (f"⏰ **Запит чекає вже {item['waited_minutes']} хв** від клієнта (ID: `{client_id}`)\n"
+                f"Натисніть кнопку нижче, щоб взяти запит в роботу.")
+        keyboard = InlineKeyboardMarkup([[InlineKeyboardButton("🛠 Взяти клієнта", callback_data=f"take_{client_id}")]])
+        messages.append((MANAGER_GROUP_ID, text, {"parse_mode": "Markdown", "reply_markup": keyboard}))
+        if item["level"] == len(ESCALATION_THRESHOLDS_MINUTES) - 1 and item["level"] > 0:
+            messages.append((MANAGER_ID, text, {"parse_mode": "Markdown", "reply_markup": keyboard}))
+    if messages:
+        sent, failed = await send_many(telegram_app.bot, messages)
+        logger.info(f"Нагадування про чергу: надіслано {sent}, не доставлено {failed}.")
+
+def on_client_state_invalidated(table: str, key: str):
+    """Стан клієнта змінив інший процес: оновлюємо чергу нагадувань лідера."""
+    if not escalations_running() or table not in ("client_states", "*"):
+        return
+    asyncio.create_task(refresh_waiting_client(None if key == "*" else int(key)))
+
+async def refresh_waiting_client(client_id: Optional[int]):
+    if client_id is None:
+        # Сповіщення могли бути втрачені - відновлюємо чергу з БД
+        for client in await get_pending_clients():
+            track_client(client["client_id"], client["last_activity"])
+        return
+    state = await get_client_state(client_id)
+    if state and state.get("is_active") and not state.get("current_manager_id"):
+        track_client(client_id, state["last_activity"])
+    else:
+        untrack_client(client_id)
 
-    logger.info(f"FastAPI startup: Встановлення вебхука на: {full_webhook_url}")
+async def start_update_polling():
+    await start_polling(telegram_app.bot, process_incoming_update)
+
+async def register_webhook():
+    full_webhook_url = f"{WEBHOOK_URL}{WEBHOOK_PATH}"
+    logger.info(f"Встановлення вебхука на: {full_webhook_url}")
     await telegram_app.bot.set_webhook(url=full_webhook_url, secret_token=WEBHOOK_SECRET_TOKEN)
-    logger.info(f"FastAPI startup: Вебхук встановлено.")
+    logger.info(f"Вебхук встановлено.")
 
 @fastapi_app.on_event("shutdown")
 async def shutdown_event():
-    logger.info("FastAPI shutdown: Закриття пулу БД...")
-    await close_db_pool()
+    """
+    Впорядкована зупинка: нові оновлення не приймаються, ті, що обробляються, і розсилки завершуються
+    (не довше SHUTDOWN_DRAIN_TIMEOUT, після чого скасовуються), буфери записуються в БД, і лише потім
+    закриваються Telegram Application та пул. Усе, що не встигло завершитись, потрапляє у звіт.
+    """
+    global accepting_updates
+    accepting_updates = False
+    loop = asyncio.get_running_loop()
+    deadline = loop.time() + SHUTDOWN_DRAIN_TIMEOUT
+    # Polling зупиняємо першим: необроблені оновлення пачки лишаються за offset і прийдуть наступному процесу
+    await stop_polling()
+    logger.info(f"FastAPI shutdown: Очікування {len(inflight_updates)} оновлень і {pending_sends()} розсилок...")
+    while (inflight_updates or pending_sends()) and loop.time() < deadline:
+        await asyncio.sleep(0.1)
+    report = {
+        "updates_interrupted": sorted(inflight_updates),
+        "sends_interrupted": pending_sends(),
+        "jobs_interrupted": running_jobs(),
+    }
+    # Те, що не завершилось вчасно, скасовується й дочікується: обробники не мають працювати, коли їхні
+    # захоплення вже звільнено, а Application і пул закрито
+    interrupted_tasks = list(inflight_updates.values())
+    for task in interrupted_tasks:
+        task.cancel()
+    await asyncio.gather(*interrupted_tasks, return_exceptions=True)
+    await cancel_pending_sends()
+    # Перервані оновлення Telegram має доставити знову (іншому процесу або після перезапуску)
+    for update_id in report["updates_interrupted"]:
+        await release_update_claim(update_id)
+
+    await stop_leader_election()
     logger.info("FastAPI shutdown: Закриття Telegram Application...")
     if telegram_app:
+        # stop() і shutdown() записують у БД залишки user_data, тому пул закриваємо після них
+        if telegram_app.running:
+            await telegram_app.stop()
         await telegram_app.shutdown()
+    # Повідомлення діалогів, що ще в буфері пачкового запису, і ще не записані оброблені update_id
+    await flush_client_messages()
+    await flush_processed_updates()
+    report["messages_unwritten"] = pending_client_messages()
+    # Записи, відкладені під час недоступності БД, живуть лише в пам'яті процесу
+    report["deferred_writes_unwritten"] = get_db_health()["deferred_writes"]
+    await stop_cache_listener()
+    logger.info("FastAPI shutdown: Закриття пулу БД...")
+    await close_db_pool()
+
+    if any(report.values()):
+        logger.warning(f"Зупинка з втратами: {report}")
+    else:
+        logger.info("Зупинка завершена: усі оновлення оброблено, буфери записано.")
 
 @fastapi_app.post(WEBHOOK_PATH)
 async def telegram_webhook(request: Request):
     x_telegram_bot_api_secret_token = request.headers.get("X-Telegram-Bot-Api-Secret-Token")
     if not WEBHOOK_SECRET_TOKEN or x_telegram_bot_api_secret_token != WEBHOOK_SECRET_TOKEN:
         raise HTTPException(status_code=403, detail="Invalid secret token")
+    if not accepting_updates:
+        # Процес зупиняється - Telegram повторить доставку
+        return Response(status_code=503)
 
     try:
-        req_json = await request.json()
-        update = Update.de_json(req_json, telegram_app.bot)
-
-        await telegram_app.process_update(update)
-        return Response(status_code=200)
+        update = Update.de_json(await request.json(), telegram_app.bot)
     except Exception as e:
-        logger.exception(f"Помилка при обробці вебхука: {e}")
+        logger.exception(f"Помилка при розборі оновлення вебхука: {e}")
         return Response(status_code=500)
+    # 500 - Telegram доставить оновлення повторно
+    return Response(status_code=200 if await process_incoming_update(update) else 500)
+
+async def process_incoming_update(update: Update) -> bool:
+    """
+    Спільний конвеєр вебхука і polling: відкидає повторні доставки та обробляє оновлення.
+    Повертає False, якщо обробка завершилась помилкою і оновлення треба доставити повторно.
+    """
+    if not accepting_updates:
+        return False
+    # Повторна доставка того самого оновлення відкидається до будь-яких обробників і не витрачає ліміт флуду
+    if await is_duplicate_update(update.update_id):
+        return True
+    # Флуд відкидається до обробників і звернень до БД (менеджери не обмежуються)
+    user = update.effective_user
+    if user and not is_manager(user.id):
+        verdict = flood_check_user(user.id)
+        if verdict != FLOOD_ALLOWED:
+            inc_counter("flood_dropped_updates_total", "Оновлення, відкинуті захистом від флуду", verdict=verdict)
+            # Попередження надсилається у фоні: черга відправки не затримує відповідь на оновлення
+            if verdict == FLOOD_LIMITED_NOW:
+                telegram_app.create_task(send_message_throttled(
+                    telegram_app.bot, user.id,
+                    "⏳ Ви надсилаєте повідомлення надто швидко, тому частину з них не отримано. "
+                    "Зачекайте кілька секунд і надішліть решту одним повідомленням."
+                ))
+            elif verdict == FLOOD_MUTED_NOW:
+                telegram_app.create_task(send_message_throttled(
+                    telegram_app.bot, user.id,
+                    f"⏳ Забагато повідомлень поспіль. Наступні {int(FLOOD_MUTE_SECONDS)} с повідомлення не оброблятимуться."
+                ))
+            return True
+    inflight_updates[update.update_id] = asyncio.current_task()
+    try:
+        return await process_update_tracked(telegram_app, update)
+    finally:
+        inflight_updates.pop(update.update_id, None)
 
 @fastapi_app.get("/")
 async def read_root():
     return {"status": "ok", "message": "Bot is running with webhook setup and secure secret token"}
 
+@fastapi_app.get("/metrics")
+async def metrics_endpoint(request: Request):
+    if METRICS_TOKEN and request.headers.get("Authorization") != f"Bearer {METRICS_TOKEN}":
+        raise HTTPException(status_code=403, detail="Forbidden")
+    return Response(content=await render_metrics(), media_type="text/plain; version=0.0.4")
+
+async def collect_sla_metrics():
+    """SLA за останні 24 години для /metrics (рахується з support_dialogs, тому однакове на всіх воркерах)."""
+    rows = await get_support_sla_stats(1, "total")
+    summary = rows[0] if rows else {}
+    set_gauge("support_dialogs_24h", summary.get("dialogs", 0), "Діалоги, відкриті за останні 24 години")
+    set_gauge("support_unanswered_dialogs_24h", summary.get("unanswered", 0), "Завершені діалоги без відповіді менеджера")
+    for name, help_text in (
+        ("claim", "Час від запиту до закріплення за менеджером"),
+        ("first_response", "Час від запиту до першої відповіді менеджера"),
+        ("duration", "Тривалість завершених діалогів"),
+    ):
+        for quantile in ("50", "90"):
+            set_gauge(f"support_{name}_seconds_24h", summary.get(f"{name}_p{quantile}"), help_text, quantile=f"0.{quantile[0]}")
+
+DB_BREAKER_STATES = {"closed": 0, "half_open": 1, "open": 2}
+
+async def collect_db_metrics():
+    """Стан запобіжника БД і режиму деградації цього процесу."""
+    health = get_db_health()
+    set_gauge("db_circuit_breaker_state", DB_BREAKER_STATES[health["state"]], "Запобіжник БД: 0 - закритий, 1 - пробний запит, 2 - відкритий")
+    set_gauge("db_connection_failures", health["failures"], "Помилки з'єднання з БД поспіль")
+    set_gauge("db_circuit_breaker_opened_total", health["times_opened"], "Скільки разів відкривався запобіжник БД")
+    set_gauge("db_deferred_writes", health["deferred_writes"], "Записи, відкладені до відновлення БД")
+    set_gauge("db_deferred_writes_dropped_total", health["dropped_writes"], "Записи, втрачені через переповнення черги")
+    set_gauge("db_degraded_reads_total", health["degraded_reads"], "Читання, обслужені останніми відомими значеннями")
+
 # --- МЕНЕДЖЕРСЬКІ КОМАНДИ ДЛЯ БОНУСІВ (ОКРЕМІ ФУНКЦІЇ) ---
 async def add_bonus_command_manager(update: Update, context: ContextTypes.DEFAULT_TYPE):
     # Ця функція тепер може викликатися як з команди, так і з handle_message
@@ -1301,12 +2059,7 @@ async def add_bonus_command_manager(update: Update, context: ContextTypes.DEFAUL
         current_balance = bonus_acc.get("bonus_balance", Decimal('0.00')) # Забезпечуємо, що значення за замовчуванням є Decimal
         new_balance = current_balance + amount # Тепер обидва операнди Decimal!
 
-        pool = await get_db_pool()
-        async with pool.acquire() as conn:
-            await conn.execute(
-                "UPDATE bonus_accounts SET bonus_balance = $2, last_updated = NOW() WHERE telegram_user_id = $1;",
-                target_tg_id, new_balance
-            )
+        await set_bonus_balance(target_tg_id, new_balance)
 
         # Сповіщення менеджера про успішне оновлення
         if not context.user_data.get("manager_awaiting_balance_amount"): # Щоб уникнути дублювання, якщо викликано з handle_message
@@ -1339,12 +2092,7 @@ async def set_bonus_command_manager(update: Update, context: ContextTypes.DEFAUL
             await update.message.reply_text(f"❌ Не вдалося знайти/створити бонусний акаунт для клієнта (ID: `{target_tg_id}`).", parse_mode="Markdown")
             return
 
-        pool = await get_db_pool()
-        async with pool.acquire() as conn:
-            await conn.execute(
-                "UPDATE bonus_accounts SET bonus_balance = $2, last_updated = NOW() WHERE telegram_user_id = $1;",
-                target_tg_id, new_balance
-            )
+        await set_bonus_balance(target_tg_id, new_balance)
 
         # Сповіщення менеджера про успішне оновлення
         if not context.user_data.get("manager_awaiting_balance_amount"): # Щоб уникнути дублювання
@@ -1379,6 +2127,305 @@ async def get_balance_command_manager(update: Update, context: ContextTypes.DEFA
         logger.error(f"Помилка в get_balance_command_manager: {e}")
         await update.message.reply_text(f"Виникла непередбачена помилка: {e}")
 
+# --- МЕНЕДЖЕРСЬКІ КОМАНДИ ДЛЯ РОЗПОДІЛУ КЛІЄНТІВ ---
+async def manager_online_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    uid = update.effective_user.id
+    await set_manager_online(uid, True)
+    await update.message.reply_text("🟢 Ви онлайн. Нові клієнти призначатимуться вам автоматично.")
+    await assign_pending_clients(context.application)
+
+async def manager_offline_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    uid = update.effective_user.id
+    await set_manager_online(uid, False)
+    await update.message.reply_text("🔴 Ви офлайн. Нові клієнти вам не призначатимуться, поточні діалоги залишаються.")
+
+async def manager_capacity_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    uid = update.effective_user.id
+    if not context.args or len(context.args) != 1:
+        await update.message.reply_text("Використання: `/capacity <кількість_одночасних_діалогів>`", parse_mode="Markdown")
+        return
+    try:
+        max_dialogs = int(context.args[0])
+        if max_dialogs < 0:
+            raise ValueError
+    except ValueError:
+        await update.message.reply_text("❌ Ліміт має бути невід'ємним цілим числом.")
+        return
+    await set_manager_max_dialogs(uid, max_dialogs)
+    await update.message.reply_text(f"✅ Ваш ліміт одночасних діалогів: **{max_dialogs}**.", parse_mode="Markdown")
+    await assign_pending_clients(context.application)
+
+async def managers_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    managers = await get_managers_load()
+    if not managers:
+        await update.message.reply_text("📭 Реєстр менеджерів порожній.")
+        return
+    text = "👨‍💻 **Менеджери:**\n\n"
+    for m in managers:
+        status = "🟢" if m["is_online"] else "🔴"
+        text += f"{status} `{m['manager_id']}` — діалогів: **{m['active_dialogs']}/{m['max_dialogs']}**\n"
+    await update.message.reply_text(text, parse_mode="Markdown")
+
+# --- МЕНЕДЖЕРСЬКІ КОМАНДИ ІСТОРІЇ СТАТУСІВ ---
+def format_duration(seconds: Optional[float]) -> str:
+    if seconds is None:
+        return "—"
+    minutes = int(seconds // 60)
+    days, minutes = divmod(minutes, 24 * 60)
+    hours, minutes = divmod(minutes, 60)
+    if days:
+        return f"{days} д {hours} год"
+    if hours:
+        return f"{hours} год {minutes} хв"
+    return f"{minutes} хв"
+
+async def order_timeline_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    if not context.args or len(context.args) != 1:
+        await update.message.reply_text("Використання: `/order_timeline <ID_замовлення>`", parse_mode="Markdown")
+        return
+    order_id = context.args[0]
+    timeline = await get_order_timeline(order_id)
+    if not timeline:
+        await update.message.reply_text(f"📭 Історії статусів для замовлення `{order_id}` не знайдено.", parse_mode="Markdown")
+        return
+    text = f"🕓 **Історія статусів замовлення** `{order_id}`:\n\n"
+    for event in timeline:
+        text += f"{event['changed_at'].strftime('%d.%m.%Y %H:%M')} — {event['status']} ({format_duration(event['dwell_seconds'])})\n"
+    await update.message.reply_text(text, parse_mode="Markdown")
+
+async def status_dwell_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    try:
+        days = int(context.args[0]) if context.args else 30
+        if days <= 0:
+            raise ValueError
+    except ValueError:
+        await update.message.reply_text("Використання: `/status_dwell [кількість_днів]`", parse_mode="Markdown")
+        return
+    stats = await get_status_dwell_stats(days)
+    if not stats:
+        await update.message.reply_text(f"📭 За останні {days} днів змін статусів не було.")
+        return
+    text = f"⏱ **Час у статусах за {days} днів** (середнє / медіана / 90%):\n\n"
+    for row in stats:
+        text += (
+            f"{row['status']}: {format_duration(row['avg_seconds'])} / {format_duration(row['p50_seconds'])}"
+            f" / {format_duration(row['p90_seconds'])} — завершено {row['completed']}, зараз {row['in_progress']}\n"
+        )
+    await update.message.reply_text(text, parse_mode="Markdown")
+
+# --- МЕНЕДЖЕРСЬКА СТАТИСТИКА ПРОДАЖІВ ---
+STATS_DEFAULT_DAYS = 7
+STATS_MAX_DAYS = 366
+
+async def stats_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    try:
+        days = int(context.args[0]) if context.args else STATS_DEFAULT_DAYS
+        if not 0 < days <= STATS_MAX_DAYS:
+            raise ValueError
+    except ValueError:
+        await update.message.reply_text(f"Використання: `/stats [кількість_днів до {STATS_MAX_DAYS}]`", parse_mode="Markdown")
+        return
+    rows = await get_order_stats(days)
+    if not rows:
+        await update.message.reply_text(f"📭 За останні {days} днів замовлень не було.")
+        return
+
+    by_status: Dict[str, Dict[str, Any]] = {}
+    by_day: Dict[Any, Dict[str, Any]] = {}
+    for row in rows:
+        for bucket in (by_status.setdefault(row["status"], {}), by_day.setdefault(row["day"], {})):
+            bucket["orders"] = bucket.get("orders", 0) + row["orders_count"]
+            bucket["priced"] = bucket.get("priced", 0) + row["priced_count"]
+            bucket["revenue"] = bucket.get("revenue", Decimal("0.00")) + row["revenue"]
+
+    total_orders = sum(b["orders"] for b in by_day.values())
+    total_revenue = sum((b["revenue"] for b in by_day.values()), Decimal("0.00"))
+    text = f"📊 **Замовлення за {days} днів:** {total_orders} на суму **{total_revenue:.2f} грн**\n\n"
+    text += "**За статусами:**\n"
+    for status, b in by_status.items():
+        avg = f"{b['revenue'] / b['priced']:.2f} грн" if b["priced"] else "—"
+        text += f"{status}: {b['orders']} — {b['revenue']:.2f} грн (середня ціна {avg})\n"
+    text += "\n**За днями:**\n"
+    for day, b in by_day.items():
+        text += f"{day.strftime('%d.%m.%Y')}: {b['orders']} — {b['revenue']:.2f} грн\n"
+    await update.message.reply_text(text, parse_mode="Markdown")
+
+# --- МЕНЕДЖЕРСЬКИЙ ПОШУК ЗА ЗАМОВЛЕННЯМИ ТА ДІАЛОГАМИ ---
+SEARCH_PAGE_SIZE = 5
+SEARCH_MIN_QUERY_LENGTH = 3 # коротші запити не мають триграм для індексу
+SEARCH_SNIPPET_LENGTH = 120
+
+def shorten(text: Optional[str], length: int = SEARCH_SNIPPET_LENGTH) -> str:
+    text = text or ""
+    return text if len(text) <= length else text[:length] + "…"
+
+async def render_search_page(search_query: str, page: int):
+    """Формує сторінку результатів пошуку: текст (без розмітки - в ньому текст клієнтів) та кнопки гортання."""
+    offset = page * SEARCH_PAGE_SIZE
+    # Беремо на один результат більше, щоб знати, чи є наступна сторінка
+    orders = await search_orders(search_query, SEARCH_PAGE_SIZE + 1, offset)
+    messages = await search_client_messages(search_query, SEARCH_PAGE_SIZE + 1, offset)
+    has_next = len(orders) > SEARCH_PAGE_SIZE or len(messages) > SEARCH_PAGE_SIZE
+    orders, messages = orders[:SEARCH_PAGE_SIZE], messages[:SEARCH_PAGE_SIZE]
+
+    text = f"🔎 Пошук: «{search_query}» (сторінка {page + 1})\n\n"
+    if orders:
+        text += "📦 Замовлення:\n"
+        for o in orders:
+            price = f"{o['price']:.2f} грн" if o["price"] is not None else "—"
+            text += f"• {o['order_id']} | клієнт {o['client_id']} | {o['status']} | {price}\n  {shorten(o['description'])}\n"
+        text += "\n"
+    if messages:
+        text += "💬 Повідомлення:\n"
+        for m in messages:
+            who = "клієнт" if m["sender_type"] == "client" else "менеджер"
+            text += f"• {m['timestamp'].strftime('%d.%m.%Y %H:%M')} | клієнт {m['client_id']} ({who}): {shorten(m['message_text'])}\n"
+    if not orders and not messages:
+        text += "📭 Нічого не знайдено." if page == 0 else "📭 Більше результатів немає."
+
+    buttons = []
+    if page > 0:
+        buttons.append(InlineKeyboardButton("◀️ Назад", callback_data=f"search_{page - 1}"))
+    if has_next:
+        buttons.append(InlineKeyboardButton("Далі ▶️", callback_data=f"search_{page + 1}"))
+    return text, InlineKeyboardMarkup([buttons]) if buttons else None
+
+async def search_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    search_query = " ".join(context.args).strip() if context.args else ""
+    if len(search_query) < SEARCH_MIN_QUERY_LENGTH:
+        await update.message.reply_text(
+            f"Використання: `/search <текст>` (щонайменше {SEARCH_MIN_QUERY_LENGTH} символи), "
+            "наприклад `/search диски passat`", parse_mode="Markdown"
+        )
+        return
+    # Запит зберігається для кнопок гортання (callback_data має обмеження 64 байти)
+    context.user_data["search_query"] = search_query
+    text, markup = await render_search_page(search_query, 0)
+    await update.message.reply_text(text, reply_markup=markup)
+    logger.info(f"Менеджер {update.effective_user.id} виконав пошук '{search_query}'.")
+
+# --- МЕНЕДЖЕРСЬКА SLA-СТАТИСТИКА ПІДТРИМКИ ---
+SLA_DEFAULT_DAYS = 7
+SLA_WEEK_TOP = 15 # скільки найнавантаженіших годин тижня показувати
+WEEKDAYS = ("Пн", "Вт", "Ср", "Чт", "Пт", "Сб", "Нд")
+
+def format_sla_row(row: Dict[str, Any]) -> str:
+    return (
+        f"{row['dialogs']} діал., закріплення {format_duration(row['claim_p50'])}/{format_duration(row['claim_p90'])}, "
+        f"відповідь {format_duration(row['first_response_p50'])}/{format_duration(row['first_response_p90'])}, "
+        f"тривалість {format_duration(row['duration_p50'])}/{format_duration(row['duration_p90'])}"
+        + (f", без відповіді {row['unanswered']}" if row["unanswered"] else "")
+    )
+
+async def sla_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    args = list(context.args or [])
+    by_week = "week" in args
+    if by_week:
+        args.remove("week")
+    try:
+        days = int(args[0]) if args else SLA_DEFAULT_DAYS
+        if not 0 < days <= STATS_MAX_DAYS:
+            raise ValueError
+    except ValueError:
+        await update.message.reply_text("Використання: `/sla [кількість_днів] [week]`", parse_mode="Markdown")
+        return
+
+    rows = await get_support_sla_stats(days, "hour_of_week" if by_week else "day")
+    if not rows:
+        await update.message.reply_text(f"📭 За останні {days} днів запитів не було.")
+        return
+    text = f"⏱ SLA підтримки за {days} днів (медіана/90%):\n\n"
+    if by_week:
+        # Для планування змін: години тижня з найбільшою кількістю запитів
+        text += "Найнавантаженіші години тижня:\n"
+        for row in sorted(rows, key=lambda r: r["dialogs"], reverse=True)[:SLA_WEEK_TOP]:
+            text += f"{WEEKDAYS[row['dow'] - 1]} {row['hour']:02d}:00 — {format_sla_row(row)}\n"
+    else:
+        for row in rows:
+            text += f"{row['day'].strftime('%d.%m.%Y')} — {format_sla_row(row)}\n"
+    await update.message.reply_text(text)
+
+async def compute_support_dialog_metrics_job():
+    total, cursor = 0, 0
+    while True:
+        # Курсор за dialog_id: відкриті діалоги лишаються незафіксованими і не повинні оброблятись повторно
+        processed, cursor = await compute_support_dialog_metrics(SUPPORT_METRICS_BATCH_SIZE, cursor)
+        total += processed
+        if processed < SUPPORT_METRICS_BATCH_SIZE:
+            break
+    if total:
+        logger.info(f"Оновлено SLA-метрики {total} діалогів.")
+
+async def purge_forwarded_messages_job():
+    await purge_forwarded_messages(FORWARDED_MESSAGES_RETENTION_DAYS)
+
+async def purge_processed_updates_job():
+    await purge_processed_updates(PROCESSED_UPDATES_RETENTION_HOURS)
+
+async def maintain_client_messages_partitions_job():
+    await maintain_client_messages_partitions(CLIENT_MESSAGES_RETENTION_MONTHS, drop=CLIENT_MESSAGES_RETENTION_MODE != "detach")
+
+async def archive_completed_orders_job():
+    """Переносить давно виконані замовлення в архів невеликими пачками, щоб не навантажувати БД."""
+    total = 0
+    for _ in range(ORDERS_ARCHIVE_MAX_BATCHES):
+        moved = await archive_completed_orders(ORDERS_ARCHIVE_AFTER_DAYS, ORDERS_ARCHIVE_BATCH_SIZE)
+        total += moved
+        if moved < ORDERS_ARCHIVE_BATCH_SIZE:
+            break
+        await asyncio.sleep(ORDERS_ARCHIVE_BATCH_PAUSE)
+    if total:
+        logger.info(f"В архів перенесено {total} виконаних замовлень.")
+
+async def archive_closed_dialogs_job():
+    await archive_closed_dialogs(DIALOG_ARCHIVE_GRACE_HOURS, DIALOG_ARCHIVE_BATCH_SIZE)
+
+async def close_stale_dialogs_job():
+    """
+    Завершує неактивні діалоги одним запитом до БД і сповіщає сторони через обмежену розсилку:
+    кожного клієнта окремо, кожного менеджера - одним повідомленням зі списком клієнтів.
+    """
+    closed = await close_stale_dialogs(DIALOG_IDLE_CLOSE_MINUTES, DIALOG_IDLE_CLOSE_BATCH_SIZE)
+    if not closed:
+        return
+    for row in closed:
+        untrack_client(row["client_id"])
+    messages = [
+        (row["client_id"], "⌛ Діалог завершено через відсутність активності. Якщо питання залишилось — звертайтесь знову!",
+         {"reply_markup": main_menu})
+        for row in closed
+    ]
+    clients_by_manager: Dict[int, list[int]] = {}
+    released_managers = set()
+    for row in closed:
+        if row["manager_id"]:
+            clients_by_manager.setdefault(row["manager_id"], []).append(row["client_id"])
+            if row["was_active_dialog"]:
+                released_managers.add(row["manager_id"])
+    for manager_id, client_ids in clients_by_manager.items():
+        text = "⌛ Через відсутність активності автоматично завершено діалоги з клієнтами: " + \
+            ", ".join(f"`{cid}`" for cid in client_ids)
+        kwargs = {"parse_mode": "Markdown"}
+        if manager_id in released_managers:
+            # Активний діалог менеджера закрито - повертаємо його в головне меню
+            kwargs["reply_markup"] = manager_main_menu
+            await set_manager_menu_state(telegram_app, manager_id, "main")
+        messages.append((manager_id, text, kwargs))
+    sent, failed = await send_many(telegram_app.bot, messages)
+    logger.info(f"Автозавершення неактивних діалогів: {len(closed)} діалогів, сповіщень надіслано {sent}, не доставлено {failed}.")
+    if clients_by_manager:
+        # У менеджерів звільнились місця - віддаємо їм клієнтів з черги
+        await assign_pending_clients(telegram_app)
+
+async def assign_pending_clients_job():
+    """Періодичний розподіл черги на лідері (на випадок, якщо подію звільнення менеджера пропущено)."""
+    await assign_pending_clients(telegram_app)
+
 if __name__ == "__main__":
-    logger.info("Запуск Uvicorn сервера...")
-    uvicorn.run(fastapi_app, host="0.0.0.0", port=WEB_SERVER_PORT)
+    parser = argparse.ArgumentParser(description="Telegram-бот магазину автозапчастин")
+    parser.add_argument("--mode", choices=("webhook", "polling"), default=BOT_MODE,
+                        help="як отримувати оновлення (за замовчуванням BOT_MODE або webhook)")
+    BOT_MODE = parser.parse_args().mode
+    # HTTP-сервер працює в обох режимах: /metrics і перевірка стану, а в режимі webhook - прийом оновлень
+    logger.info(f"Запуск Uvicorn сервера (режим {BOT_MODE})...")
+    uvicorn.run(fastapi_app, host="0.0.0.0", port=WEB_SERVER_PORT, timeout_graceful_shutdown=SHUTDOWN_DRAIN_TIMEOUT)
@@ -0,0 +1,933 @@
+import pandas as pd
+import os
+import logging
+import itertools
+import re
+from typing import Dict, Any, Optional
+from datetime import datetime, timezone, timedelta
+from decimal import Decimal
+from zoneinfo import ZoneInfo
+
+from dialog_archive import DIALOG_ARCHIVE_CODEC, encode_dialog, decode_dialog
+from order_status import COMPLETED, status_code, status_label
+
+# 🛠️ Налаштування логування для memory_db.py
+logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(name)s - %(levelname)s - %(message)s')
+logger = logging.getLogger(__name__)
+
+# In-memory бекенд сховища з тією ж семантикою, що й db.py.
+# Використовується для локальної розробки та бенчмарків обробників без Supabase.
+# Дані живуть лише в межах процесу і зникають після перезапуску.
+
+_orders: Dict[str, Dict[str, Any]] = {}
+_client_states: Dict[int, Dict[str, Any]] = {}
+_client_messages: Dict[int, list[Dict[str, Any]]] = {} # client_id -> повідомлення у порядку додавання
+_manager_active_dialogs: Dict[int, Optional[int]] = {}
+_bonus_accounts: Dict[int, Dict[str, Any]] = {}
+_bonus_codes: Dict[Any, Dict[str, Any]] = {}
+_user_data: Dict[int, str] = {} # user_id -> JSON-рядок user_data
+_managers: Dict[int, Dict[str, Any]] = {}
+_forwarded_messages: Dict[tuple[int, int], Dict[str, Any]] = {} # (manager_id, message_id) -> client_id, created_at
+_processed_updates: Dict[int, datetime] = {} # update_id -> час обробки
+_polling_offsets: Dict[int, int] = {} # bot_id -> наступний offset getUpdates
+_orders_archive: Dict[str, Dict[str, Any]] = {}
+_dialog_archives: Dict[int, list[Dict[str, Any]]] = {} # client_id -> стиснені архіви діалогів
+_order_status_events: list[Dict[str, Any]] = [] # історія статусів у порядку event_id
+_order_event_callbacks: list = []
+_support_dialogs: list[Dict[str, Any]] = [] # журнал діалогів для SLA-аналітики у порядку dialog_id
+_export_watermarks: Dict[int, datetime] = {} # manager_id -> exported_until
+
+_message_ids = itertools.count(1)
+_bonus_code_ids = itertools.count(1)
+
+_initialized = False
+
+def _now() -> datetime:
+    """Поточний час з часовою зоною (аналог NOW() для TIMESTAMP WITH TIME ZONE)."""
+    return datetime.now(timezone.utc)
+
+def _to_money(value) -> Optional[Decimal]:
+    """Приводить суму до Decimal з двома знаками, як NUMERIC(10, 2) у Postgres."""
+    if value is None:
+        return None
+    return Decimal(str(value)).quantize(Decimal('0.01'))
+
+_ORDER_KEYS = ("order_id", "client_id", "status", "price", "description", "created_at")
+
+def _order_row(order: Dict[str, Any], keys=None) -> Dict[str, Any]:
+    """Копія замовлення: status - текст для відображення, status_code - збережений код (як _order_row у db.py)."""
+    row = {k: order[k] for k in keys} if keys else dict(order)
+    row["status_code"] = order["status"]
+    row["status"] = status_label(order["status"])
+    return row
+
+def _order_event_row(event: Dict[str, Any]) -> Dict[str, Any]:
+    """Копія події історії статусів з текстовими статусами (як _order_event_row у db.py)."""
+    row = dict(event)
+    row["status_code"] = event["status"]
+    row["status"] = status_label(event["status"])
+    if event["previous_status"] is not None:
+        row["previous_status"] = status_label(event["previous_status"])
+    return row
+
+def _record_status_event(order_id: str, status: int, previous_status: Optional[int], changed_by: Optional[int], changed_at: datetime):
+    """Додає подію в історію статусів і викликає колбеки стрічки змін (аналог тригера NOTIFY у db.py)."""
+    event = {
+        "event_id": len(_order_status_events) + 1,
+        "order_id": order_id,
+        "status": status,
+        "previous_status": previous_status,
+        "changed_by": changed_by,
+        "changed_at": changed_at,
+    }
+    _order_status_events.append(event)
+    for callback in _order_event_callbacks:
+        try:
+            callback(_order_event_row(event))
+        except Exception as e:
+            logger.error(f"Помилка в колбеку зміни статусу замовлення {order_id}: {e}")
+
+def _percentile(values: list[float], fraction: float) -> Optional[float]:
+    """Неперервний перцентиль (як percentile_cont у Postgres)."""
+    if not values:
+        return None
+    values = sorted(values)
+    pos = (len(values) - 1) * fraction
+    lower = int(pos)
+    upper = min(lower + 1, len(values) - 1)
+    return values[lower] + (values[upper] - values[lower]) * (pos - lower)
+
+async def get_db_pool():
+    """Сумісність з db.py: in-memory бекенд не має пулу з'єднань."""
+    if not _initialized:
+        await init_db_pool()
+    return None
+
+async def init_db_pool():
+    """Ініціалізує in-memory сховище."""
+    global _initialized
+    if not _initialized:
+        _initialized = True
+        logger.info("In-memory сховище ініціалізовано.")
+
+async def init_tables():
+    """Сумісність з db.py: таблиці in-memory бекенда створюються при імпорті модуля."""
+    logger.info("Таблиці успішно ініціалізовані/перевірені (in-memory).")
+
+async def close_db_pool():
+    """Сумісність з db.py: дані in-memory бекенда залишаються до кінця процесу."""
+    global _initialized
+    if _initialized:
+        _initialized = False
+        logger.info("In-memory сховище закрито.")
+
+async def start_cache_listener():
+    """Сумісність з db.py: in-memory бекенд працює в одному процесі, інвалідація не потрібна."""
+
+async def stop_cache_listener():
+    """Сумісність з db.py: in-memory бекенд працює в одному процесі, інвалідація не потрібна."""
+
+def add_invalidation_callback(callback):
+    """Сумісність з db.py: інші процеси не змінюють in-memory дані, колбеки не викликаються."""
+
+def add_order_status_callback(callback):
+    """Реєструє колбек callback(event) для кожної зміни статусу замовлення."""
+    _order_event_callbacks.append(callback)
+
+async def hold_leader_lock() -> bool:
+    """In-memory бекенд обслуговує один процес, тож він завжди лідер."""
+    return True
+
+async def release_leader_lock():
+    """Сумісність з db.py: блокування лідера в in-memory бекенді немає."""
+
+def reset_storage():
+    """Повністю очищає in-memory сховище (для бенчмарків та локальних сценаріїв)."""
+    global _message_ids, _bonus_code_ids
+    _orders.clear()
+    _order_status_events.clear()
+    _support_dialogs.clear()
+    _export_watermarks.clear()
+    _client_states.clear()
+    _client_messages.clear()
+    _manager_active_dialogs.clear()
+    _bonus_accounts.clear()
+    _bonus_codes.clear()
+    _user_data.clear()
+    _managers.clear()
+    _forwarded_messages.clear()
+    _processed_updates.clear()
+    _polling_offsets.clear()
+    _orders_archive.clear()
+    _dialog_archives.clear()
+    _message_ids = itertools.count(1)
+    _bonus_code_ids = itertools.count(1)
+
+async def add_order(order_id: str, client_id: int, status: str, price: Optional[float] = None, description: Optional[str] = None,
+                    changed_by: Optional[int] = None) -> bool:
+    """Додає нове замовлення (ON CONFLICT DO NOTHING) разом з початковою подією історії статусів."""
+    if order_id in _orders:
+        logger.info(f"Замовлення {order_id} вже існує, пропускаємо.")
+        return True
+    _orders[order_id] = {
+        "order_id": order_id,
+        "client_id": client_id,
+        "status": status_code(status),
+        "price": _to_money(price),
+        "description": description,
+        "created_at": _now(),
+    }
+    order = _orders[order_id]
+    order["updated_at"] = order["created_at"]
+    _record_status_event(order_id, order["status"], None, changed_by, order["created_at"])
+    logger.info(f"Замовлення {order_id} додано зі статусом '{status}'.")
+    return True
+
+async def get_order_details(order_id: str) -> Optional[Dict[str, Any]]:
+    """Повертає деталі замовлення (статус, ціну, опис) за його order_id, або None, якщо не знайдено."""
+    order = _orders.get(order_id)
+    if not order:
+        return None
+    return _order_row(order, ("order_id", "status", "price", "description", "created_at"))
+
+def _set_order_status(order: Dict[str, Any], code: int, changed_by: Optional[int]):
+    previous = order["status"]
+    order["status"] = code
+    if previous != code:
+        order["updated_at"] = _now()
+        _record_status_event(order["order_id"], code, previous, changed_by, _now())
+
+async def update_order_status(order_id: str, new_status: str, changed_by: Optional[int] = None):
+    """Оновлює статус замовлення за його order_id і записує подію в історію статусів."""
+    order = _orders.get(order_id)
+    if order:
+        _set_order_status(order, status_code(new_status), changed_by)
+    logger.info(f"Статус замовлення {order_id} оновлено на {new_status}.")
+
+async def bulk_update_order_status(order_ids: list[str], new_status: str, changed_by: Optional[int] = None) -> list[Dict[str, Any]]:
+    """Оновлює статус кількох замовлень. Повертає {order_id, client_id, changed} знайдених замовлень."""
+    code = status_code(new_status)
+    updated = []
+    for order_id in dict.fromkeys(order_ids):
+        order = _orders.get(order_id)
+        if order:
+            changed = order["status"] != code
+            _set_order_status(order, code, changed_by)
+            updated.append({"order_id": order_id, "client_id": order["client_id"], "changed": changed})
+    logger.info(f"Статус {len(updated)} замовлень оновлено на {new_status}.")
+    return updated
+
+async def get_order_timeline(order_id: str) -> list[Dict[str, Any]]:
+    """Історія статусів замовлення від найстарішої події з dwell_seconds для кожного статусу."""
+    events = [e for e in _order_status_events if e["order_id"] == order_id]
+    timeline = []
+    for i, event in enumerate(events):
+        left_at = events[i + 1]["changed_at"] if i + 1 < len(events) else _now()
+        timeline.append(dict(_order_event_row(event), dwell_seconds=(left_at - event["changed_at"]).total_seconds()))
+    return timeline
+
+async def get_status_dwell_stats(days: int) -> list[Dict[str, Any]]:
+    """Час перебування замовлень у кожному статусі для етапів, що почалися за останні days днів."""
+    threshold = _now() - timedelta(days=days)
+    next_change: Dict[int, datetime] = {}
+    last_by_order: Dict[str, Dict[str, Any]] = {}
+    for event in _order_status_events:
+        previous = last_by_order.get(event["order_id"])
+        if previous is not None:
+            next_change[previous["event_id"]] = event["changed_at"]
+        last_by_order[event["order_id"]] = event
+    stats: Dict[int, Dict[str, Any]] = {}
+    for event in _order_status_events:
+        if event["changed_at"] < threshold or event["status"] == COMPLETED:
+            continue
+        entry = stats.setdefault(event["status"], {"durations": [], "in_progress": 0})
+        left_at = next_change.get(event["event_id"])
+        if left_at is None:
+            entry["in_progress"] += 1
+        else:
+            entry["durations"].append((left_at - event["changed_at"]).total_seconds())
+    result = []
+    for code in sorted(stats):
+        durations = stats[code]["durations"]
+        result.append({
+            "status": status_label(code),
+            "status_code": code,
+            "completed": len(durations),
+            "in_progress": stats[code]["in_progress"],
+            "avg_seconds": sum(durations) / len(durations) if durations else None,
+            "p50_seconds": _percentile(durations, 0.5),
+            "p90_seconds": _percentile(durations, 0.9),
+        })
+    return result
+
+async def get_order_status_events_since(after_event_id: int, limit: int = 500) -> list[Dict[str, Any]]:
+    """Повертає до limit подій зміни статусу з event_id > after_event_id (за зростанням)."""
+    return [_order_event_row(e) for e in _order_status_events[after_event_id:after_event_id + limit]]
+
+async def get_client_id_by_order_id(order_id: str) -> Optional[int]:
+    """Повертає client_id замовлення або None, якщо замовлення не знайдено."""
+    order = _orders.get(order_id)
+    return order["client_id"] if order else None
+
+async def get_all_orders():
+    """Повертає всі замовлення."""
+    return [_order_row(o, _ORDER_KEYS) for o in _orders.values()]
+
+async def get_orders_by_status(status: str):
+    """Повертає замовлення за певним статусом."""
+    code = status_code(status)
+    return [_order_row(o, _ORDER_KEYS) for o in _orders.values() if o["status"] == code]
+
+async def delete_order(order_id: str):
+    """Видаляє замовлення за його order_id."""
+    _orders.pop(order_id, None)
+    logger.info(f"Замовлення {order_id} видалено.")
+
+async def add_client_state(client_id: int, is_active: bool = False, is_notified: bool = False, current_manager_id: Optional[int] = None):
+    """Додає новий стан клієнта або оновлює існуючий."""
+    _client_states[client_id] = {
+        "is_active": is_active,
+        "is_notified": is_notified,
+        "current_manager_id": current_manager_id,
+        "last_activity": _now(),
+    }
+    logger.info(f"Стан клієнта {client_id} додано/оновлено.")
+
+async def get_client_state(client_id: int):
+    """Повертає стан клієнта за його client_id, або None, якщо не знайдено."""
+    state = _client_states.get(client_id)
+    return dict(state) if state else None
+
+async def update_client_active_status(client_id: int, is_active: bool):
+    """Оновлює статус активності клієнта."""
+    state = _client_states.get(client_id)
+    if state:
+        state["is_active"] = is_active
+        state["last_activity"] = _now()
+        for dialog in _open_support_dialogs(client_id):
+            dialog["closed_at"] = _now()
+        if is_active:
+            _support_dialogs.append({
+                "dialog_id": len(_support_dialogs) + 1, "client_id": client_id, "opened_at": _now(),
+                "claimed_at": None, "manager_id": None, "first_client_message_at": None, "first_response_at": None,
+                "closed_at": None, "message_count": 0, "metrics_final": False,
+            })
+    logger.info(f"Статус активності клієнта {client_id} оновлено на {is_active}.")
+
+async def update_client_notified_status(client_id: int, is_notified: bool):
+    """Оновлює статус сповіщення клієнта."""
+    state = _client_states.get(client_id)
+    if state:
+        state["is_notified"] = is_notified
+    logger.info(f"Статус сповіщення клієнта {client_id} оновлено на {is_notified}.")
+
+async def update_client_manager(client_id: int, manager_id: Optional[int]):
+    """Оновлює ID менеджера, який зараз працює з клієнтом."""
+    state = _client_states.get(client_id)
+    if state:
+        state["current_manager_id"] = manager_id
+    logger.info(f"Менеджер для клієнта {client_id} оновлено на {manager_id}.")
+
+async def close_stale_dialogs(idle_minutes: int, batch_size: int) -> list[Dict[str, Any]]:
+    """
+    Завершує до batch_size активних діалогів, у яких понад idle_minutes хвилин не було ні повідомлень,
+    ні змін стану. Повертає [{client_id, manager_id, was_active_dialog}] для сповіщення сторін.
+    """
+    threshold = _now() - timedelta(minutes=idle_minutes)
+    # Повідомлення зберігають локальний час без часового поясу, як client_messages у Postgres
+    messages_threshold = datetime.now() - timedelta(minutes=idle_minutes)
+    stale = sorted(
+        ((cid, s) for cid, s in _client_states.items()
+         if s["is_active"] and s["last_activity"] < threshold
+         and not any(m["timestamp"] >= messages_threshold for m in _client_messages.get(cid, []))),
+        key=lambda item: item[1]["last_activity"]
+    )[:batch_size]
+    closed = []
+    for client_id, state in stale:
+        manager_id = state["current_manager_id"]
+        state.update(is_active=False, is_notified=False, current_manager_id=None, last_activity=_now())
+        for dialog in _open_support_dialogs(client_id):
+            dialog["closed_at"] = _now()
+        released = [m for m, c in _manager_active_dialogs.items() if c == client_id]
+        for m in released:
+            _manager_active_dialogs[m] = None
+        closed.append({
+            "client_id": client_id,
+            "manager_id": manager_id if manager_id is not None else next(iter(released), None),
+            "was_active_dialog": bool(released),
+        })
+    if closed:
+        logger.info(f"Автоматично завершено {len(closed)} неактивних діалогів.")
+    return closed
+
+async def get_manager_active_dialogs(manager_id: int) -> Optional[int]:
+    """Повертає client_id активного діалогу менеджера або None."""
+    return _manager_active_dialogs.get(manager_id)
+
+async def update_manager_active_dialog(manager_id: int, client_id: Optional[int]):
+    """Встановлює або очищає активний діалог для менеджера."""
+    if client_id is not None and client_id not in _client_states:
+        # Аналог порушення FOREIGN KEY у Postgres
+        logger.error(f"Помилка при оновленні активного діалогу для менеджера {manager_id}: клієнта {client_id} не існує.")
+        return
+    _manager_active_dialogs[manager_id] = client_id
+    if client_id:
+        logger.info(f"Менеджер {manager_id} тепер веде активний діалог з клієнтом {client_id}.")
+    else:
+        logger.info(f"Активний діалог для менеджера {manager_id} очищено.")
+
+async def claim_client(client_id: int, manager_id: int) -> bool:
+    """Атомарно закріплює активного клієнта за менеджером."""
+    state = _client_states.get(client_id)
+    if not state or not state["is_active"] or state["current_manager_id"] not in (None, manager_id):
+        return False
+    state["current_manager_id"] = manager_id
+    _mark_support_dialog_claimed(client_id, manager_id)
+    logger.info(f"Клієнта {client_id} закріплено за менеджером {manager_id}.")
+    return True
+
+# 🔥 ФУНКЦІЇ РЕЄСТРУ МЕНЕДЖЕРІВ ТА РОЗПОДІЛУ КЛІЄНТІВ 🔥
+
+async def register_manager(manager_id: int, max_dialogs: int):
+    """Додає менеджера до реєстру, якщо його там ще немає."""
+    _managers.setdefault(manager_id, {"manager_id": manager_id, "is_online": True, "max_dialogs": max_dialogs})
+    logger.info(f"Менеджер {manager_id} зареєстрований.")
+
+async def set_manager_online(manager_id: int, is_online: bool):
+    """Змінює онлайн-статус менеджера."""
+    if manager_id in _managers:
+        _managers[manager_id]["is_online"] = is_online
+    logger.info(f"Менеджер {manager_id} тепер {'онлайн' if is_online else 'офлайн'}.")
+
+async def set_manager_max_dialogs(manager_id: int, max_dialogs: int):
+    """Встановлює ліміт одночасних діалогів менеджера."""
+    if manager_id in _managers:
+        _managers[manager_id]["max_dialogs"] = max_dialogs
+    logger.info(f"Ліміт діалогів менеджера {manager_id} встановлено на {max_dialogs}.")
+
+async def get_managers_load() -> list[Dict[str, Any]]:
+    """Повертає менеджерів з кількістю активних діалогів."""
+    loads = {mid: 0 for mid in _managers}
+    for state in _client_states.values():
+        if state["is_active"] and state["current_manager_id"] in loads:
+            loads[state["current_manager_id"]] += 1
+    return [dict(m, active_dialogs=loads[mid]) for mid, m in sorted(_managers.items())]
+
+async def assign_client_to_least_loaded_manager(client_id: int) -> Optional[int]:
+    """Призначає очікуючого клієнта найменш завантаженому онлайн-менеджеру з вільним лімітом."""
+    state = _client_states.get(client_id)
+    if not state or not state["is_active"] or state["current_manager_id"] is not None:
+        return None
+    candidates = [
+        (m["active_dialogs"], m["manager_id"]) for m in await get_managers_load()
+        if m["is_online"] and m["active_dialogs"] < m["max_dialogs"]
+    ]
+    if not candidates:
+        return None
+    manager_id = min(candidates)[1]
+    state["current_manager_id"] = manager_id
+    _mark_support_dialog_claimed(client_id, manager_id)
+    logger.info(f"Клієнта {client_id} автоматично призначено менеджеру {manager_id}.")
+    return manager_id
+
+async def get_active_clients():
+    """Повертає список ID активних клієнтів."""
+    return [cid for cid, s in _client_states.items() if s["is_active"]]
+
+async def get_pending_clients() -> list[Dict[str, Any]]:
+    """Повертає активних клієнтів без менеджера, відсортованих за last_activity."""
+    pending = [
+        {"client_id": cid, "last_activity": s["last_activity"]}
+        for cid, s in _client_states.items()
+        if s["is_active"] and s["current_manager_id"] is None
+    ]
+    pending.sort(key=lambda r: r["last_activity"])
+    return pending
+
+async def get_not_notified_clients():
+    """Повертає список ID клієнтів, які не були сповіщені."""
+    return [cid for cid, s in _client_states.items() if not s["is_notified"]]
+
+async def add_client_message(client_id: int, sender_type: str, message_text: str,
+                             media_type: Optional[str] = None, file_id: Optional[str] = None) -> bool:
+    """Додає повідомлення від клієнта або менеджера до історії (для медіа - лише file_id Telegram). False - не додано."""
+    if client_id not in _client_states:
+        # Аналог порушення FOREIGN KEY у Postgres
+        logger.error(f"Помилка при додаванні повідомлення для клієнта {client_id}: стану клієнта не існує.")
+        return False
+    _client_messages.setdefault(client_id, []).append({
+        "message_id": next(_message_ids),
+        "sender_type": sender_type,
+        "message_text": message_text,
+        "timestamp": datetime.now(),
+        "media_type": media_type,
+        "file_id": file_id,
+    })
+    logger.info(f"Повідомлення для клієнта {client_id} додано.")
+    return True
+
+async def maintain_client_messages_partitions(retention_months: int, drop: bool = True) -> list[str]:
+    """Секцій у пам'яті немає: просто видаляє повідомлення, старші за термін зберігання."""
+    threshold = datetime.now() - timedelta(days=30 * retention_months)
+    for client_id, messages in _client_messages.items():
+        _client_messages[client_id] = [m for m in messages if m["timestamp"] >= threshold]
+    for client_id, archives in _dialog_archives.items():
+        _dialog_archives[client_id] = [a for a in archives if a["last_ts"] >= threshold]
+    return []
+
+def is_db_degraded() -> bool:
+    """Дані в пам'яті процесу завжди доступні."""
+    return False
+
+def get_db_health() -> Dict[str, Any]:
+    """Дані в пам'яті процесу завжди доступні: запобіжник закритий, відкладених записів немає."""
+    return {"state": "closed", "failures": 0, "times_opened": 0, "deferred_writes": 0, "dropped_writes": 0, "degraded_reads": 0}
+
+def pending_client_messages() -> int:
+    """Повідомлення зберігаються одразу, буфера немає."""
+    return 0
+
+async def flush_client_messages() -> bool:
+    """Повідомлення зберігаються одразу, буфера немає."""
+    return True
+
+async def get_client_messages(client_id: int):
+    """Повертає всі повідомлення для певного клієнта (разом із розпакованими архівами завершених діалогів)."""
+    messages = []
+    for archive in _dialog_archives.get(client_id, []):
+        messages.extend(decode_dialog(archive["payload"], archive["codec"]))
+    messages.extend(
+        {k: m[k] for k in ("sender_type", "message_text", "timestamp", "media_type", "file_id")}
+        for m in _client_messages.get(client_id, [])
+    )
+    return messages
+
+async def archive_closed_dialogs(grace_hours: int, batch_size: int) -> int:
+    """Стискає повідомлення завершених діалогів клієнтів, які не писали понад grace_hours годин."""
+    threshold = datetime.now() - timedelta(hours=grace_hours)
+    archived = 0
+    for client_id, messages in list(_client_messages.items()):
+        if archived >= batch_size:
+            break
+        state = _client_states.get(client_id)
+        if not messages or (state and state["is_active"]) or messages[-1]["timestamp"] >= threshold:
+            continue
+        _dialog_archives.setdefault(client_id, []).append({
+            "first_ts": messages[0]["timestamp"],
+            "last_ts": messages[-1]["timestamp"],
+            "message_count": len(messages),
+            "codec": DIALOG_ARCHIVE_CODEC,
+            "payload": encode_dialog(messages),
+        })
+        _client_messages[client_id] = []
+        archived += 1
+    return archived
+
+# --- АНАЛІТИКА ПРОДАЖІВ ---
+STATS_TIME_ZONE = os.getenv("STATS_TIME_ZONE", "Europe/Kyiv")
+
+async def get_order_stats(days: int) -> list[Dict[str, Any]]:
+    """
+    Денні агрегати замовлень за останні days днів, новіші дні першими (формат як у db.py).
+    In-memory бекенд рахує їх з _orders та _orders_archive при кожному виклику.
+    """
+    tz = ZoneInfo(STATS_TIME_ZONE)
+    first_day = _now().astimezone(tz).date() - timedelta(days=days - 1)
+    stats: Dict[tuple, Dict[str, Any]] = {}
+    for order in list(_orders.values()) + list(_orders_archive.values()):
+        day = order["created_at"].astimezone(tz).date()
+        if day < first_day:
+            continue
+        row = stats.setdefault((day, order["status"]), {"orders_count": 0, "priced_count": 0, "revenue": Decimal("0.00")})
+        row["orders_count"] += 1
+        if order["price"] is not None:
+            row["priced_count"] += 1
+            row["revenue"] += order["price"]
+    result = []
+    for (day, code), row in sorted(stats.items(), key=lambda item: (-item[0][0].toordinal(), item[0][1])):
+        result.append({
+            "day": day,
+            "status": status_label(code),
+            "status_code": code,
+            **row,
+            "avg_price": row["revenue"] / row["priced_count"] if row["priced_count"] else None,
+        })
+    return result
+
+# --- SLA ПІДТРИМКИ ---
+
+def _open_support_dialogs(client_id: int) -> list[Dict[str, Any]]:
+    return [d for d in _support_dialogs if d["client_id"] == client_id and d["closed_at"] is None]
+
+def _mark_support_dialog_claimed(client_id: int, manager_id: int):
+    for dialog in _open_support_dialogs(client_id):
+        if dialog["claimed_at"] is None:
+            dialog["claimed_at"] = _now()
+            dialog["manager_id"] = manager_id
+
+async def compute_support_dialog_metrics(batch_size: int, after_dialog_id: int = 0) -> tuple[int, int]:
+    """
+    Заповнює час першого повідомлення клієнта, першої відповіді та кількість повідомлень для незафіксованих
+    діалогів з dialog_id > after_dialog_id. Повертає (кількість оброблених, останній dialog_id).
+    """
+    pending = [d for d in _support_dialogs if not d["metrics_final"] and d["dialog_id"] > after_dialog_id][:batch_size]
+    for dialog in pending:
+        # Як і client_messages у Postgres, повідомлення зберігають локальний час без часового поясу
+        opened = dialog["opened_at"].astimezone().replace(tzinfo=None)
+        closed = (dialog["closed_at"] or _now()).astimezone().replace(tzinfo=None)
+        messages = [m for m in _client_messages.get(dialog["client_id"], []) if opened <= m["timestamp"] <= closed]
+        first = {}
+        for m in messages:
+            first.setdefault(m["sender_type"], m["timestamp"].astimezone())
+        dialog["first_client_message_at"] = first.get("client")
+        dialog["first_response_at"] = first.get("manager")
+        dialog["message_count"] = len(messages)
+        dialog["metrics_final"] = dialog["closed_at"] is not None
+    return len(pending), pending[-1]["dialog_id"] if pending else after_dialog_id
+
+async def get_support_sla_stats(days: int, group_by: str = "day") -> list[Dict[str, Any]]:
+    """Перцентилі SLA для діалогів, відкритих за останні days днів (формат як у db.py)."""
+    tz = ZoneInfo(STATS_TIME_ZONE)
+    threshold = _now() - timedelta(days=days)
+    groups: Dict[tuple, list[Dict[str, Any]]] = {}
+    for dialog in _support_dialogs:
+        if dialog["opened_at"] < threshold:
+            continue
+        local = dialog["opened_at"].astimezone(tz)
+        key = {"day": (local.date(),), "hour_of_week": (local.isoweekday(), local.hour), "total": ()}[group_by]
+        groups.setdefault(key, []).append(dialog)
+    if group_by == "total" and not groups:
+        groups[()] = []
+    key_names = {"day": ("day",), "hour_of_week": ("dow", "hour"), "total": ()}[group_by]
+    result = []
+    for key in sorted(groups):
+        dialogs = groups[key]
+        row = dict(zip(key_names, key))
+        row["dialogs"] = len(dialogs)
+        row["unanswered"] = sum(1 for d in dialogs if d["metrics_final"] and d["first_response_at"] is None)
+        for name, end in (("claim", "claimed_at"), ("first_response", "first_response_at"), ("duration", "closed_at")):
+            durations = [(d[end] - d["opened_at"]).total_seconds() for d in dialogs if d[end] is not None]
+            row[f"{name}_p50"] = _percentile(durations, 0.5)
+            row[f"{name}_p90"] = _percentile(durations, 0.9)
+        result.append(row)
+    return result
+
+# --- ПОШУК ДЛЯ МЕНЕДЖЕРІВ ---
+# Спрощений аналог word_similarity з pg_trgm: частка триграм запиту, що є в найкращому фрагменті тексту
+# (послідовності сусідніх слів). Поріг - той самий SEARCH_SIMILARITY_THRESHOLD, що й у db.py.
+SEARCH_SIMILARITY_THRESHOLD = float(os.getenv("SEARCH_SIMILARITY_THRESHOLD", 0.5))
+
+def _trigrams(words: list[str]) -> set[str]:
+    result = set()
+    for word in words:
+        padded = f"  {word} "
+        result.update(padded[i:i + 3] for i in range(len(padded) - 2))
+    return result
+
+def _words(text: Optional[str]) -> list[str]:
+    return re.findall(r"\w+", (text or "").lower())
+
+def _word_similarity(query: str, text: Optional[str]) -> float:
+    query_words = _words(query)
+    query_trigrams = _trigrams(query_words)
+    if not query_trigrams:
+        return 0.0
+    text_words = _words(text)
+    best = 0.0
+    for start in range(len(text_words)):
+        for end in range(start + 1, min(start + len(query_words), len(text_words)) + 1):
+            shared = len(query_trigrams & _trigrams(text_words[start:end]))
+            best = max(best, shared / len(query_trigrams))
+    return best
+
+def _search_page(items: list[Dict[str, Any]], text_key: str, time_key: str, query: str, limit: int, offset: int) -> list[Dict[str, Any]]:
+    found = []
+    for item in items:
+        score = _word_similarity(query, item[text_key])
+        if score >= SEARCH_SIMILARITY_THRESHOLD:
+            found.append(dict(item, score=score))
+    found.sort(key=lambda r: (r["score"], r[time_key]), reverse=True)
+    return found[offset:offset + limit]
+
+async def search_orders(query: str, limit: int, offset: int = 0) -> list[Dict[str, Any]]:
+    """Шукає замовлення (включно з архівними) за описом, найсхожіші першими."""
+    orders = [
+        _order_row(o, ("order_id", "client_id", "status", "price", "description", "created_at"))
+        for o in list(_orders.values()) + list(_orders_archive.values())
+    ]
+    return _search_page(orders, "description", "created_at", query, limit, offset)
+
+async def search_client_messages(query: str, limit: int, offset: int = 0) -> list[Dict[str, Any]]:
+    """Шукає повідомлення діалогів за текстом, найсхожіші першими."""
+    messages = [
+        {"client_id": client_id, **{k: m[k] for k in ("sender_type", "message_text", "timestamp")}}
+        for client_id, client_messages in _client_messages.items() for m in client_messages
+    ]
+    return _search_page(messages, "message_text", "timestamp", query, limit, offset)
+
+def _orders_dataframe(rows: list[Dict[str, Any]]) -> pd.DataFrame:
+    df = pd.DataFrame(rows)
+    # Excel не підтримує дати з часовою зоною
+    for column in ("created_at", "updated_at"):
+        if column in df:
+            df[column] = pd.to_datetime(df[column], utc=True).dt.tz_localize(None)
+    return df
+
+async def export_orders_to_excel():
+    """Експортує всі замовлення в Excel файл."""
+    data = [_order_row(o, _ORDER_KEYS + ("updated_at",)) for o in _orders.values()]
+    if not data:
+        logger.info("Немає даних для експорту.")
+        return None
+    try:
+        df = _orders_dataframe(data)
+        file_path = "orders_export.xlsx"
+        df.to_excel(file_path, index=False)
+        logger.info(f"Дані замовлень експортовано до {file_path}.")
+        return file_path
+    except Exception as e:
+        logger.error(f"Помилка при експорті замовлень в Excel: {e}")
+        return None
+
+async def export_order_changes_to_excel(manager_id: int) -> tuple[Optional[str], Optional[datetime]]:
+    """
+    Експортує в Excel замовлення, створені або змінені після попереднього експорту менеджера manager_id
+    (при першому експорті - всі). Повертає (шлях до файлу або None, якщо змін немає; нова позначка).
+    """
+    since = _export_watermarks.get(manager_id)
+    until = _now()
+    rows = []
+    for order in sorted(_orders.values(), key=lambda o: o["updated_at"]):
+        if (since is None or order["updated_at"] > since) and order["updated_at"] <= until:
+            row = _order_row(order, _ORDER_KEYS + ("updated_at",))
+            row["is_new"] = "нове" if since is None or order["created_at"] > since else "змінене"
+            rows.append(row)
+    if not rows:
+        logger.info(f"Немає змін замовлень для експорту менеджеру {manager_id}.")
+        return None, until
+    try:
+        file_path = f"orders_changes_{manager_id}.xlsx"
+        _orders_dataframe(rows).to_excel(file_path, index=False)
+        logger.info(f"Експортовано {len(rows)} змінених замовлень для менеджера {manager_id} до {file_path}.")
+        return file_path, until
+    except Exception as e:
+        logger.error(f"Помилка при експорті змін замовлень для менеджера {manager_id}: {e}")
+        return None, None
+
+async def commit_export_watermark(manager_id: int, exported_until: datetime):
+    """Запам'ятовує, що менеджер manager_id отримав усі зміни замовлень до exported_until."""
+    current = _export_watermarks.get(manager_id)
+    _export_watermarks[manager_id] = max(current, exported_until) if current else exported_until
+
+# 🔥 ФУНКЦІЇ ДЛЯ ОБРОБКИ БОНУСІВ 🔥
+
+def _find_account_by_instagram(instagram_user_id: str) -> Optional[Dict[str, Any]]:
+    for account in _bonus_accounts.values():
+        if account["instagram_user_id"] == instagram_user_id:
+            return account
+    return None
+
+async def create_or_get_bonus_account(telegram_user_id: int, instagram_user_id: Optional[str] = None) -> Optional[Dict[str, Any]]:
+    """Створює або повертає запис про бонусний акаунт клієнта."""
+    account = _bonus_accounts.get(telegram_user_id)
+    if account:
+        if instagram_user_id and account["instagram_user_id"] is None:
+            if _find_account_by_instagram(instagram_user_id):
+                # Аналог порушення UNIQUE (instagram_user_id)
+                logger.error(f"Помилка при створенні/отриманні бонусного акаунту для TG ID {telegram_user_id}: IG ID {instagram_user_id} вже зайнятий.")
+                return None
+            account["instagram_user_id"] = instagram_user_id
+            account["last_updated"] = _now()
+        return {k: account[k] for k in ("telegram_user_id", "instagram_user_id", "bonus_balance")}
+
+    _bonus_accounts[telegram_user_id] = {
+        "telegram_user_id": telegram_user_id,
+        "instagram_user_id": instagram_user_id,
+        "bonus_balance": Decimal('0.00'),
+        "last_updated": _now(),
+    }
+    logger.info(f"Створено новий бонусний акаунт для TG ID: {telegram_user_id}")
+    return {"telegram_user_id": telegram_user_id, "instagram_user_id": instagram_user_id, "bonus_balance": Decimal('0.00')}
+
+async def update_bonus_balance(telegram_user_id: int, amount: float) -> bool:
+    """Оновлює баланс бонусів для клієнта."""
+    await create_or_get_bonus_account(telegram_user_id)
+    account = _bonus_accounts[telegram_user_id]
+    account["bonus_balance"] = _to_money(account["bonus_balance"] + _to_money(amount))
+    account["last_updated"] = _now()
+    logger.info(f"Оновлено баланс бонусів для TG ID: {telegram_user_id} на {amount}.")
+    return True
+
+async def set_bonus_balance(telegram_user_id: int, new_balance: float) -> bool:
+    """Встановлює абсолютне значення балансу бонусів для клієнта."""
+    account = _bonus_accounts.get(telegram_user_id)
+    if account:
+        account["bonus_balance"] = _to_money(new_balance)
+        account["last_updated"] = _now()
+    logger.info(f"Встановлено баланс бонусів для TG ID: {telegram_user_id} на {new_balance}.")
+    return True
+
+def add_bonus_code(code: str, bonus_amount: float, user_id: Optional[str] = None, is_active: bool = True) -> int:
+    """
+    Додає бонусний код у in-memory сховище.
+    У Postgres таблиця bonus_codes наповнюється поза ботом, тут це робиться вручну.
+    """
+    code_id = next(_bonus_code_ids)
+    _bonus_codes[code_id] = {
+        "id": code_id,
+        "code": code,
+        "is_active": is_active,
+        "bonus_amount": _to_money(bonus_amount),
+        "user_id": user_id,
+        "redeemed_at": None,
+        "activated_by_tg_user_id": None,
+    }
+    return code_id
+
+async def get_bonus_code_details(code: str) -> Optional[Dict[str, Any]]:
+    """Отримує деталі бонусного коду за його значенням."""
+    for record in _bonus_codes.values():
+        if record["code"] == code:
+            details = dict(record)
+            details['value'] = details.pop('bonus_amount')
+            details['assigned_to_ig_user_id'] = details.pop('user_id')
+            details['activation_date'] = details.pop('redeemed_at')
+            return details
+    return None
+
+async def activate_bonus_code(code_id: str, telegram_user_id: int) -> bool:
+    """
+    Активує бонусний код, позначаючи його як використаний
+    та записуючи, хто його активував.
+    """
+    record = _bonus_codes.get(code_id)
+    if record and record["is_active"]:
+        record["is_active"] = False
+        record["activated_by_tg_user_id"] = telegram_user_id
+        record["redeemed_at"] = _now()
+    logger.info(f"Бонусний код ID {code_id} активовано користувачем TG ID {telegram_user_id}.")
+    return True
+
+async def get_telegram_id_by_instagram_id(instagram_user_id: str) -> Optional[int]:
+    """Повертає Telegram ID, пов'язаний з даним Instagram ID."""
+    account = _find_account_by_instagram(instagram_user_id)
+    return account["telegram_user_id"] if account else None
+
+async def link_instagram_to_telegram_account(telegram_user_id: int, instagram_user_id: str) -> bool:
+    """Зв'язує Instagram ID з існуючим Telegram-акаунтом."""
+    await create_or_get_bonus_account(telegram_user_id)
+    owner = _find_account_by_instagram(instagram_user_id)
+    if owner and owner["telegram_user_id"] != telegram_user_id:
+        logger.error(f"Помилка при зв'язуванні IG ID {instagram_user_id} з TG ID {telegram_user_id}: IG ID вже зайнятий.")
+        return False
+    account = _bonus_accounts[telegram_user_id]
+    account["instagram_user_id"] = instagram_user_id
+    account["last_updated"] = _now()
+    logger.info(f"Зв'язано IG ID {instagram_user_id} з TG ID {telegram_user_id}.")
+    return True
+
+# 🔥 ФУНКЦІЇ ДЛЯ ОТРИМАННЯ СПИСКІВ ЗАМОВЛЕНЬ 🔥
+
+async def get_client_orders(client_id: int) -> list[Dict[str, Any]]:
+    """Повертає всі замовлення для певного клієнта, новіші першими."""
+    orders = [
+        _order_row(o, ("order_id", "status", "created_at", "price", "description"))
+        for o in list(_orders.values()) + list(_orders_archive.values()) if o["client_id"] == client_id
+    ]
+    orders.sort(key=lambda o: o["created_at"], reverse=True)
+    return orders
+
+async def archive_completed_orders(older_than_days: int, batch_size: int) -> int:
+    """Переносить до batch_size давно виконаних замовлень в архів."""
+    threshold = _now() - timedelta(days=older_than_days)
+    candidates = sorted(
+        (o for o in _orders.values() if o["status"] == COMPLETED and o["created_at"] < threshold),
+        key=lambda o: o["created_at"]
+    )[:batch_size]
+    for order in candidates:
+        _orders_archive.setdefault(order["order_id"], dict(order, archived_at=_now()))
+        del _orders[order["order_id"]]
+    return len(candidates)
+
+async def get_all_active_orders() -> list[Dict[str, Any]]:
+    """Повертає всі замовлення, статус яких НЕ "✅ Замовлення виконано", новіші першими."""
+    orders = [_order_row(o) for o in _orders.values() if o["status"] != COMPLETED]
+    orders.sort(key=lambda o: o["created_at"], reverse=True)
+    logger.info(f"get_all_active_orders: Знайдено {len(orders)} активних замовлень.")
+    return orders
+
+# 🔥 ФУНКЦІЇ ДЛЯ ЗБЕРЕЖЕННЯ context.user_data (persistence.py) 🔥
+
+async def get_persisted_user_data(user_id: int) -> Optional[str]:
+    """Повертає збережений user_data користувача як JSON-рядок, або None, якщо запису немає."""
+    return _user_data.get(user_id)
+
+async def save_user_data_batch(rows: list[tuple[int, str]]) -> bool:
+    """Зберігає пачку user_data. rows — список пар (user_id, JSON-рядок)."""
+    for user_id, data in rows:
+        _user_data[user_id] = data
+    return True
+
+async def delete_persisted_user_data(user_id: int):
+    """Видаляє збережений user_data користувача."""
+    _user_data.pop(user_id, None)
+
+# 🔥 ФУНКЦІЇ ДЛЯ МАРШРУТИЗАЦІЇ ВІДПОВІДЕЙ МЕНЕДЖЕРА (REPLY) 🔥
+
+async def add_forwarded_message(manager_id: int, message_id: int, client_id: int):
+    """Запам'ятовує, що повідомлення message_id у чаті менеджера належить діалогу з client_id."""
+    _forwarded_messages.setdefault((manager_id, message_id), {"client_id": client_id, "created_at": _now()})
+
+async def get_forwarded_message_client(manager_id: int, message_id: int) -> Optional[int]:
+    """Повертає client_id, якому належить повідомлення message_id у чаті менеджера, або None."""
+    record = _forwarded_messages.get((manager_id, message_id))
+    return record["client_id"] if record else None
+
+async def purge_forwarded_messages(older_than_days: int) -> int:
+    """Видаляє зв'язки пересланих повідомлень, старші за older_than_days днів."""
+    threshold = _now() - timedelta(days=older_than_days)
+    stale = [key for key, r in _forwarded_messages.items() if r["created_at"] < threshold]
+    for key in stale:
+        del _forwarded_messages[key]
+    return len(stale)
+
+# 🔥 ФУНКЦІЇ ДЛЯ ІДЕМПОТЕНТНОЇ ОБРОБКИ ОНОВЛЕНЬ TELEGRAM 🔥
+
+async def claim_update(update_id: int) -> bool:
+    """Позначає update_id як оброблений. False, якщо оновлення вже оброблялось."""
+    if update_id in _processed_updates:
+        return False
+    _processed_updates[update_id] = _now()
+    return True
+
+async def record_processed_updates(update_ids: list[int]) -> bool:
+    """Позначає пачку update_id як оброблені."""
+    now = _now()
+    for update_id in update_ids:
+        _processed_updates.setdefault(update_id, now)
+    return True
+
+async def get_recent_processed_updates(limit: int) -> list[int]:
+    """Повертає до limit найбільших оброблених update_id за зростанням."""
+    return sorted(_processed_updates)[-limit:] if limit > 0 else []
+
+async def release_update(update_id: int):
+    """Знімає позначку з update_id."""
+    _processed_updates.pop(update_id, None)
+
+async def get_polling_offset(bot_id: int) -> Optional[int]:
+    """Повертає збережений offset getUpdates для бота bot_id або None."""
+    return _polling_offsets.get(bot_id)
+
+async def save_polling_offset(bot_id: int, next_offset: int) -> bool:
+    """Зберігає offset getUpdates (лише вперед, як GREATEST у db.py)."""
+    _polling_offsets[bot_id] = max(_polling_offsets.get(bot_id, next_offset), next_offset)
+    return True
+
+async def purge_processed_updates(older_than_hours: int) -> int:
+    """Видаляє записи про оброблені оновлення, старші за older_than_hours годин."""
+    threshold = _now() - timedelta(hours=older_than_hours)
+    stale = [update_id for update_id, processed_at in _processed_updates.items() if processed_at < threshold]
+    for update_id in stale:
+        del _processed_updates[update_id]
+    return len(stale)
@@ -0,0 +1,63 @@
+import logging
+from typing import Awaitable, Callable, Dict, Tuple
+
+logger = logging.getLogger(__name__)
+
+# Метрики процесу у текстовому форматі Prometheus (ендпоінт /metrics у main.py).
+# Лічильники та gauge оновлюються кодом бота; колектори (add_collector) викликаються перед кожним
+# зчитуванням і оновлюють значення, які зберігаються в БД (спільні для всіх воркерів).
+
+_metrics: Dict[str, Dict] = {} # name -> {"type", "help", "values": {labels: value}}
+_collectors: list[Callable[[], Awaitable[None]]] = []
+
+def _labels_key(labels: Dict[str, object]) -> Tuple[Tuple[str, str], ...]:
+    return tuple(sorted((k, str(v)) for k, v in labels.items()))
+
+def _metric(name: str, metric_type: str, help_text: str) -> Dict:
+    metric = _metrics.get(name)
+    if metric is None:
+        metric = _metrics[name] = {"type": metric_type, "help": help_text, "values": {}}
+    return metric
+
+def set_gauge(name: str, value: float, help_text: str = "", **labels):
+    """Встановлює значення gauge з мітками labels (None - значення прибирається)."""
+    values = _metric(name, "gauge", help_text)["values"]
+    key = _labels_key(labels)
+    if value is None:
+        values.pop(key, None)
+    else:
+        values[key] = float(value)
+
+def inc_counter(name: str, help_text: str = "", amount: float = 1, **labels):
+    """Збільшує лічильник з мітками labels."""
+    values = _metric(name, "counter", help_text)["values"]
+    key = _labels_key(labels)
+    values[key] = values.get(key, 0.0) + amount
+
+def add_collector(collector: Callable[[], Awaitable[None]]):
+    """Реєструє асинхронну функцію, яка оновлює метрики перед кожним зчитуванням /metrics."""
+    _collectors.append(collector)
+
+def _escape(value: str) -> str:
+    return value.replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+def _format_labels(key: Tuple[Tuple[str, str], ...]) -> str:
+    if not key:
+        return ""
+    return "{" + ",".join(f'{k}="{_escape(v)}"' for k, v in key) + "}"
+
+async def render_metrics() -> str:
+    """Оновлює метрики колекторами і повертає їх у текстовому форматі Prometheus."""
+    for collector in _collectors:
+        try:
+            await collector()
+        except Exception as e:
+            logger.error(f"Помилка колектора метрик {getattr(collector, '__name__', collector)}: {e}")
+    lines = []
+    for name, metric in sorted(_metrics.items()):
+        if metric["help"]:
+            lines.append(f"# HELP {name} {metric['help']}")
+        lines.append(f"# TYPE {name} {metric['type']}")
+        for key, value in sorted(metric["values"].items()):
+            lines.append(f"{name}{_format_labels(key)} {value:g}")
+    return "\n".join(lines) + "\n"
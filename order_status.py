@@ -0,0 +1,42 @@
+from typing import Union
+
+# Статуси замовлень.
+# У БД статус зберігається як SMALLINT-код; текст для клієнтів і менеджерів береться лише звідси,
+# тому підпис статусу можна змінити без міграції даних.
+
+UNKNOWN = 0
+ASSEMBLING = 1
+AWAITING_EU_DELIVERY = 2
+DELIVERY_UKRAINE = 3
+COMPLETED = 4
+
+STATUS_LABELS = {
+    UNKNOWN: "❔ Невідомий статус",
+    ASSEMBLING: "🔄 Комплектування замовлення",
+    AWAITING_EU_DELIVERY: "🚚 Очікуємо доставку з ЄС",
+    DELIVERY_UKRAINE: "📮 Доставка по Україні",
+    COMPLETED: "✅ Замовлення виконано",
+}
+_CODES_BY_LABEL = {label: code for code, label in STATUS_LABELS.items()}
+
+def status_label(code: int) -> str:
+    """Текст статусу для відображення."""
+    return STATUS_LABELS.get(code, STATUS_LABELS[UNKNOWN])
+
+def status_code(status: Union[int, str]) -> int:
+    """Код статусу за кодом або за текстом (для сумісності з викликами, що передають підпис)."""
+    if isinstance(status, int):
+        if status not in STATUS_LABELS:
+            raise ValueError(f"Невідомий код статусу замовлення: {status}")
+        return status
+    code = _CODES_BY_LABEL.get(status)
+    if code is None:
+        raise ValueError(f"Невідомий статус замовлення: '{status}'")
+    return code
+
+def migration_case_sql(column: str) -> str:
+    """SQL-вираз CASE, що перетворює старі текстові статуси на коди (для одноразової міграції)."""
+    branches = " ".join(
+        f"WHEN {column} = '{label}' THEN {code}" for code, label in STATUS_LABELS.items() if code != UNKNOWN
+    )
+    return f"CASE {branches} ELSE {UNKNOWN} END"
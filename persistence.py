@@ -0,0 +1,187 @@
+import os
+import json
+import asyncio
+import logging
+from datetime import datetime
+from decimal import Decimal
+from typing import Dict, Any, Optional
+
+from telegram.ext import BasePersistence, PersistenceInput
+
+from storage import (
+    get_persisted_user_data, save_user_data_batch, delete_persisted_user_data,
+    add_invalidation_callback
+)
+
+logger = logging.getLogger(__name__)
+
+# Як часто PTB передає змінені user_data у persistence (секунди).
+# Усі зміни за цей інтервал записуються в БД однією пачкою.
+USER_DATA_FLUSH_INTERVAL = float(os.getenv("USER_DATA_FLUSH_INTERVAL", 0.3))
+# Пауза перед повторним записом пачки, яку не вдалося зберегти (БД недоступна)
+USER_DATA_RETRY_DELAY = float(os.getenv("USER_DATA_RETRY_DELAY", 5))
+
+def _encode_value(value):
+    """Серіалізує типи, які не підтримує JSON (Decimal для цін, datetime)."""
+    if isinstance(value, Decimal):
+        return {"__decimal__": str(value)}
+    if isinstance(value, datetime):
+        return {"__datetime__": value.isoformat()}
+    if isinstance(value, (set, tuple)):
+        return list(value)
+    raise TypeError(f"Тип {type(value).__name__} не підтримується у user_data")
+
+def _decode_object(obj: Dict[str, Any]):
+    if "__decimal__" in obj:
+        return Decimal(obj["__decimal__"])
+    if "__datetime__" in obj:
+        return datetime.fromisoformat(obj["__datetime__"])
+    return obj
+
+def dump_user_data(data: Dict[str, Any]) -> str:
+    """Перетворює user_data на JSON-рядок для збереження в БД."""
+    return json.dumps(data, default=_encode_value, ensure_ascii=False)
+
+def load_user_data(raw: str) -> Dict[str, Any]:
+    """Відновлює user_data з JSON-рядка з БД."""
+    return json.loads(raw, object_hook=_decode_object)
+
+class DbPersistence(BasePersistence):
+    """
+    Зберігає context.user_data (стан меню, режими очікування вводу тощо) у сховищі бота,
+    щоб перезапуск або кілька воркерів uvicorn не втрачали розмови.
+
+    - user_data завантажується ліниво: при першому оновленні від користувача (refresh_user_data);
+    - зміни накопичуються і записуються пачкою (write-behind) раз на update_interval;
+    - flush() під час зупинки бота записує все, що залишилось;
+    - коли інший воркер зберігає user_data, він надсилає інвалідацію, і тут дані перечитуються
+      при наступному оновленні від користувача.
+    chat_data, bot_data, callback_data та conversations бот не використовує, тому вони не зберігаються.
+    """
+
+    def __init__(self, update_interval: float = USER_DATA_FLUSH_INTERVAL):
+        super().__init__(
+            store_data=PersistenceInput(user_data=True, chat_data=False, bot_data=False, callback_data=False),
+            update_interval=update_interval,
+        )
+        self._loaded_user_ids: set[int] = set()
+        self._pending: Dict[int, str] = {} # user_id -> JSON-рядок, ще не записаний у БД
+        self._flush_task: Optional[asyncio.Task] = None
+        add_invalidation_callback(self._on_invalidation)
+
+    def _on_invalidation(self, table: str, key: str):
+        if table == "*":
+            self._loaded_user_ids.clear()
+        elif table == "user_data":
+            self._loaded_user_ids.discard(int(key))
+
+    # --- user_data ---
+
+    async def get_user_data(self) -> Dict[int, Dict[str, Any]]:
+        # Нічого не завантажуємо наперед: дані кожного користувача підтягуються в refresh_user_data.
+        return {}
+
+    async def refresh_user_data(self, user_id: int, user_data: Dict[str, Any]) -> None:
+        if user_id in self._loaded_user_ids:
+            return
+        self._loaded_user_ids.add(user_id)
+        if user_id in self._pending:
+            # Локальна версія новіша за збережену
+            return
+        raw = await get_persisted_user_data(user_id)
+        if raw:
+            user_data.clear()
+            user_data.update(load_user_data(raw))
+            logger.info(f"user_data користувача {user_id} завантажено з БД.")
+
+    async def update_user_data(self, user_id: int, data: Dict[str, Any]) -> None:
+        # Серіалізуємо одразу, щоб зберегти знімок стану на цей момент
+        self._pending[user_id] = dump_user_data(data)
+        self._loaded_user_ids.add(user_id)
+        self._schedule_flush()
+
+    async def drop_user_data(self, user_id: int) -> None:
+        self._pending.pop(user_id, None)
+        self._loaded_user_ids.discard(user_id)
+        await delete_persisted_user_data(user_id)
+
+    # --- пакетний запис ---
+
+    def _schedule_flush(self):
+        if self._flush_task is None or self._flush_task.done():
+            self._flush_task = asyncio.create_task(self._flush_soon())
+
+    async def _flush_soon(self):
+        # PTB викликає update_user_data для всіх змінених користувачів одночасно (asyncio.gather).
+        # Один пропуск циклу подій дозволяє зібрати їх усіх в одну пачку.
+        await asyncio.sleep(0)
+        # Поки запис не вдається, повторюємо з паузою; зміни, що надійшли за цей час, потрапляють у ту саму пачку
+        while not await self._flush_pending():
+            await asyncio.sleep(USER_DATA_RETRY_DELAY)
+
+    async def _flush_pending(self) -> bool:
+        """Записує накопичені user_data. Повертає False, якщо їх не вдалося зберегти (вони залишаються в черзі)."""
+        if not self._pending:
+            return True
+        rows = list(self._pending.items())
+        self._pending.clear()
+        saved = False
+        try:
+            saved = await save_user_data_batch(rows)
+        except Exception as e:
+            logger.error(f"Помилка при записі user_data для {len(rows)} користувачів: {e}")
+        finally:
+            if not saved:
+                # Повертаємо незаписані дані (і при скасуванні задачі), якщо їх ще не замінила новіша версія
+                for user_id, raw in rows:
+                    self._pending.setdefault(user_id, raw)
+        if not saved:
+            logger.warning(f"Не вдалося записати user_data для {len(rows)} користувачів, повторимо через {USER_DATA_RETRY_DELAY:g} с.")
+        return saved
+
+    async def flush(self) -> None:
+        # Фонова задача може чекати повтору - не чекаємо її, а робимо останню спробу одразу
+        if self._flush_task and not self._flush_task.done():
+            self._flush_task.cancel()
+            try:
+                await self._flush_task
+            except asyncio.CancelledError:
+                pass
+        await self._flush_pending()
+        if self._pending:
+            logger.error(f"Під час зупинки не збережено user_data для {len(self._pending)} користувачів.")
+
+    # --- дані, які бот не зберігає ---
+
+    async def get_chat_data(self) -> Dict[int, Dict[Any, Any]]:
+        return {}
+
+    async def update_chat_data(self, chat_id: int, data: Dict[Any, Any]) -> None:
+        pass
+
+    async def refresh_chat_data(self, chat_id: int, chat_data: Dict[Any, Any]) -> None:
+        pass
+
+    async def drop_chat_data(self, chat_id: int) -> None:
+        pass
+
+    async def get_bot_data(self) -> Dict[Any, Any]:
+        return {}
+
+    async def update_bot_data(self, data: Dict[Any, Any]) -> None:
+        pass
+
+    async def refresh_bot_data(self, bot_data: Dict[Any, Any]) -> None:
+        pass
+
+    async def get_callback_data(self):
+        return None
+
+    async def update_callback_data(self, data) -> None:
+        pass
+
+    async def get_conversations(self, name: str) -> Dict:
+        return {}
+
+    async def update_conversation(self, name: str, key, new_state) -> None:
+        pass
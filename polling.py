@@ -0,0 +1,152 @@
+import os
+import asyncio
+import logging
+from typing import Awaitable, Callable, Dict, Optional
+
+from telegram import Bot, Update
+from telegram.error import Conflict, NetworkError, RetryAfter
+
+from storage import get_polling_offset, save_polling_offset
+
+logger = logging.getLogger(__name__)
+
+# Режим long polling (getUpdates) - запасний варіант, коли хост вебхука недоступний, і зручний режим для
+# локальних навантажувальних тестів. Оновлення отримуються пачками до POLLING_BATCH_SIZE і проходять той самий
+# конвеєр, що й вебхук (відкидання дублікатів -> process_update). getUpdates викликає лише лідер.
+#
+# Offset (update_id наступного необробленого оновлення) зберігається в БД після кожної пачки, тому після
+# перезапуску оновлення не губляться; якщо процес впав до збереження offset, пачка прийде ще раз і вже
+# оброблені оновлення відкине захист від дублікатів (processed_updates).
+
+POLLING_BATCH_SIZE = int(os.getenv("POLLING_BATCH_SIZE", 100))
+POLLING_TIMEOUT = int(os.getenv("POLLING_TIMEOUT", 30))
+# Скільки разів пробувати оновлення, обробка якого завершилась помилкою, перш ніж пропустити його
+POLLING_MAX_ATTEMPTS = 3
+# Пауза перед повтором після неочікуваної помилки в циклі polling (секунди)
+POLLING_ERROR_DELAY = 5
+
+UpdateProcessor = Callable[[Update], Awaitable[bool]]
+
+_polling_task: Optional[asyncio.Task] = None
+_stop_requested = False
+_processing = False
+_failed_attempts: Dict[int, int] = {} # update_id -> кількість невдалих спроб
+
+async def _process_batch(updates: list[Update], process: UpdateProcessor) -> int:
+    """
+    Обробляє пачку: оновлення різних чатів паралельно, одного чату - по черзі (зберігається порядок діалогу).
+    Повертає offset для наступного getUpdates: перше оновлення, яке треба повторити, або наступне після пачки.
+    """
+    by_chat: Dict[Optional[int], list[Update]] = {}
+    for update in updates:
+        chat = update.effective_chat
+        by_chat.setdefault(chat.id if chat else None, []).append(update)
+    failed = set()
+
+    async def process_chat(chat_updates: list[Update]):
+        for update in chat_updates:
+            try:
+                ok = await process(update)
+            except Exception as e:
+                logger.exception(f"Помилка при обробці оновлення {update.update_id} у polling: {e}")
+                ok = False
+            if not ok:
+                failed.add(update.update_id)
+
+    await asyncio.gather(*(process_chat(chat_updates) for chat_updates in by_chat.values()))
+
+    next_offset = updates[-1].update_id + 1
+    for update in updates:
+        update_id = update.update_id
+        if update_id not in failed:
+            _failed_attempts.pop(update_id, None)
+            continue
+        attempts = _failed_attempts.get(update_id, 0) + 1
+        if attempts < POLLING_MAX_ATTEMPTS:
+            _failed_attempts[update_id] = attempts
+            next_offset = min(next_offset, update_id)
+        else:
+            _failed_attempts.pop(update_id, None)
+            logger.error(f"Оновлення {update_id} не оброблено після {attempts} спроб, пропускаємо.")
+    return next_offset
+
+async def _start_session(bot: Bot) -> Optional[int]:
+    """Повертає збережений offset і знімає вебхук: getUpdates не працює, поки в бота встановлено вебхук."""
+    offset = await get_polling_offset(bot.id)
+    await bot.delete_webhook()
+    logger.info(f"Polling запущено (offset {offset}, пачки до {POLLING_BATCH_SIZE} оновлень).")
+    return offset
+
+async def _polling_loop(bot: Bot, process: UpdateProcessor):
+    global _processing
+    started = False
+    offset = None
+    while not _stop_requested:
+        try:
+            if not started:
+                offset = await _start_session(bot)
+                started = True
+            updates = await bot.get_updates(
+                offset=offset, limit=POLLING_BATCH_SIZE, timeout=POLLING_TIMEOUT, allowed_updates=Update.ALL_TYPES
+            )
+        except RetryAfter as e:
+            logger.warning(f"Telegram обмежив getUpdates, чекаємо {e.retry_after} с.")
+            await asyncio.sleep(e.retry_after)
+            continue
+        except Conflict as e:
+            logger.error(f"Інший процес отримує оновлення цього бота (вебхук або polling): {e}")
+            await asyncio.sleep(POLLING_TIMEOUT)
+            continue
+        except NetworkError as e:
+            logger.warning(f"Помилка мережі при getUpdates: {e}. Повторюємо.")
+            await asyncio.sleep(1)
+            continue
+        except Exception as e:
+            # Polling не повинен тихо зупинитись, поки процес лишається лідером
+            logger.exception(f"Помилка в циклі polling: {e}. Повтор через {POLLING_ERROR_DELAY} с.")
+            await asyncio.sleep(POLLING_ERROR_DELAY)
+            continue
+        if not updates:
+            continue
+
+        _processing = True
+        try:
+            next_offset = await _process_batch(updates, process)
+            try:
+                saved = await save_polling_offset(bot.id, next_offset)
+            except Exception as e:
+                logger.error(f"Помилка при збереженні offset {next_offset}: {e}")
+                saved = False
+            if not saved:
+                logger.warning(f"Offset {next_offset} не збережено: після перезапуску пачка прийде повторно і буде відкинута як дублікати.")
+        finally:
+            _processing = False
+        if next_offset <= updates[-1].update_id:
+            await asyncio.sleep(1) # пауза перед повтором оновлення з помилкою
+        offset = next_offset
+    logger.info("Polling зупинено.")
+
+async def start_polling(bot: Bot, process: UpdateProcessor):
+    """Запускає отримання оновлень через getUpdates. process(update) повертає False, якщо оновлення треба повторити."""
+    global _polling_task, _stop_requested
+    if _polling_task is not None:
+        return
+    _stop_requested = False
+    _polling_task = asyncio.create_task(_polling_loop(bot, process))
+
+async def stop_polling():
+    """Зупиняє polling: очікування getUpdates переривається, а пачка, що обробляється, завершується і зберігає offset."""
+    global _polling_task, _stop_requested
+    if _polling_task is None:
+        return
+    _stop_requested = True
+    if not _processing:
+        _polling_task.cancel()
+    try:
+        await _polling_task
+    except asyncio.CancelledError:
+        pass
+    except Exception as e:
+        # Помилка polling не повинна переривати решту зупинки (звільнення захоплень, запис буферів, закриття пулу)
+        logger.error(f"Polling завершився з помилкою: {e}")
+    _polling_task = None
@@ -0,0 +1,55 @@
+from typing import Awaitable, Callable, Dict, Iterable, Optional, Tuple
+
+# Маршрутизатор текстових повідомлень (кнопок меню) до обробників.
+# Замість ланцюжка MessageHandler з regex-фільтрами та довгого if/elif у handle_message
+# обробник знаходиться кількома пошуками у словниках за (роль, стан меню, текст кнопки).
+#
+# Порядок пошуку:
+#   1. (роль, стан, текст)  - кнопка, яка діє лише в конкретному стані меню;
+#   2. (роль, текст)        - кнопка, яка діє в будь-якому стані;
+#   3. (роль, стан)         - довільний текст у стані (режим очікування вводу, активний діалог);
+#   4. роль                 - обробник за замовчуванням ("не розумію").
+
+Handler = Callable[..., Awaitable[None]]
+
+class MessageRouter:
+    def __init__(self):
+        self._exact: Dict[Tuple[str, str, str], Handler] = {}
+        self._any_state: Dict[Tuple[str, str], Handler] = {}
+        self._state_fallback: Dict[Tuple[str, str], Handler] = {}
+        self._default: Dict[str, Handler] = {}
+
+    def on_text(self, role: str, text: str, handler: Handler, states: Optional[Iterable[str]] = None):
+        """
+        Реєструє обробник кнопки з текстом text.
+        Якщо states не вказано, кнопка діє в будь-якому стані меню.
+        """
+        if states is None:
+            key = (role, text)
+            if key in self._any_state:
+                raise ValueError(f"Кнопка '{text}' для ролі '{role}' вже зареєстрована.")
+            self._any_state[key] = handler
+            return
+        for state in states:
+            key = (role, state, text)
+            if key in self._exact:
+                raise ValueError(f"Кнопка '{text}' для ролі '{role}' у стані '{state}' вже зареєстрована.")
+            self._exact[key] = handler
+
+    def on_state(self, role: str, state: str, handler: Handler):
+        """Реєструє обробник довільного тексту в стані state."""
+        self._state_fallback[(role, state)] = handler
+
+    def set_default(self, role: str, handler: Handler):
+        """Обробник для повідомлень, яким не знайшлося жодного маршруту."""
+        self._default[role] = handler
+
+    def resolve(self, role: str, state: str, text: str) -> Optional[Handler]:
+        handler = self._exact.get((role, state, text))
+        if handler is None:
+            handler = self._any_state.get((role, text))
+        if handler is None:
+            handler = self._state_fallback.get((role, state))
+        if handler is None:
+            handler = self._default.get(role)
+        return handler
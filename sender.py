@@ -0,0 +1,80 @@
+import os
+import asyncio
+import logging
+from typing import Any, Dict, Iterable, Tuple
+
+from telegram import Bot
+from telegram.error import Forbidden, RetryAfter
+
+logger = logging.getLogger(__name__)
+
+# Розсилка великої кількості повідомлень (масові сповіщення клієнтам) з обмеженням швидкості.
+# Telegram дозволяє боту близько 30 повідомлень на секунду в різні чати; при перевищенні
+# повертає RetryAfter. Усі розсилки процесу ділять один ліміт SEND_RATE_PER_SECOND.
+
+SEND_RATE_PER_SECOND = float(os.getenv("SEND_RATE_PER_SECOND", 25))
+SEND_MAX_ATTEMPTS = 3
+
+_send_lock = asyncio.Lock()
+_next_send_at = 0.0
+_send_tasks: set[asyncio.Task] = set() # задачі, чиє повідомлення зараз чекає черги або надсилається
+
+def pending_sends() -> int:
+    """Скільки повідомлень ще не надіслано (для звіту при зупинці бота)."""
+    return len(_send_tasks)
+
+async def cancel_pending_sends() -> int:
+    """
+    Скасовує задачі, що ще надсилають повідомлення, і чекає їх завершення (при зупинці бота, коли час
+    очікування вичерпано). Повертає кількість скасованих розсилок.
+    """
+    tasks = [task for task in _send_tasks if task is not asyncio.current_task()]
+    for task in tasks:
+        task.cancel()
+    await asyncio.gather(*tasks, return_exceptions=True)
+    return len(tasks)
+
+async def _wait_turn():
+    """Чекає на наступний вільний слот відправки (рівномірно SEND_RATE_PER_SECOND на секунду)."""
+    global _next_send_at
+    async with _send_lock:
+        loop = asyncio.get_running_loop()
+        now = loop.time()
+        if _next_send_at > now:
+            await asyncio.sleep(_next_send_at - now)
+            now = _next_send_at
+        _next_send_at = now + 1 / SEND_RATE_PER_SECOND
+
+async def send_message_throttled(bot: Bot, chat_id: int, text: str, **kwargs) -> bool:
+    """Надсилає повідомлення з урахуванням ліміту та RetryAfter. Повертає True, якщо повідомлення доставлено."""
+    task = asyncio.current_task()
+    _send_tasks.add(task)
+    try:
+        for attempt in range(1, SEND_MAX_ATTEMPTS + 1):
+            await _wait_turn()
+            try:
+                await bot.send_message(chat_id, text, **kwargs)
+                return True
+            except RetryAfter as e:
+                logger.warning(f"Telegram обмежив відправку, чекаємо {e.retry_after} с (спроба {attempt}/{SEND_MAX_ATTEMPTS}).")
+                await asyncio.sleep(e.retry_after)
+            except Forbidden as e:
+                logger.info(f"Користувач {chat_id} заблокував бота, повідомлення не надіслано: {e}")
+                return False
+            except Exception as e:
+                logger.warning(f"Не вдалося надіслати повідомлення користувачу {chat_id}: {e}")
+                return False
+        return False
+    finally:
+        _send_tasks.discard(task)
+
+async def send_many(bot: Bot, messages: Iterable[Tuple[int, str, Dict[str, Any]]]) -> Tuple[int, int]:
+    """
+    Надсилає пачку повідомлень (chat_id, text, kwargs для send_message) з обмеженням швидкості.
+    Повертає (кількість доставлених, кількість недоставлених).
+    """
+    results = await asyncio.gather(*(
+        send_message_throttled(bot, chat_id, text, **kwargs) for chat_id, text, kwargs in messages
+    ))
+    sent = sum(1 for ok in results if ok)
+    return sent, len(results) - sent
@@ -0,0 +1,59 @@
+import os
+import logging
+from dotenv import load_dotenv
+
+# 🛠️ Інтерфейс сховища: набір функцій, які бот використовує для роботи з даними.
+# Реалізації:
+#   STORAGE_BACKEND=postgres (за замовчуванням) -> db.py (asyncpg / Supabase)
+#   STORAGE_BACKEND=memory                      -> memory_db.py (дані в пам'яті процесу)
+# main.py імпортує функції лише звідси, тому бекенд можна змінити без змін у обробниках.
+
+logger = logging.getLogger(__name__)
+
+load_dotenv()
+
+STORAGE_BACKEND = os.getenv("STORAGE_BACKEND", "postgres").lower()
+
+STORAGE_API = (
+    "init_db_pool", "close_db_pool", "get_db_pool", "get_db_health", "is_db_degraded",
+    "start_cache_listener", "stop_cache_listener", "add_invalidation_callback",
+    "hold_leader_lock", "release_leader_lock",
+    "add_order", "update_order_status", "bulk_update_order_status", "get_order_details", "export_orders_to_excel",
+    "export_order_changes_to_excel", "commit_export_watermark",
+    "get_client_id_by_order_id", "get_all_orders", "get_orders_by_status", "delete_order",
+    "get_order_timeline", "get_status_dwell_stats", "get_order_status_events_since", "add_order_status_callback",
+    "add_client_state", "get_client_state", "update_client_active_status",
+    "update_client_notified_status", "update_client_manager", "close_stale_dialogs",
+    "get_manager_active_dialogs", "update_manager_active_dialog",
+    "get_active_clients", "get_pending_clients", "get_not_notified_clients", "claim_client",
+    "register_manager", "set_manager_online", "set_manager_max_dialogs",
+    "get_managers_load", "assign_client_to_least_loaded_manager",
+    "add_client_message", "get_client_messages", "flush_client_messages", "pending_client_messages",
+    "maintain_client_messages_partitions", "archive_closed_dialogs",
+    "search_orders", "search_client_messages",
+    "get_order_stats", "compute_support_dialog_metrics", "get_support_sla_stats",
+    "create_or_get_bonus_account", "update_bonus_balance", "set_bonus_balance",
+    "get_bonus_code_details", "activate_bonus_code",
+    "get_telegram_id_by_instagram_id", "link_instagram_to_telegram_account",
+    "get_client_orders", "get_all_active_orders", "archive_completed_orders",
+    "get_persisted_user_data", "save_user_data_batch", "delete_persisted_user_data",
+    "add_forwarded_message", "get_forwarded_message_client", "purge_forwarded_messages",
+    "claim_update", "record_processed_updates", "get_recent_processed_updates", "release_update",
+    "purge_processed_updates", "get_polling_offset", "save_polling_offset",
+)
+
+if STORAGE_BACKEND == "memory":
+    import memory_db as _backend
+elif STORAGE_BACKEND == "postgres":
+    import db as _backend
+else:
+    raise ValueError(f"Невідомий STORAGE_BACKEND '{STORAGE_BACKEND}'. Допустимі значення: postgres, memory.")
+
+_missing = [name for name in STORAGE_API if not hasattr(_backend, name)]
+if _missing:
+    raise ImportError(f"Бекенд сховища '{STORAGE_BACKEND}' не реалізує: {', '.join(_missing)}")
+
+globals().update({name: getattr(_backend, name) for name in STORAGE_API})
+__all__ = list(STORAGE_API)
+
+logger.info(f"Використовується бекенд сховища: {STORAGE_BACKEND}.")
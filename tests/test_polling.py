@@ -0,0 +1,83 @@
+import os
+import asyncio
+
+# main читає налаштування під час імпорту; тести працюють без БД і без Telegram
+os.environ.setdefault("BOT_TOKEN", "1:test")
+os.environ.setdefault("MANAGER_ID", "1")
+os.environ.setdefault("MANAGER_GROUP_ID", "-1")
+os.environ["STORAGE_BACKEND"] = "memory"
+
+from telegram import Update, User
+from telegram.ext import Application, ExtBot, MessageHandler, filters
+
+import main
+import polling
+from storage import get_polling_offset
+
+CLIENT_ID = 7
+UPDATE_ID = 500
+
+class OfflineBot(ExtBot):
+    """Бот без мережі: getUpdates віддає заготовлені пачки, offset кожного виклику записується."""
+
+    def __init__(self, token: str, batches: list[list[dict]]):
+        super().__init__(token)
+        with self._unfrozen():
+            self.batches = batches
+            self.offsets: list = []
+
+    async def get_me(self, *args, **kwargs):
+        self._bot_user = User(1, "bot", True, username="bot")
+        return self._bot_user
+
+    async def delete_webhook(self, *args, **kwargs):
+        return True
+
+    async def get_updates(self, offset=None, *args, **kwargs):
+        self.offsets.append(offset)
+        if not self.batches:
+            polling._stop_requested = True
+            return []
+        return [Update.de_json(data, self) for data in self.batches.pop(0)]
+
+def _message_update(update_id: int, text: str) -> dict:
+    return {
+        "update_id": update_id,
+        "message": {
+            "message_id": update_id,
+            "date": 0,
+            "chat": {"id": CLIENT_ID, "type": "private"},
+            "from": {"id": CLIENT_ID, "is_bot": False, "first_name": "Client"},
+            "text": text,
+        },
+    }
+
+def test_failed_update_is_retried_and_offset_held():
+    async def run():
+        calls = []
+
+        async def flaky_handler(update, context):
+            calls.append(update.update_id)
+            if len(calls) == 1:
+                raise RuntimeError("збій обробника")
+
+        # Telegram доставляє оновлення повторно, поки offset не зсунуто за нього
+        failed_update = _message_update(UPDATE_ID, "привіт")
+        bot = OfflineBot("1:test", [[failed_update], [failed_update]])
+        app = Application.builder().bot(bot).build()
+        app.add_handler(MessageHandler(filters.ALL, flaky_handler))
+        main.track_handler_errors(app)
+        await app.initialize()
+        main.telegram_app = app
+        try:
+            await asyncio.wait_for(polling._polling_loop(bot, main.process_incoming_update), timeout=10)
+        finally:
+            await app.shutdown()
+        return calls, bot.offsets, await get_polling_offset(bot.id)
+
+    calls, offsets, saved_offset = asyncio.run(run())
+    # Перша спроба впала в обробнику, повторна доставка оброблена
+    assert calls == [UPDATE_ID, UPDATE_ID]
+    # Після помилки offset утримується на оновленні, після успіху - зсувається далі
+    assert offsets == [None, UPDATE_ID, UPDATE_ID + 1]
+    assert saved_offset == UPDATE_ID + 1